@@ -0,0 +1,94 @@
+# Measures the texture side of the TextureTransfer loop without a model:
+# capture (texture -> RGBA8 tensor -> CHW image) and write back (CHW image ->
+# RGBA8 tensor -> texture), with a stand-in render engine publishing a frame
+# through its own texture every iteration. The shared memory backend runs on
+# CPU-only machines as well.
+#
+#   python -m benchmarks.bench_capture --width 1280 --height 720
+import argparse
+import time
+import numpy as np
+import torch
+import gfx2cuda as g2c
+
+from frame_converter import FrameConverter
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def bench(name, fn, frames):
+    for _ in range(10):
+        fn()
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    synchronize()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {elapsed / frames * 1000:.3f} ms/frame, {frames / elapsed:.1f} fps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark texture capture and write back")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--dtype", type=str, default="float16")
+    parser.add_argument("--backend", type=str, default="shm", choices=["shm", "d3d11"])
+    args = parser.parse_args()
+
+    backend = g2c.Backends.SHM if args.backend == "shm" else g2c.Backends.D3D11
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = getattr(torch, args.dtype)
+    shape = (args.height, args.width, 4)
+    rgba = g2c.TextureFormat.RGBA8UINT
+
+    # the engine's textures, opened through their handles like a session would
+    engine_input = g2c.texture(shape, rgba, backend=backend)
+    engine_output = g2c.texture(shape, rgba, backend=backend)
+    input_texture = g2c.open_ipc_texture(engine_input.ipc_handle, backend=backend)
+    output_texture = g2c.open_ipc_texture(engine_output.ipc_handle, backend=backend)
+
+    frame = torch.from_numpy(np.random.randint(0, 255, shape, dtype=np.uint8)).to(device)
+    input_tensor = torch.empty(shape, dtype=torch.uint8, device=device)
+    output_tensor = torch.full(shape, 255, dtype=torch.uint8, device=device)
+    converter = FrameConverter(device, dtype)
+
+    def render():
+        with engine_input:
+            engine_input.copy_from(frame)
+
+    stream = torch.cuda.current_stream() if torch.cuda.is_available() else None
+
+    def capture():
+        with input_texture.mapped(stream):
+            input_texture.copy_to(input_tensor, stream)
+        return converter.to_image(input_tensor)
+
+    image = capture()
+
+    def write_back():
+        converter.to_rgba(image, output_tensor)
+        with output_texture.mapped(stream):
+            output_texture.copy_from(output_tensor, stream)
+
+    def loop():
+        render()
+        capture()
+        write_back()
+
+    print(f"{args.backend} backend, {args.width}x{args.height} on {device}")
+    bench("render", render, args.frames)
+    bench("capture", capture, args.frames)
+    bench("write back", write_back, args.frames)
+    bench("loop", loop, args.frames)
+
+    for texture in (input_texture, output_texture, engine_input, engine_output):
+        g2c.release(texture)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Measures what skipping the ControlNet and --controlnet-resolution-scale buy
+# for a controlnet pipeline: FPS per setting and PSNR of the output against
+# the full resolution ControlNet. Any other flag is passed on to config.py.
+#
+#   python -m benchmarks.bench_controlnet --pipeline controlnet --scales 1.0,0.75,0.5
+import argparse
+import math
+import sys
+import time
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ControlNet elision")
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--scales", type=str, default="1.0,0.75,0.5")
+    args, remaining = parser.parse_known_args()
+    # config.py parses sys.argv when it is imported
+    sys.argv = sys.argv[:1] + remaining
+    return args
+
+
+def test_image(width, height, device, dtype):
+    # checkerboard plus a radial gradient, enough structure for edge detection
+    y = torch.linspace(-1, 1, height, device=device).view(-1, 1)
+    x = torch.linspace(-1, 1, width, device=device).view(1, -1)
+    checker = ((x * 8).floor() + (y * 8).floor()) % 2
+    radial = 1 - torch.sqrt(x**2 + y**2).clamp(max=1)
+    image = torch.stack((checker, radial, checker * radial))
+    return image.to(dtype)
+
+
+def controlnet_of(pipeline):
+    pipe = getattr(pipeline, "pipe", None) or next(iter(pipeline.pipes.values()))
+    return pipe.controlnet
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def run(pipeline, params, frames):
+    output = pipeline.predict(params)
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(frames):
+        pipeline.predict(params)
+    synchronize()
+    return frames / (time.perf_counter() - start), output
+
+
+def psnr(output, reference):
+    if output is None or reference is None:
+        return float("nan")
+    mse = torch.mean((output.float() - reference.float()) ** 2).item()
+    return float("inf") if mse == 0 else 10 * math.log10(1 / mse)
+
+
+def main():
+    args = parse_args()
+
+    from types import SimpleNamespace
+    from config import config
+    from device import device, torch_dtype
+    from util import get_pipeline_class
+
+    pipeline = get_pipeline_class(config.pipeline)(config, device, torch_dtype)
+    controlnet = controlnet_of(pipeline)
+    if not hasattr(controlnet, "resolution_scale"):
+        print("ControlNet is compiled or not patched, nothing to compare")
+        return
+
+    params = SimpleNamespace(**pipeline.InputParams().dict())
+    params.image = test_image(params.width, params.height, device, torch_dtype)
+
+    controlnet.resolution_scale = 1.0
+    full_fps, reference = run(pipeline, params, args.frames)
+    print(f"{'full':>12}: {full_fps:6.2f} fps")
+
+    for scale in (float(scale) for scale in args.scales.split(",")):
+        if scale >= 1:
+            continue
+        controlnet.resolution_scale = scale
+        fps, output = run(pipeline, params, args.frames)
+        print(f"{f'scale {scale}':>12}: {fps:6.2f} fps, {psnr(output, reference):6.2f} dB PSNR")
+    controlnet.resolution_scale = 1.0
+
+    controlnet_scale = params.controlnet_scale
+    params.controlnet_scale = 0.0
+    fps, output = run(pipeline, params, args.frames)
+    params.controlnet_scale = controlnet_scale
+    print(f"{'skipped':>12}: {fps:6.2f} fps, {psnr(output, reference):6.2f} dB PSNR")
+
+
+if __name__ == "__main__":
+    main()
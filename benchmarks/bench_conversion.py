@@ -0,0 +1,75 @@
+# Compares the per-frame RGBA8 <-> CHW conversion of the old TextureTransfer
+# loop with FrameConverter: time per frame and CUDA allocations per frame.
+#
+#   python -m benchmarks.bench_conversion --width 1280 --height 720
+import argparse
+import time
+import torch
+
+from frame_converter import FrameConverter
+
+
+def legacy_round_trip(input_tensor, output_tensor):
+    without_alpha = input_tensor[..., :3]
+    image = without_alpha.permute(2, 0, 1).contiguous().mul(1 / 255).cuda()
+    generated_tensor = image.permute(1, 2, 0).contiguous().mul(255).cuda()
+    output_tensor[..., :3] = generated_tensor
+
+
+def converter_round_trip(converter, input_tensor, output_tensor):
+    image = converter.to_image(input_tensor)
+    converter.to_rgba(image, output_tensor)
+
+
+def allocations():
+    if not torch.cuda.is_available():
+        return 0
+    return torch.cuda.memory_stats().get("allocation.all.allocated", 0)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def bench(name, fn, frames):
+    for _ in range(10):
+        fn()
+    synchronize()
+    allocated = allocations()
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    synchronize()
+    elapsed = time.perf_counter() - start
+    per_frame = (allocations() - allocated) / frames
+    print(f"{name:>10}: {elapsed / frames * 1000:.3f} ms/frame, {per_frame:.1f} allocations/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark frame conversion")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--dtype", type=str, default="float16")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = getattr(torch, args.dtype)
+    input_tensor = torch.randint(
+        0, 255, (args.height, args.width, 4), dtype=torch.uint8, device=device
+    )
+    output_tensor = torch.full_like(input_tensor, 255)
+    converter = FrameConverter(device, dtype)
+
+    if device.type == "cuda":
+        bench("legacy", lambda: legacy_round_trip(input_tensor, output_tensor), args.frames)
+    bench(
+        "converter",
+        lambda: converter_round_trip(converter, input_tensor, output_tensor),
+        args.frames,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,23 @@ class Args(NamedTuple):
     onediff: bool = False
     compel: bool = False
     debug: bool = False
+    max_batch_size: int = 4
+    batch_timeout: float = 0.005
+    similar_image_filter: bool = False
+    similar_image_filter_threshold: float = 0.98
+    similar_image_filter_max_skip_frame: int = 10
+    overlap_stages: bool = False
+    stage_buffers: int = 3
+    target_fps: float = 60.0
+    texture_pool_budget: int = 1024
+    prompt_cache_size: int = 64
+    prompt_cache_dir: str = None
+    resolution_buckets: str = None
+    warmup_profile: str = None
+    controlnet_resolution_scale: float = 1.0
+    max_resident_models: int = 2
+    direct_texture_io: bool = False
+    output_ring_size: int = 1
 
     def pretty_print(self):
         print("\n")
@@ -32,6 +49,9 @@ TIMEOUT = float(os.environ.get("TIMEOUT", 0))
 SAFETY_CHECKER = os.environ.get("SAFETY_CHECKER", None) == "True"
 TORCH_COMPILE = os.environ.get("TORCH_COMPILE", None) == "True"
 USE_TAESD = os.environ.get("USE_TAESD", "True") == "True"
+TARGET_FPS = float(os.environ.get("TARGET_FPS", 60))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 4))
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", 0.005))
 default_host = os.getenv("HOST", "0.0.0.0")
 default_port = int(os.getenv("PORT", "7860"))
 
@@ -117,6 +137,125 @@ parser.add_argument(
     default=False,
     help="Enable OneDiff",
 )
+parser.add_argument(
+    "--max-batch-size",
+    dest="max_batch_size",
+    type=int,
+    default=MAX_BATCH_SIZE,
+    help="Max number of sessions batched into one inference call",
+)
+parser.add_argument(
+    "--batch-timeout",
+    dest="batch_timeout",
+    type=float,
+    default=BATCH_TIMEOUT,
+    help="Seconds to wait for other sessions to join a batch",
+)
+parser.add_argument(
+    "--similar-image-filter",
+    dest="similar_image_filter",
+    action="store_true",
+    default=False,
+    help="Skip inference on input frames similar to the last processed one",
+)
+parser.add_argument(
+    "--similar-image-filter-threshold",
+    dest="similar_image_filter_threshold",
+    type=float,
+    default=0.98,
+    help="Cosine similarity above which frames may be skipped",
+)
+parser.add_argument(
+    "--similar-image-filter-max-skip-frame",
+    dest="similar_image_filter_max_skip_frame",
+    type=int,
+    default=10,
+    help="Max number of consecutive skipped frames",
+)
+parser.add_argument(
+    "--overlap-stages",
+    dest="overlap_stages",
+    action="store_true",
+    default=False,
+    help="Overlap capture, inference and write-back on separate CUDA streams",
+)
+parser.add_argument(
+    "--stage-buffers",
+    dest="stage_buffers",
+    type=int,
+    default=3,
+    help="Number of frames in flight with --overlap-stages (2 or 3)",
+)
+parser.add_argument(
+    "--target-fps",
+    dest="target_fps",
+    type=float,
+    default=TARGET_FPS,
+    help="Default frame rate cap per session, 0 to disable pacing",
+)
+parser.add_argument(
+    "--texture-pool-budget",
+    dest="texture_pool_budget",
+    type=int,
+    default=1024,
+    help="VRAM budget in MB for pooled session textures and tensors, 0 for unlimited",
+)
+parser.add_argument(
+    "--prompt-cache-size",
+    dest="prompt_cache_size",
+    type=int,
+    default=64,
+    help="Number of encoded prompts kept in memory",
+)
+parser.add_argument(
+    "--prompt-cache-dir",
+    dest="prompt_cache_dir",
+    type=str,
+    default=None,
+    help="Directory to persist encoded prompts across restarts",
+)
+parser.add_argument(
+    "--resolution-buckets",
+    dest="resolution_buckets",
+    type=str,
+    default=None,
+    help="Comma separated WIDTHxHEIGHT sizes the pipeline runs at, e.g. 512x512,768x768",
+)
+parser.add_argument(
+    "--warmup-profile",
+    dest="warmup_profile",
+    type=str,
+    default=None,
+    help="JSON file with the resolutions, steps, batch sizes and controlnet settings to warm up at startup",
+)
+parser.add_argument(
+    "--controlnet-resolution-scale",
+    dest="controlnet_resolution_scale",
+    type=float,
+    default=1.0,
+    help="Run the ControlNet at this fraction of the latent resolution and upsample its residuals",
+)
+parser.add_argument(
+    "--max-resident-models",
+    dest="max_resident_models",
+    type=int,
+    default=2,
+    help="Number of per base model UNets/text encoders kept on the GPU, the rest wait in pinned host memory",
+)
+parser.add_argument(
+    "--direct-texture-io",
+    dest="direct_texture_io",
+    action="store_true",
+    default=False,
+    help="Sample input textures and write output textures with CUDA kernels instead of staging copies",
+)
+parser.add_argument(
+    "--output-ring-size",
+    dest="output_ring_size",
+    type=int,
+    default=1,
+    help="Number of output textures per session that finished frames rotate through",
+)
 parser.set_defaults(taesd=USE_TAESD)
 
 config = Args(**vars(parser.parse_args()))
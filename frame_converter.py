@@ -0,0 +1,71 @@
+import torch
+
+from pipelines.utils.output import is_rgba8
+
+
+class FrameConverter:
+    def __init__(self, device: torch.device, dtype: torch.dtype):
+        self.device = device
+        self.dtype = dtype
+        self.buffers: dict[tuple, torch.Tensor] = {}
+
+    def buffer(self, name: str, shape: tuple, dtype: torch.dtype) -> torch.Tensor:
+        key = (name, tuple(shape), dtype)
+        tensor = self.buffers.get(key)
+        if tensor is None:
+            tensor = torch.empty(shape, dtype=dtype, device=self.device)
+            self.buffers[key] = tensor
+        return tensor
+
+    def clear(self):
+        self.buffers.clear()
+
+    @torch.no_grad()
+    def to_image(self, rgba: torch.Tensor, slot: int = 0) -> torch.Tensor:
+        # RGBA8 HWC -> RGB CHW in [0, 1], converted into a persistent buffer
+        height, width, _ = rgba.shape
+        image = self.buffer(f"image{slot}", (3, height, width), self.dtype)
+        image.copy_(rgba[..., :3].permute(2, 0, 1))
+        return image.mul_(1 / 255)
+
+    @torch.no_grad()
+    def resize(self, image: torch.Tensor, width: int, height: int) -> torch.Tensor:
+        # antialiased CHW resize, used to move frames in and out of a bucket
+        if is_rgba8(image):
+            if image.shape[:2] == (height, width):
+                return image
+            image = image[..., :3].permute(2, 0, 1).to(self.dtype).mul_(1 / 255)
+        if image.shape[-2:] == (height, width):
+            return image
+        return torch.nn.functional.interpolate(
+            image.unsqueeze(0),
+            size=(height, width),
+            mode="bilinear",
+            align_corners=False,
+            antialias=True,
+        ).squeeze(0)
+
+    @torch.no_grad()
+    def to_rgba(self, image: torch.Tensor, rgba: torch.Tensor, slot: int = 0) -> torch.Tensor:
+        # RGB CHW in [0, 1] -> RGB channels of an RGBA8 HWC tensor, alpha untouched
+        if is_rgba8(image):
+            return rgba.copy_(image)
+        scaled = self.buffer(f"scaled{slot}", image.shape, image.dtype)
+        torch.mul(image, 255, out=scaled).clamp_(0, 255)
+        rgba[..., :3].copy_(scaled.permute(1, 2, 0))
+        return rgba
+
+    @torch.no_grad()
+    def read_texture(self, texture, width: int, height: int, slot: int = 0, stream=None) -> torch.Tensor:
+        # samples a mapped RGBA8 texture straight into RGB CHW of width x height
+        image = self.buffer(f"texture{slot}", (3, height, width), self.dtype)
+        # raw pointers, torch has no __cuda_array_interface__ for bfloat16
+        texture.read_to(image.data_ptr(), width, height, self.dtype, stream)
+        return image
+
+    @torch.no_grad()
+    def write_texture(self, image: torch.Tensor, texture, slot: int = 0, stream=None):
+        # RGB CHW in [0, 1] -> mapped RGBA8 surface texture, alpha 255
+        if image.dtype != self.dtype or not image.is_contiguous():
+            image = self.buffer(f"write{slot}", image.shape, self.dtype).copy_(image)
+        texture.write_from(image.data_ptr(), self.dtype, stream)
@@ -0,0 +1,37 @@
+import time
+
+
+class FramePacer:
+    def __init__(self, target_fps: float = 60.0, smoothing: float = 0.2):
+        self.target_fps = target_fps
+        self.smoothing = smoothing
+        self.frame_time: float = None
+        self.frame_start: float = None
+
+    def set_target_fps(self, target_fps: float):
+        self.target_fps = target_fps
+
+    def reset(self):
+        self.frame_time = None
+        self.frame_start = None
+
+    def wait(self):
+        now = time.perf_counter()
+        if self.frame_start is None:
+            self.frame_start = now
+            return
+
+        elapsed = now - self.frame_start
+        if self.frame_time is None:
+            self.frame_time = elapsed
+        else:
+            self.frame_time += self.smoothing * (elapsed - self.frame_time)
+
+        # Only sleep for what is left of the frame budget. The EMA keeps a
+        # single fast frame from causing a long sleep, taking the max with the
+        # current frame means a slow frame is never padded further.
+        if self.target_fps and self.target_fps > 0:
+            remaining = 1 / self.target_fps - max(elapsed, self.frame_time)
+            if remaining > 0:
+                time.sleep(remaining)
+        self.frame_start = time.perf_counter()
@@ -2,11 +2,13 @@
 __version__ = "0.0.2.dev0"
 
 import sys
+from contextlib import contextmanager
 
 from gfx2cuda.gfx2cuda import *
 from gfx2cuda.backends import Texture
 from gfx2cuda.format import TextureFormat
 from gfx2cuda.exception import Gfx2CudaError
+import gfx2cuda.dll.cuda
 
 _instance = None
 
@@ -15,7 +17,7 @@ def _default_backend():
     if sys.platform == 'win32':
         return Backends.D3D11
     else:
-        return Backends.OPENGL
+        return Backends.SHM
 
 
 def _lazy_init(backend=None, **kwargs):
@@ -61,7 +63,8 @@ def texture(*args, **kwargs):
         dtype = kwargs.get('dtype', 'float')
         normalized = kwargs.get('normalized', False)
         fmt = TextureFormat.from_channels_and_dtype(dims[2], dtype, normalized)
-    tex = _instance.create_texture(dims[1], dims[0], fmt, device=device)
+    surface = kwargs.get('surface', False)
+    tex = _instance.create_texture(dims[1], dims[0], fmt, device=device, surface=surface)
     if needs_copy is not None:
         with tex:
             if hasattr(needs_copy, '__cuda_array_interface__'):
@@ -82,6 +85,34 @@ def open_ipc_texture(handle, **kwargs):
     return tex
 
 
+def release(tex, **kwargs):
+    _lazy_init(**kwargs)
+    _instance.release_texture(tex)
+
+
 def synchronize(**kwargs):
     _lazy_init(**kwargs)
-    _instance.device.synchronize()
\ No newline at end of file
+    _instance.device.synchronize()
+
+
+@contextmanager
+def map_many(textures, stream=None):
+    # Maps all textures with a single cudaGraphicsMapResources call instead of
+    # one driver round trip each, e.g. a session's input and output. Yields
+    # their data pointers in order.
+    textures = list(textures)
+    unique = list({id(tex): tex for tex in textures}.values())
+    resources = [tex._ptr for tex in unique if tex._ptr is not None]
+    # textures without a graphics resource (shared memory) map themselves
+    others = [tex for tex in unique if tex._ptr is None]
+    if resources:
+        gfx2cuda.dll.cuda.cuda_map_resources(resources, stream)
+    for tex in others:
+        tex.map(stream)
+    try:
+        yield [tex.data_ptr() for tex in textures]
+    finally:
+        for tex in others:
+            tex.unmap(stream)
+        if resources:
+            gfx2cuda.dll.cuda.cuda_unmap_resources(resources, stream)
@@ -1,14 +1,39 @@
 import enum
+import sys
+import time
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+import numpy as np
 
 import gfx2cuda
-import gfx2cuda.dll.dxgi
-import gfx2cuda.dll.d3d
 import gfx2cuda.dll.cuda
+import gfx2cuda.dll.shm
+import gfx2cuda.kernels
+if sys.platform == 'win32':
+    import gfx2cuda.dll.dxgi
+    import gfx2cuda.dll.d3d
 from gfx2cuda.format import TextureFormat
 from gfx2cuda.exception import Gfx2CudaError, Gfx2CudaUnsupoortedError
 
 
+def _cuda_ptr(obj, name):
+    if isinstance(obj, int):
+        return obj
+    if hasattr(obj, '__cuda_array_interface__'):
+        return obj.__cuda_array_interface__['data'][0]
+    raise ValueError(f"type of {name} not understood as CUDA pointer")
+
+
+# 8 bit RGBA, both are unsigned 8 bit channels to CUDA and read as [0, 1]
+DIRECT_FORMATS = (TextureFormat.RGBA8UINT, TextureFormat.RGBA8UNORM)
+
+# how long SHMTexture.copy_to waits for a frame the writer isn't changing,
+# and how long it sleeps between checks of the frame counter
+SHM_READ_TIMEOUT = 0.05
+SHM_READ_WAIT = 0.0005
+
+
 class Texture:
     def __init__(self, width, height, format, device, cpu_access=False, ptr=None):
         self.width = width
@@ -20,6 +45,10 @@ class Texture:
         self._ptr = None
         self._ipc_handle = None
         self._tex = ptr
+        self._released = False
+        self._surface = False
+        # texture/surface objects of the mapped array, keyed by kind and array
+        self._objects = {}
 
     @property
     def ipc_handle(self):
@@ -37,7 +66,7 @@ class Texture:
         pass
 
     @abstractmethod
-    def register(self):
+    def register(self, surface=False):
         pass
 
     def __str__(self):
@@ -50,40 +79,96 @@ class Texture:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.unmap()
 
-    def map(self):
-        gfx2cuda.dll.cuda.cuda_map_resource(self._ptr)
+    @contextmanager
+    def mapped(self, stream=None):
+        # like `with texture:`, but mapped in the order of `stream`
+        self.map(stream)
+        try:
+            yield self.data_ptr()
+        finally:
+            self.unmap(stream)
 
-    def unmap(self):
-        gfx2cuda.dll.cuda.cuda_unmap_resource(self._ptr)
+    # stream is None for the legacy synchronous behaviour, or a CUDA stream
+    # (torch.cuda.Stream or a cudaStream_t) to queue the work on it instead
+    def map(self, stream=None):
+        gfx2cuda.dll.cuda.cuda_map_resource(self._ptr, stream)
+
+    def unmap(self, stream=None):
+        gfx2cuda.dll.cuda.cuda_unmap_resource(self._ptr, stream)
 
     def unregister(self):
         gfx2cuda.dll.cuda.cuda_unregister_resource(self._ptr)
 
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.destroy_objects()
+        if self._ptr is not None:
+            self.unregister()
+
     def data_ptr(self):
         return gfx2cuda.dll.cuda.cuda_get_mapped_array(self._ptr)
 
-    def copy_to(self, dst):
-        if isinstance(dst, int):
-            ptr = dst
-        elif hasattr(dst, '__cuda_array_interface__'):
-            ptr = dst.__cuda_array_interface__['data'][0]
-        else:
-            raise ValueError("type of dst not understood as CUDA pointer")
+    def copy_to(self, dst, stream=None):
+        ptr = _cuda_ptr(dst, 'dst')
         wbytes = self.nbytes // self.height
-        gfx2cuda.dll.cuda.cuda_memcpy2d_atod(ptr, self.data_ptr(), wbytes, self.height)
+        gfx2cuda.dll.cuda.cuda_memcpy2d_atod(ptr, self.data_ptr(), wbytes, self.height, stream)
 
-    def copy_from(self, src):
-        if isinstance(src, int):
-            ptr = src
-        elif hasattr(src, '__cuda_array_interface__'):
-            ptr = src.__cuda_array_interface__['data'][0]
-        else:
-            raise ValueError("type of dst not understood as CUDA pointer")
+    def copy_from(self, src, stream=None):
+        ptr = _cuda_ptr(src, 'src')
         wbytes = self.nbytes // self.height
-        gfx2cuda.dll.cuda.cuda_memcpy2d_dtoa(self.data_ptr(), ptr, wbytes, self.height)
+        gfx2cuda.dll.cuda.cuda_memcpy2d_dtoa(self.data_ptr(), ptr, wbytes, self.height, stream)
+
+    # Direct access to the mapped CUDA array, without a linear staging copy.
+    # Only for 8 bit RGBA textures, surfaces need register(surface=True).
+    @property
+    def has_array(self):
+        return True
+
+    @property
+    def supports_direct_io(self):
+        return self.has_array and self.format in DIRECT_FORMATS
+
+    def _object(self, kind, create):
+        key = (kind, self.data_ptr())
+        if key not in self._objects:
+            self._objects[key] = create(key[1])
+        return self._objects[key]
+
+    def texture_object(self):
+        return self._object('texture', gfx2cuda.dll.cuda.cuda_create_texture_object)
+
+    def surface_object(self):
+        if not self._surface:
+            raise Gfx2CudaError("Texture was not registered for surface load/store")
+        return self._object('surface', gfx2cuda.dll.cuda.cuda_create_surface_object)
+
+    def destroy_objects(self):
+        for (kind, _), obj in self._objects.items():
+            if kind == 'texture':
+                gfx2cuda.dll.cuda.cuda_destroy_texture_object(obj)
+            else:
+                gfx2cuda.dll.cuda.cuda_destroy_surface_object(obj)
+        self._objects = {}
+
+    def _check_rgba8(self):
+        if self.format not in DIRECT_FORMATS:
+            raise Gfx2CudaUnsupoortedError(f"Direct access needs 8 bit RGBA, not {self.format}")
+
+    def read_to(self, dst, width, height, dtype, stream=None):
+        # samples the texture bilinearly into an RGB CHW image in [0, 1] of
+        # width x height, dtype float32, float16 or bfloat16
+        self._check_rgba8()
+        gfx2cuda.kernels.read_texture(self.texture_object(), _cuda_ptr(dst, 'dst'), width, height, dtype, stream)
+
+    def write_from(self, src, dtype, stream=None):
+        # packs an RGB CHW image of the texture's size into RGBA8, alpha 255
+        self._check_rgba8()
+        gfx2cuda.kernels.write_surface(_cuda_ptr(src, 'src'), self.surface_object(), self.width, self.height, dtype, stream)
 
     def __del__(self):
-        self.unregister()
+        self.release()
 
 
 class D3D11Texture(Texture):
@@ -105,8 +190,9 @@ class D3D11Texture(Texture):
         gfx2cuda.dll.dxgi.dxgi_resource_release(dxgi_ptr)
         return handle.value
 
-    def register(self):
-        self._ptr = gfx2cuda.dll.cuda.cuda_register_d3d_resource(self._tex)
+    def register(self, surface=False):
+        self._ptr = gfx2cuda.dll.cuda.cuda_register_d3d_resource(self._tex, surface)
+        self._surface = surface
 
 
 class OpenGLTexture(Texture):
@@ -122,13 +208,159 @@ class OpenGLTexture(Texture):
     def create_ipc_handle(self):
         raise NotImplementedError
 
-    def register(self):
+    def register(self, surface=False):
         raise NotImplementedError
 
 
+class SHMTexture(Texture):
+    # Texture in named POSIX shared memory, for render engines without D3D.
+    # The handle names the segment, whose header holds the size, format and
+    # a frame counter the writer bumps after every complete frame. With CUDA
+    # the pixels are page locked, so GPU copies are a single DMA transfer.
+    def __init__(self, width, height, format, device, cpu_access=False, ptr=None):
+        super().__init__(width, height, format, device, cpu_access, ptr)
+        self.array = None
+        self._frame = None
+        self._registered = False
+        # two host copies of the pixels, frames are validated in the spare one
+        # and the other holds the last frame read without tearing
+        self._staging = None
+        self._good = 0
+        self._good_counter = None
+        self._owner = self._tex is None
+        if self._tex is None:
+            self._ipc_handle = gfx2cuda.dll.shm.shm_new_handle()
+            self._tex = gfx2cuda.dll.shm.shm_create(
+                self._ipc_handle, width, height, self.nbytes // height, format.name
+            )
+        self.array = gfx2cuda.dll.shm.shm_pixels(
+            self._tex, width, height, format.channels, format.get_numpy_dtype()
+        )
+        self._frame = gfx2cuda.dll.shm.shm_frame_counter(self._tex)
+
+    @classmethod
+    def create_from_ptr(cls, ptr, device):
+        # ptr is the ipc handle of a segment created by another process
+        shm, width, height, pitch, format_name = gfx2cuda.dll.shm.shm_open(ptr)
+        fmt = TextureFormat[format_name]
+        if pitch != width * fmt.get_pixel_size():
+            gfx2cuda.dll.shm.shm_close(shm)
+            raise Gfx2CudaUnsupoortedError(f"Padded rows are not supported ({pitch} bytes for {width} pixels)")
+        tex = cls(width, height, fmt, device, ptr=shm)
+        tex._ipc_handle = ptr
+        return tex
+
+    def create_ipc_handle(self):
+        return self._ipc_handle
+
+    def register(self, surface=False):
+        if gfx2cuda.dll.cuda.cuda_available():
+            gfx2cuda.dll.cuda.cuda_host_register(self.data_ptr(), self.nbytes)
+            self._registered = True
+
+    def map(self, stream=None):
+        pass
+
+    def unmap(self, stream=None):
+        pass
+
+    def unregister(self):
+        if self._registered:
+            self._registered = False
+            gfx2cuda.dll.cuda.cuda_host_unregister(self.data_ptr())
+            if self._staging is not None:
+                for staging in self._staging:
+                    gfx2cuda.dll.cuda.cuda_host_unregister(staging.ctypes.data)
+        self._staging = None
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self.array is not None:
+            self.unregister()
+        # the views have to go before the mapping can be closed
+        self.array = None
+        self._frame = None
+        if self._tex is not None:
+            gfx2cuda.dll.shm.shm_close(self._tex, unlink=self._owner)
+
+    def data_ptr(self):
+        return self.array.ctypes.data
+
+    @property
+    def frame(self):
+        # number of complete frames, see gfx2cuda.dll.shm for the protocol
+        return int(self._frame[0]) // 2
+
+    @property
+    def has_array(self):
+        # plain host memory, there is no CUDA array to sample or write
+        return False
+
+    def texture_object(self):
+        raise Gfx2CudaUnsupoortedError("Shared memory textures have no CUDA array")
+
+    def surface_object(self):
+        raise Gfx2CudaUnsupoortedError("Shared memory textures have no CUDA array")
+
+    def _read_frame(self):
+        # Copies the newest complete frame into the spare staging buffer and
+        # keeps it if the counter didn't move meanwhile. While the writer is
+        # mid frame the reader sleeps, and once SHM_READ_TIMEOUT has passed
+        # the last good frame is returned instead of a torn one.
+        if self._staging is None:
+            self._staging = (np.zeros_like(self.array), np.zeros_like(self.array))
+            if self._registered:
+                for staging in self._staging:
+                    gfx2cuda.dll.cuda.cuda_host_register(staging.ctypes.data, self.nbytes)
+        deadline = time.monotonic() + SHM_READ_TIMEOUT
+        while True:
+            before = int(self._frame[0])
+            if before == self._good_counter:
+                break
+            if before % 2 == 0:
+                spare = 1 - self._good
+                np.copyto(self._staging[spare], self.array)
+                if int(self._frame[0]) == before:
+                    self._good, self._good_counter = spare, before
+                    break
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(SHM_READ_WAIT)
+        return self._staging[self._good]
+
+    def copy_to(self, dst, stream=None):
+        frame = self._read_frame()
+        if isinstance(dst, int) or hasattr(dst, '__cuda_array_interface__'):
+            ptr = dst if isinstance(dst, int) else dst.__cuda_array_interface__['data'][0]
+            gfx2cuda.dll.cuda.cuda_memcpy(ptr, frame.ctypes.data, self.nbytes, stream)
+            if stream is not None:
+                # the next read may refill this staging buffer
+                gfx2cuda.dll.cuda.cuda_stream_synchronize(stream)
+        else:
+            # host arrays and CPU tensors
+            np.copyto(np.asarray(dst), frame)
+
+    def copy_from(self, src, stream=None):
+        # odd while the pixels are being written
+        self._frame[0] += 1
+        if isinstance(src, int) or hasattr(src, '__cuda_array_interface__'):
+            ptr = src if isinstance(src, int) else src.__cuda_array_interface__['data'][0]
+            gfx2cuda.dll.cuda.cuda_memcpy(self.data_ptr(), ptr, self.nbytes, stream)
+            if stream is not None:
+                # readers take the counter as "frame complete", so wait for
+                # this stream only, never the whole device
+                gfx2cuda.dll.cuda.cuda_stream_synchronize(stream)
+        else:
+            np.copyto(self.array, np.asarray(src))
+        self._frame[0] += 1
+
+
 class Backends(enum.Enum):
     D3D11 = 0
     OPENGL = 1
+    SHM = 2
 
 
 class Device(metaclass=ABCMeta):
@@ -139,14 +371,16 @@ class Device(metaclass=ABCMeta):
         self.handle = None
         self.dev = -1
 
-    def create_texture(self, width, height, format):
+    def create_texture(self, width, height, format, surface=False):
         if self.backend == Backends.D3D11:
             tex = D3D11Texture(width, height, format, self)
         elif self.backend == Backends.OPENGL:
             tex = OpenGLTexture(width, height, format, self)
+        elif self.backend == Backends.SHM:
+            tex = SHMTexture(width, height, format, self)
         else:
             raise Gfx2CudaError("The specified backend is invalid!")
-        tex.register()
+        tex.register(surface)
         return tex
 
     @abstractmethod
@@ -175,6 +409,8 @@ class Device(metaclass=ABCMeta):
             return D3D11Device.discover_devices()
         elif backend == Backends.OPENGL:
             return OpenGLDevice.discover_devices()
+        elif backend == Backends.SHM:
+            return SHMDevice.discover_devices()
         else:
             raise Gfx2CudaError("The specified backend is invalid!")
 
@@ -225,3 +461,25 @@ class OpenGLDevice(Device):
     @classmethod
     def discover_devices(cls):
         raise NotImplementedError
+
+
+class SHMDevice(Device):
+    def __init__(self, name=None, adapter=None, backend=None):
+        super().__init__(name, adapter, backend)
+
+    def init_context(self):
+        # the textures live in host memory, CUDA device 0 does the copies
+        self.dev = 0
+
+    def synchronize(self):
+        if gfx2cuda.dll.cuda.cuda_available():
+            gfx2cuda.dll.cuda.cuda_device_synchronize()
+
+    def open_ipc_handle(self, handle):
+        tex = SHMTexture.create_from_ptr(handle, self)
+        tex.register()
+        return tex
+
+    @classmethod
+    def discover_devices(cls):
+        return [cls(name="POSIX shared memory", backend=Backends.SHM)]
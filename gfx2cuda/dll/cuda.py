@@ -1,60 +1,234 @@
 import os
+import sys
 from ctypes import *
+import ctypes.util
 import glob
 
-CUDA_PATH = os.getenv('CUDA_PATH')
-if sizeof(c_void_p) == 8:
-    _cu_re = '/bin/cudart64_*'
-else:  # == 4
-    _cu_re = '/bin/cudart32_*'
-
-cu_path = glob.glob(CUDA_PATH + _cu_re)[0]
-cu = cdll.LoadLibrary(cu_path)
+_cu = None
+_available = None
+
+
+def _load_cudart():
+    if sys.platform == 'win32':
+        CUDA_PATH = os.getenv('CUDA_PATH')
+        if sizeof(c_void_p) == 8:
+            _cu_re = '/bin/cudart64_*'
+        else:  # == 4
+            _cu_re = '/bin/cudart32_*'
+        return cdll.LoadLibrary(glob.glob(CUDA_PATH + _cu_re)[0])
+
+    # the runtime torch ships with is usually already loaded into the process
+    for name in ('libcudart.so', 'libcudart.so.12', 'libcudart.so.11.0', ctypes.util.find_library('cudart')):
+        if name is None:
+            continue
+        try:
+            return cdll.LoadLibrary(name)
+        except OSError:
+            pass
+    raise OSError("Could not find the CUDA runtime library")
+
+
+def cudart():
+    # loaded on first use, so the module imports on machines without CUDA
+    global _cu
+    if _cu is None:
+        _cu = _load_cudart()
+    return _cu
+
+
+def cuda_available():
+    global _available
+    if _available is None:
+        try:
+            count = c_int()
+            _available = cudart().cudaGetDeviceCount(byref(count)) == 0 and count.value > 0
+        except (OSError, IndexError, TypeError):
+            _available = False
+    return _available
+
+
+def cuda_stream(stream):
+    # None, a raw cudaStream_t or anything with a cuda_stream attribute
+    # (torch.cuda.Stream). 0 is the legacy default stream.
+    if stream is None:
+        return None
+    return c_void_p(getattr(stream, 'cuda_stream', stream))
 
 
 def cuda_device_d3d_adapter(adapter):
     dev = c_int()
-    ret = cu.cudaD3D11GetDevice(byref(dev), cast(adapter, c_void_p))
+    ret = cudart().cudaD3D11GetDevice(byref(dev), cast(adapter, c_void_p))
     assert ret == 0, ret
     return dev.value
 
 
-def cuda_map_resource(resource):
-    ret = cu.cudaGraphicsMapResources(1, byref(resource), 0)
+def cuda_map_resource(resource, stream=None):
+    ret = cudart().cudaGraphicsMapResources(1, byref(resource), cuda_stream(stream))
+    assert ret == 0, ret
+
+
+def cuda_unmap_resource(resource, stream=None):
+    ret = cudart().cudaGraphicsUnmapResources(1, byref(resource), cuda_stream(stream))
+    assert ret == 0, ret
+
+
+def cuda_map_resources(resources, stream=None):
+    array = (c_void_p * len(resources))(*[r.value for r in resources])
+    ret = cudart().cudaGraphicsMapResources(len(resources), array, cuda_stream(stream))
     assert ret == 0, ret
 
 
-def cuda_unmap_resource(resource):
-    ret = cu.cudaGraphicsUnmapResources(1, byref(resource), 0)
+def cuda_unmap_resources(resources, stream=None):
+    array = (c_void_p * len(resources))(*[r.value for r in resources])
+    ret = cudart().cudaGraphicsUnmapResources(len(resources), array, cuda_stream(stream))
     assert ret == 0, ret
 
 
 def cuda_unregister_resource(resource):
-    ret = cu.cudaGraphicsUnregisterResource(resource)
+    ret = cudart().cudaGraphicsUnregisterResource(resource)
+    assert ret == 0, ret
+
+
+# Without a stream the copies are synchronous on the legacy default stream.
+# With one they are queued on it and return immediately.
+def cuda_memcpy2d_atod(dst, src, width_in_bytes, height, stream=None):
+    if stream is None:
+        ret = cudart().cudaMemcpy2DFromArray(c_void_p(dst), width_in_bytes, c_void_p(src), 0, 0, width_in_bytes, height, 3)
+    else:
+        ret = cudart().cudaMemcpy2DFromArrayAsync(c_void_p(dst), width_in_bytes, c_void_p(src), 0, 0, width_in_bytes, height, 3, cuda_stream(stream))
+    assert ret == 0, ret
+
+
+def cuda_memcpy2d_dtoa(dst, src, width_in_bytes, height, stream=None):
+    if stream is None:
+        ret = cudart().cudaMemcpy2DToArray(c_void_p(dst), 0, 0, c_void_p(src), width_in_bytes, width_in_bytes, height, 3)
+    else:
+        ret = cudart().cudaMemcpy2DToArrayAsync(c_void_p(dst), 0, 0, c_void_p(src), width_in_bytes, width_in_bytes, height, 3, cuda_stream(stream))
     assert ret == 0, ret
 
 
-def cuda_memcpy2d_atod(dst, src, width_in_bytes, height):
-    ret = cu.cudaMemcpy2DFromArray(c_void_p(dst), width_in_bytes, c_void_p(src), 0, 0, width_in_bytes, height, 3)
+def cuda_memcpy(dst, src, nbytes, stream=None):
+    # cudaMemcpyDefault, the direction follows from the (unified) addresses
+    if stream is None:
+        ret = cudart().cudaMemcpy(c_void_p(dst), c_void_p(src), c_size_t(nbytes), 4)
+    else:
+        ret = cudart().cudaMemcpyAsync(c_void_p(dst), c_void_p(src), c_size_t(nbytes), 4, cuda_stream(stream))
     assert ret == 0, ret
 
 
-def cuda_memcpy2d_dtoa(dst, src, width_in_bytes, height):
-    ret = cu.cudaMemcpy2DToArray(c_void_p(dst), 0, 0, c_void_p(src), width_in_bytes, width_in_bytes, height, 3)
+def cuda_stream_synchronize(stream):
+    ret = cudart().cudaStreamSynchronize(cuda_stream(stream))
+    assert ret == 0, ret
+
+
+def cuda_host_register(ptr, nbytes):
+    ret = cudart().cudaHostRegister(c_void_p(ptr), c_size_t(nbytes), 0)
+    assert ret == 0, ret
+
+
+def cuda_host_unregister(ptr):
+    ret = cudart().cudaHostUnregister(c_void_p(ptr))
+    assert ret == 0, ret
+
+
+def cuda_device_synchronize():
+    ret = cudart().cudaDeviceSynchronize()
     assert ret == 0, ret
 
 
 def cuda_get_mapped_array(resource):
     array = c_void_p()
-    ret = cu.cudaGraphicsSubResourceGetMappedArray(byref(array), resource, 0, 0)
+    ret = cudart().cudaGraphicsSubResourceGetMappedArray(byref(array), resource, 0, 0)
     assert ret == 0, ret
     return array.value
 
 
-def cuda_register_d3d_resource(d3d_resource):
+def cuda_register_d3d_resource(d3d_resource, surface=False):
+    # surface load/store is needed to bind a surface object to the array,
+    # such resources are written by CUDA so they aren't mapped read only
     resource = c_void_p()
-    ret = cu.cudaGraphicsD3D11RegisterResource(byref(resource), cast(d3d_resource, c_void_p), 0)
+    flags = 8 if surface else 0  # cudaGraphicsRegisterFlagsSurfaceLoadStore
+    ret = cudart().cudaGraphicsD3D11RegisterResource(byref(resource), cast(d3d_resource, c_void_p), flags)
     assert ret == 0, ret
-    ret = cu.cudaGraphicsResourceSetMapFlags(resource, 1)
+    ret = cudart().cudaGraphicsResourceSetMapFlags(resource, 0 if surface else 1)
     assert ret == 0, ret
     return resource
+
+
+class _ResourceArray(Structure):
+    _fields_ = [("array", c_void_p)]
+
+
+class _ResourceUnion(Union):
+    _fields_ = [("array", _ResourceArray), ("reserved", c_byte * 56)]
+
+
+class cudaResourceDesc(Structure):
+    _fields_ = [("resType", c_int), ("res", _ResourceUnion), ("flags", c_uint)]
+
+
+class cudaTextureDesc(Structure):
+    _fields_ = [
+        ("addressMode", c_int * 3),
+        ("filterMode", c_int),
+        ("readMode", c_int),
+        ("sRGB", c_int),
+        ("borderColor", c_float * 4),
+        ("normalizedCoords", c_int),
+        ("maxAnisotropy", c_uint),
+        ("mipmapFilterMode", c_int),
+        ("mipmapLevelBias", c_float),
+        ("minMipmapLevelClamp", c_float),
+        ("maxMipmapLevelClamp", c_float),
+        ("disableTrilinearOptimization", c_int),
+        ("seamlessCubemap", c_int),
+    ]
+
+
+def _array_resource_desc(array):
+    desc = cudaResourceDesc()
+    desc.resType = 0  # cudaResourceTypeArray
+    desc.res.array.array = array
+    return desc
+
+
+def cuda_create_texture_object(array):
+    # normalized coordinates, clamped, bilinear, 8 bit channels read as [0, 1]
+    tex_desc = cudaTextureDesc()
+    tex_desc.addressMode[0] = tex_desc.addressMode[1] = 1  # cudaAddressModeClamp
+    tex_desc.filterMode = 1  # cudaFilterModeLinear
+    tex_desc.readMode = 1  # cudaReadModeNormalizedFloat
+    tex_desc.normalizedCoords = 1
+    tex = c_ulonglong()
+    ret = cudart().cudaCreateTextureObject(byref(tex), byref(_array_resource_desc(array)), byref(tex_desc), None)
+    assert ret == 0, ret
+    return tex.value
+
+
+def cuda_destroy_texture_object(tex):
+    ret = cudart().cudaDestroyTextureObject(c_ulonglong(tex))
+    assert ret == 0, ret
+
+
+def cuda_create_surface_object(array):
+    surface = c_ulonglong()
+    ret = cudart().cudaCreateSurfaceObject(byref(surface), byref(_array_resource_desc(array)))
+    assert ret == 0, ret
+    return surface.value
+
+
+def cuda_destroy_surface_object(surface):
+    ret = cudart().cudaDestroySurfaceObject(c_ulonglong(surface))
+    assert ret == 0, ret
+
+
+def cuda_compute_capability():
+    dev = c_int()
+    ret = cudart().cudaGetDevice(byref(dev))
+    assert ret == 0, ret
+    major, minor = c_int(), c_int()
+    ret = cudart().cudaDeviceGetAttribute(byref(major), 75, dev)  # cudaDevAttrComputeCapabilityMajor
+    assert ret == 0, ret
+    ret = cudart().cudaDeviceGetAttribute(byref(minor), 76, dev)  # cudaDevAttrComputeCapabilityMinor
+    assert ret == 0, ret
+    return major.value, minor.value
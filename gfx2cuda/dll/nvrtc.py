@@ -0,0 +1,114 @@
+import os
+import sys
+from ctypes import *
+import ctypes.util
+import glob
+
+# NVRTC to compile kernels at runtime and the driver API to load and launch
+# them. Both share the primary context the CUDA runtime (and torch) uses.
+_nvrtc = None
+_driver = None
+
+
+def _load(windows_patterns, linux_names):
+    if sys.platform == 'win32':
+        dirs = [os.path.join(os.getenv('CUDA_PATH', ''), 'bin'), os.getenv('SYSTEMROOT', '') + '/System32']
+        for pattern in windows_patterns:
+            for directory in dirs:
+                paths = sorted(glob.glob(os.path.join(directory, pattern)))
+                if paths:
+                    return cdll.LoadLibrary(paths[-1])
+    else:
+        for name in linux_names:
+            if name is None:
+                continue
+            try:
+                return cdll.LoadLibrary(name)
+            except OSError:
+                pass
+    raise OSError(f"Could not load any of {windows_patterns if sys.platform == 'win32' else linux_names}")
+
+
+def nvrtc():
+    global _nvrtc
+    if _nvrtc is None:
+        _nvrtc = _load(
+            ['nvrtc64_*.dll'],
+            ['libnvrtc.so', 'libnvrtc.so.12', 'libnvrtc.so.11.2', ctypes.util.find_library('nvrtc')],
+        )
+    return _nvrtc
+
+
+def driver():
+    global _driver
+    if _driver is None:
+        _driver = _load(['nvcuda.dll'], ['libcuda.so.1', 'libcuda.so', ctypes.util.find_library('cuda')])
+    return _driver
+
+
+def _program_log(program):
+    size = c_size_t()
+    nvrtc().nvrtcGetProgramLogSize(program, byref(size))
+    log = create_string_buffer(size.value)
+    nvrtc().nvrtcGetProgramLog(program, log)
+    return log.value.decode(errors='replace')
+
+
+def nvrtc_supported_arch(major, minor):
+    # newest architecture this NVRTC can target that the device runs
+    wanted = major * 10 + minor
+    count = c_int()
+    if nvrtc().nvrtcGetNumSupportedArchs(byref(count)) != 0:
+        return wanted
+    archs = (c_int * count.value)()
+    nvrtc().nvrtcGetSupportedArchs(archs)
+    supported = [arch for arch in archs if arch <= wanted]
+    return max(supported) if supported else wanted
+
+
+def nvrtc_compile_ptx(source, name, arch):
+    program = c_void_p()
+    ret = nvrtc().nvrtcCreateProgram(byref(program), source.encode(), name.encode(), 0, None, None)
+    assert ret == 0, ret
+    try:
+        options = [f'--gpu-arch=compute_{arch}'.encode(), b'--use_fast_math']
+        ret = nvrtc().nvrtcCompileProgram(program, len(options), (c_char_p * len(options))(*options))
+        assert ret == 0, _program_log(program)
+        size = c_size_t()
+        ret = nvrtc().nvrtcGetPTXSize(program, byref(size))
+        assert ret == 0, ret
+        ptx = create_string_buffer(size.value)
+        ret = nvrtc().nvrtcGetPTX(program, ptx)
+        assert ret == 0, ret
+        return ptx.raw
+    finally:
+        nvrtc().nvrtcDestroyProgram(byref(program))
+
+
+def cu_module_load(ptx):
+    module = c_void_p()
+    ret = driver().cuModuleLoadData(byref(module), c_char_p(ptx))
+    assert ret == 0, ret
+    return module
+
+
+def cu_module_function(module, name):
+    function = c_void_p()
+    ret = driver().cuModuleGetFunction(byref(function), module, name.encode())
+    assert ret == 0, ret
+    return function
+
+
+def cu_launch(function, grid, block, args, stream=None):
+    # args are ctypes values, the driver takes an array of pointers to them
+    params = (c_void_p * len(args))(*[cast(byref(arg), c_void_p) for arg in args])
+    ret = driver().cuLaunchKernel(
+        function,
+        grid[0], grid[1], 1,
+        block[0], block[1], 1,
+        0,
+        stream,
+        params,
+        None,
+    )
+    assert ret == 0, ret
@@ -0,0 +1,73 @@
+import os
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Segment layout: a 64 byte header followed by the tightly packed pixels.
+# The frame counter sits at an 8 byte aligned offset so it can be read and
+# bumped through a uint64 view without tearing. It works like a seqlock: the
+# writer bumps it to an odd value before writing the pixels and to the next
+# even value once the frame is complete, so counter // 2 frames are done.
+# Readers wait while it is odd and drop a copy during which it changed.
+#   magic, version, frame counter, width, height, row pitch, format name
+HEADER = struct.Struct("<4sIQIII16s")
+HEADER_SIZE = 64
+FRAME_OFFSET = 8
+MAGIC = b"G2CS"
+VERSION = 2
+
+# segments created by this process, the resource tracker already knows them
+_created = set()
+
+
+def shm_name(handle):
+    return f"g2c_{handle:x}"
+
+
+def shm_new_handle():
+    # 48 bits, so the handle survives a round trip through a JSON number
+    return int.from_bytes(os.urandom(6), "little")
+
+
+def shm_create(handle, width, height, pitch, format_name):
+    shm = shared_memory.SharedMemory(
+        name=shm_name(handle), create=True, size=HEADER_SIZE + pitch * height
+    )
+    HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, 0, width, height, pitch, format_name.encode("ascii"))
+    _created.add(shm.name)
+    return shm
+
+
+def shm_open(handle):
+    # the creator owns the segment, don't let this process' resource
+    # tracker unlink it on exit. A segment this process created stays
+    # registered, its owner unregisters it when unlinking.
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=shm_name(handle), track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=shm_name(handle))
+        if shm.name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+    magic, version, _, width, height, pitch, format_name = HEADER.unpack_from(shm.buf, 0)
+    if magic != MAGIC or version != VERSION:
+        shm.close()
+        raise ValueError(f"{shm_name(handle)} is not a gfx2cuda texture")
+    return shm, width, height, pitch, format_name.rstrip(b"\0").decode("ascii")
+
+
+def shm_frame_counter(shm):
+    return np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=FRAME_OFFSET)
+
+
+def shm_pixels(shm, width, height, channels, dtype):
+    # zero-copy HWC view of the pixels
+    return np.ndarray((height, width, channels), dtype=dtype, buffer=shm.buf, offset=HEADER_SIZE)
+
+
+def shm_close(shm, unlink=False):
+    shm.close()
+    if unlink:
+        _created.discard(shm.name)
+        shm.unlink()
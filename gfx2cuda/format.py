@@ -110,6 +110,14 @@ class TextureFormat(enum.Enum):
     def get_pixel_size(self):
         return self.channels * self.size
 
+    def get_numpy_dtype(self):
+        if self.size == 1:
+            return np.uint8
+        floating = "FLOAT" in self.name
+        if self.size == 2:
+            return np.float16 if floating else np.uint16
+        return np.float32 if floating else np.uint32
+
     def get_dxgi_format(self):
         if self in _dxgi_format_map:
             return _dxgi_format_map[self]
@@ -32,20 +32,25 @@ class Gfx2Cuda(metaclass=Singleton):
     def _reset_devices(self):
         self.devices = []
 
-    def create_texture(self, width, height, format, device=None):
+    def create_texture(self, width, height, format, device=None, surface=False):
         if device >= len(self.devices):
             raise Gfx2CudaError("Out of bound CUDA device")
         if self.device is not None and device is None:
-            tex = self.device.create_texture(width, height, format)
+            tex = self.device.create_texture(width, height, format, surface)
         else:
             if self.devices[device].has_cuda():
                 assert device == self.devices[device].dev
-                tex = self.devices[device].create_texture(width, height, format)
+                tex = self.devices[device].create_texture(width, height, format, surface)
             else:
                 raise Gfx2CudaError("Device has no CUDA capabilities.")
         self._ipc_handle_map[tex.ipc_handle] = tex
         return tex
 
+    def release_texture(self, tex):
+        if self._ipc_handle_map.get(tex.ipc_handle) is tex:
+            del self._ipc_handle_map[tex.ipc_handle]
+        tex.release()
+
     def lookup_ipc_handle(self, handle):
         if handle in self._ipc_handle_map:
             return self._ipc_handle_map[handle]
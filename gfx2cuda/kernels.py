@@ -0,0 +1,129 @@
+import threading
+from ctypes import c_int, c_ulonglong, c_void_p
+
+import gfx2cuda.dll.cuda
+import gfx2cuda.dll.nvrtc
+
+# Kernels working on mapped texture arrays directly, so frames don't have to
+# be copied through an RGBA8 staging tensor first:
+#   read_texture_*  samples the texture (bilinear, through the texture unit)
+#                   into an RGB CHW image in [0, 1] of any size
+#   write_surface_* packs an RGB CHW image into an RGBA8 surface, alpha 255
+# Texture and surface access is inline PTX so NVRTC needs no CUDA headers.
+SOURCE = r'''
+typedef unsigned long long u64;
+
+__device__ __forceinline__ unsigned short f32_to_f16(float v) {
+    unsigned short h;
+    asm("cvt.rn.f16.f32 %0, %1;" : "=h"(h) : "f"(v));
+    return h;
+}
+
+__device__ __forceinline__ float f16_to_f32(unsigned short h) {
+    float v;
+    asm("cvt.f32.f16 %0, %1;" : "=f"(v) : "h"(h));
+    return v;
+}
+
+__device__ __forceinline__ unsigned short f32_to_bf16(float v) {
+    unsigned int bits = __float_as_uint(v);
+    bits += 0x7fffu + ((bits >> 16) & 1u);
+    return (unsigned short)(bits >> 16);
+}
+
+__device__ __forceinline__ float bf16_to_f32(unsigned short h) {
+    return __uint_as_float(((unsigned int)h) << 16);
+}
+
+__device__ __forceinline__ float f32_to_f32(float v) { return v; }
+
+__device__ __forceinline__ unsigned short to_byte(float v) {
+    return (unsigned short)__float2int_rn(fminf(fmaxf(v, 0.0f), 1.0f) * 255.0f);
+}
+
+#define TEXTURE_KERNELS(NAME, T, TO, FROM)                                      \
+extern "C" __global__ void read_texture_##NAME(u64 tex, T* dst, int width, int height) { \
+    int x = blockIdx.x * blockDim.x + threadIdx.x;                              \
+    int y = blockIdx.y * blockDim.y + threadIdx.y;                              \
+    if (x >= width || y >= height) return;                                      \
+    float r, g, b, a;                                                           \
+    float u = (x + 0.5f) / width, v = (y + 0.5f) / height;                      \
+    asm volatile("tex.2d.v4.f32.f32 {%0, %1, %2, %3}, [%4, {%5, %6}];"          \
+                 : "=f"(r), "=f"(g), "=f"(b), "=f"(a) : "l"(tex), "f"(u), "f"(v)); \
+    int plane = width * height, i = y * width + x;                              \
+    dst[i] = TO(r);                                                             \
+    dst[plane + i] = TO(g);                                                     \
+    dst[2 * plane + i] = TO(b);                                                 \
+}                                                                               \
+extern "C" __global__ void write_surface_##NAME(const T* src, u64 surface, int width, int height) { \
+    int x = blockIdx.x * blockDim.x + threadIdx.x;                              \
+    int y = blockIdx.y * blockDim.y + threadIdx.y;                              \
+    if (x >= width || y >= height) return;                                      \
+    int plane = width * height, i = y * width + x;                              \
+    asm volatile("sust.b.2d.v4.b8.trap [%0, {%1, %2}], {%3, %4, %5, %6};"       \
+                 :: "l"(surface), "r"(x * 4), "r"(y),                           \
+                    "h"(to_byte(FROM(src[i]))),                                 \
+                    "h"(to_byte(FROM(src[plane + i]))),                         \
+                    "h"(to_byte(FROM(src[2 * plane + i]))),                     \
+                    "h"((unsigned short)255));                                  \
+}
+
+TEXTURE_KERNELS(float32, float, f32_to_f32, f32_to_f32)
+TEXTURE_KERNELS(float16, unsigned short, f32_to_f16, f16_to_f32)
+TEXTURE_KERNELS(bfloat16, unsigned short, f32_to_bf16, bf16_to_f32)
+'''
+
+DTYPES = ('float32', 'float16', 'bfloat16')
+BLOCK = (16, 16)
+
+_lock = threading.Lock()
+_module = None
+_functions = {}
+
+
+def _function(name):
+    global _module
+    with _lock:
+        if _module is None:
+            # make sure the primary context is current before the driver API
+            gfx2cuda.dll.cuda.cudart().cudaFree(None)
+            arch = gfx2cuda.dll.nvrtc.nvrtc_supported_arch(*gfx2cuda.dll.cuda.cuda_compute_capability())
+            ptx = gfx2cuda.dll.nvrtc.nvrtc_compile_ptx(SOURCE, 'gfx2cuda_kernels.cu', arch)
+            _module = gfx2cuda.dll.nvrtc.cu_module_load(ptx)
+        if name not in _functions:
+            _functions[name] = gfx2cuda.dll.nvrtc.cu_module_function(_module, name)
+        return _functions[name]
+
+
+def _grid(width, height):
+    return ((width + BLOCK[0] - 1) // BLOCK[0], (height + BLOCK[1] - 1) // BLOCK[1])
+
+
+def _check_dtype(dtype):
+    # accepts 'float16' as well as torch.float16 / np.float16
+    name = str(dtype).split('.')[-1]
+    if name not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of {DTYPES}")
+    return name
+
+
+def read_texture(texture_object, dst, width, height, dtype, stream=None):
+    dtype = _check_dtype(dtype)
+    gfx2cuda.dll.nvrtc.cu_launch(
+        _function(f'read_texture_{dtype}'),
+        _grid(width, height),
+        BLOCK,
+        [c_ulonglong(texture_object), c_void_p(dst), c_int(width), c_int(height)],
+        gfx2cuda.dll.cuda.cuda_stream(stream),
+    )
+
+
+def write_surface(src, surface_object, width, height, dtype, stream=None):
+    dtype = _check_dtype(dtype)
+    gfx2cuda.dll.nvrtc.cu_launch(
+        _function(f'write_surface_{dtype}'),
+        _grid(width, height),
+        BLOCK,
+        [c_void_p(src), c_ulonglong(surface_object), c_int(width), c_int(height)],
+        gfx2cuda.dll.cuda.cuda_stream(stream),
+    )
@@ -0,0 +1,144 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+import logging
+import threading
+import time
+
+# Params that may differ between the samples of one batched pipeline call.
+# Everything else is a pipeline-wide argument (size, steps, strength, ...)
+# and has to match for two frames to be grouped together.
+BATCH_VARYING_PARAMS = {"image", "prompt", "negative_prompt", "seed"}
+
+
+class Unbatchable:
+    # key part of a value that can't be compared, the request never shares a
+    # batch with anything else
+    def __eq__(self, other):
+        return self is other
+
+    def __hash__(self):
+        return id(self)
+
+
+def hashable(value):
+    # lists and dicts (e.g. lora weights) compare by content
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, hashable(item)) for key, item in value.items()))
+    try:
+        hash(value)
+    except TypeError:
+        return Unbatchable()
+    return value
+
+
+class InferenceRequest:
+    def __init__(self, params: SimpleNamespace, key: tuple):
+        self.params = params
+        self.key = key
+        self.future: Future = Future()
+
+
+class InferenceScheduler:
+    def __init__(self, pipeline, max_batch_size: int = 4, batch_timeout: float = 0.005):
+        self.pipeline = pipeline
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_timeout = batch_timeout
+        self.varying_params = BATCH_VARYING_PARAMS | set(
+            getattr(pipeline, "batch_varying_params", ())
+        )
+        self.pending: list[InferenceRequest] = []
+        self.sessions = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.loop, name="inference-scheduler", daemon=True
+        )
+        self.thread.start()
+
+    def register(self):
+        with self.condition:
+            self.sessions += 1
+
+    def unregister(self):
+        with self.condition:
+            self.sessions = max(0, self.sessions - 1)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def batch_key(self, params: SimpleNamespace) -> tuple:
+        key = []
+        for name, value in sorted(vars(params).items()):
+            if name in self.varying_params:
+                continue
+            key.append((name, hashable(value)))
+        return tuple(key)
+
+    def submit(self, params: SimpleNamespace) -> Future:
+        request = InferenceRequest(params, self.batch_key(params))
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        return request.future
+
+    def predict(self, params: SimpleNamespace):
+        return self.submit(params).result()
+
+    def next_batch(self) -> list[InferenceRequest]:
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait()
+            if not self.running:
+                return []
+
+            # Give the other sessions a short window to hand in their frame so
+            # they can share this pass, but never wait on sessions that are not
+            # producing frames.
+            deadline = time.perf_counter() + self.batch_timeout
+            while self.running:
+                wanted = min(self.max_batch_size, max(1, self.sessions))
+                remaining = deadline - time.perf_counter()
+                if len(self.pending) >= wanted or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            key = self.pending[0].key
+            batch = [r for r in self.pending if r.key == key][: self.max_batch_size]
+            self.pending = [r for r in self.pending if r not in batch]
+            return batch
+
+    def run_batch(self, batch: list[InferenceRequest]):
+        params_list = [request.params for request in batch]
+        if len(batch) > 1 and hasattr(self.pipeline, "predict_batch"):
+            results = self.pipeline.predict_batch(params_list)
+        else:
+            results = [self.pipeline.predict(params) for params in params_list]
+        if len(results) != len(batch):
+            # results can't be matched to sessions, loop fails every request
+            raise RuntimeError(
+                f"predict_batch returned {len(results)} results for {len(batch)} requests"
+            )
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+    def loop(self):
+        while self.running:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logging.error(f"Inference Error: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+        with self.condition:
+            for request in self.pending:
+                request.future.cancel()
+            self.pending = []
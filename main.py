@@ -12,14 +12,14 @@ import uuid
 import time
 from types import SimpleNamespace
 from texture_manager import TextureManager
+from inference_scheduler import InferenceScheduler
+from warmup import warmup, load_profile
 from util import get_pipeline_class
 from device import device, torch_dtype
 import os
 import time
 import torch
 
-THROTTLE = 1.0 / 120
-
 SIZE=512
 
 torch.backends.cuda.matmul.allow_tf32 = True
@@ -29,15 +29,34 @@ class App:
 		self.args = config
 		self.pipeline = pipeline
 		self.conn_manager = ConnectionManager()
-		async def handleUpdateCallback(user_id, handle):
+		async def handleUpdateCallback(user_id, handles):
+			# output_handle is the first ring slot, for clients without the ring
 			return await self.conn_manager.send_json(user_id, { 
 				"status": "output_handle",
-				"output_handle": handle
+				"output_handle": handles[0],
+				"output_handles": handles
+			})
+		async def frameReadyCallback(user_id, frame, slot):
+			return await self.conn_manager.send_json(user_id, {
+				"status": "frame_ready",
+				"frame": frame,
+				"slot": slot
 			})
+		self.scheduler = InferenceScheduler(
+			pipeline,
+			max_batch_size=config.max_batch_size,
+			batch_timeout=config.batch_timeout,
+		)
 		self.texture_manager = TextureManager(
 			on_handle_change=handleUpdateCallback, 
-			pipeline=pipeline
+			on_frame_ready=frameReadyCallback,
+			pipeline=pipeline,
+			scheduler=self.scheduler,
+			args=config,
+			device=device,
+			torch_dtype=torch_dtype,
 		)
+		warmup(pipeline, load_profile(config, self.texture_manager.buckets), device, torch_dtype)
 
 		@asynccontextmanager
 		async def lifespan(app: FastAPI):
@@ -91,24 +110,29 @@ class App:
 						await self.conn_manager.disconnect(user_id)
 						return
 					data = await self.conn_manager.receive_json(user_id)
-					print(data)
+					if data["status"] != "frame_released":
+						print(data)
 
 					if data["status"] == "source_info":
-						params = {}
+						# any pipeline input (prompt, steps, lora, ...) can be set per session
+						params = {
+							name: data[name]
+							for name in pipeline.InputParams.__fields__
+							if name in data
+						}
 						params = pipeline.InputParams(**params)
 						params = SimpleNamespace(**params.dict())
-						params.prompt = data["prompt"]
-						params.negative_prompt = data["negative_prompt"]
-						params.steps = data["steps"]
-						params.strength = data["strength"]
-						params.guidance_scale = data["guidance_scale"]
 						await self.texture_manager.update_info(
 							user_id, 
 							int(data["width"]), 
 							int(data["height"]), 
 							int(data["handle"]), 
-							params
+							params,
+							target_fps=float(data["target_fps"]) if "target_fps" in data else None,
 						)
+					elif data["status"] == "frame_released":
+						# the reader is done with this output ring slot
+						self.texture_manager.release_frame(user_id, int(data["slot"]))
 
 			except Exception as e:
 				logging.error(f"Websocket Error: {e}, {user_id} ")
@@ -5,7 +5,10 @@ from diffusers import (
 )
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
+from pipelines.utils.controlnet_elision import patch_controlnet
 from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.output import overlay
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -15,7 +18,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 base_model = "SimianLuo/LCM_Dreamshaper_v7"
@@ -209,29 +211,34 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-                control_image=[Image.new("RGB", (768, 768))],
-            )
         if args.compel:
             self.compel_proc = Compel(
                 tokenizer=self.pipe.tokenizer,
                 text_encoder=self.pipe.text_encoder,
                 truncate_long_prompts=False,
             )
+        patch_controlnet(self.pipe.controlnet, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            "",
+            getattr(self, "compel_proc", None),
+        )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(params.prompt)
-            prompt = None
+        embeds = self.encode_prompt(params)
 
         control_image = self.canny_torch(
-            params.image, params.canny_low_threshold, params.canny_high_threshold
+            params.image,
+            params.canny_low_threshold,
+            params.canny_high_threshold,
+            output_type="tensor",
         )
         steps = params.steps
         strength = params.strength
@@ -241,8 +248,7 @@ class Pipeline:
         results = self.pipe(
             image=params.image,
             control_image=control_image,
-            prompt_embeds=prompt_embeds,
-            prompt=prompt,
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -264,10 +270,6 @@ class Pipeline:
             return None
         result_image = results.images[0]
         if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = control_image.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
+            result_image = overlay(result_image, control_image[0])
 
         return result_image
@@ -4,9 +4,12 @@ from diffusers import (
     TCDScheduler,
     DDIMScheduler,
 )
-from compel import Compel, ReturnedEmbeddingsType
+from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
+from pipelines.utils.controlnet_elision import patch_controlnet
 from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.output import overlay
 from huggingface_hub import hf_hub_download
 
 try:
@@ -17,7 +20,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 
@@ -200,10 +202,9 @@ class Pipeline:
 
         if args.compel:
             self.pipe.compel_proc = Compel(
-                tokenizer=[self.pipe.tokenizer, self.pipe.tokenizer_2],
-                text_encoder=[self.pipe.text_encoder, self.pipe.text_encoder_2],
-                returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
-                requires_pooled=[False, True],
+                tokenizer=self.pipe.tokenizer,
+                text_encoder=self.pipe.text_encoder,
+                truncate_long_prompts=False,
             )
 
         if args.torch_compile:
@@ -213,34 +214,29 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-                control_image=[Image.new("RGB", (768, 768))],
-            )
+        patch_controlnet(self.pipe.controlnet, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            model_id,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            params.negative_prompt,
+            getattr(self.pipe, "compel_proc", None),
+        )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
 
-        prompt = params.prompt
-        negative_prompt = params.negative_prompt
-        prompt_embeds = None
-        pooled_prompt_embeds = None
-        negative_prompt_embeds = None
-        negative_pooled_prompt_embeds = None
-        if hasattr(self.pipe, "compel_proc"):
-            _prompt_embeds, pooled_prompt_embeds = self.pipe.compel_proc(
-                [params.prompt, params.negative_prompt]
-            )
-            prompt = None
-            negative_prompt = None
-            prompt_embeds = _prompt_embeds[0:1]
-            pooled_prompt_embeds = pooled_prompt_embeds[0:1]
-            negative_prompt_embeds = _prompt_embeds[1:2]
-            negative_pooled_prompt_embeds = pooled_prompt_embeds[1:2]
+        embeds = self.encode_prompt(params)
 
         control_image = self.canny_torch(
-            params.image, params.canny_low_threshold, params.canny_high_threshold
+            params.image,
+            params.canny_low_threshold,
+            params.canny_high_threshold,
+            output_type="tensor",
         )
         steps = params.steps
         strength = params.strength
@@ -250,12 +246,7 @@ class Pipeline:
         results = self.pipe(
             image=params.image,
             control_image=control_image,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            **embeds,
             generator=generator,
             strength=strength,
             eta=params.eta,
@@ -278,10 +269,6 @@ class Pipeline:
             return None
         result_image = results.images[0]
         if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = control_image.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
+            result_image = overlay(result_image, control_image[0])
 
         return result_image
@@ -3,10 +3,16 @@ from diffusers import (
     ControlNetModel,
     LCMScheduler,
     AutoencoderTiny,
+    UNet2DConditionModel,
 )
+from transformers import CLIPTextModel
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
+from pipelines.utils.controlnet_elision import patch_controlnet
 from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.model_residency import ModelResidency, same_weights
+from pipelines.utils.output import overlay
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -16,7 +22,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 taesd_model = "madebyollin/taesd"
@@ -172,95 +177,164 @@ class Pipeline:
             controlnet_model, torch_dtype=torch_dtype
         ).to(device)
 
-        self.pipes = {}
-
+        # The base models only differ in their UNet and sometimes their text
+        # encoder. One pipeline is loaded for the shared ControlNet, VAE,
+        # tokenizer and safety checker, the per model weights are kept by the
+        # residency manager and only the ones in use stay on the GPU.
+        first_model_id = next(iter(base_models))
         if args.safety_checker:
-            for base_model_id in base_models.keys():
-                pipe = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
-                    base_model_id,
-                    controlnet=controlnet_canny,
-                )
-                self.pipes[base_model_id] = pipe
+            shared = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
+                first_model_id,
+                controlnet=controlnet_canny,
+                torch_dtype=torch_dtype,
+            )
         else:
-            for base_model_id in base_models.keys():
-                pipe = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
-                    base_model_id,
-                    safety_checker=None,
-                    controlnet=controlnet_canny,
-                )
-                self.pipes[base_model_id] = pipe
+            shared = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
+                first_model_id,
+                safety_checker=None,
+                controlnet=controlnet_canny,
+                torch_dtype=torch_dtype,
+            )
+        if args.taesd:
+            shared.vae = AutoencoderTiny.from_pretrained(
+                taesd_model, torch_dtype=torch_dtype, use_safetensors=True
+            )
+        shared.vae.to(device=device, dtype=torch_dtype)
+        if shared.safety_checker is not None:
+            shared.safety_checker.to(device=device, dtype=torch_dtype)
+        if args.torch_compile:
+            shared.vae = torch.compile(
+                shared.vae, mode="reduce-overhead", fullgraph=True
+            )
 
         self.canny_torch = SobelOperator(device=device)
+        self.residency = ModelResidency(device, args.max_resident_models)
+        self.text_encoder_keys = {}
+        self.pipes = {}
+        text_encoders = {}
 
-        for pipe in self.pipes.values():
-            pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
+        for base_model_id in base_models.keys():
+            if base_model_id == first_model_id:
+                unet = shared.unet
+                text_encoder = shared.text_encoder
+            else:
+                unet = UNet2DConditionModel.from_pretrained(
+                    base_model_id, subfolder="unet", torch_dtype=torch_dtype
+                )
+                text_encoder = CLIPTextModel.from_pretrained(
+                    base_model_id, subfolder="text_encoder", torch_dtype=torch_dtype
+                )
+            text_encoder_key = next(
+                (
+                    key
+                    for key, other in text_encoders.items()
+                    if same_weights(text_encoder, other)
+                ),
+                ("text_encoder", base_model_id),
+            )
+            text_encoder = text_encoders.setdefault(text_encoder_key, text_encoder)
+            self.text_encoder_keys[base_model_id] = text_encoder_key
+
+            pipe = StableDiffusionControlNetImg2ImgPipeline(
+                vae=shared.vae,
+                text_encoder=text_encoder,
+                tokenizer=shared.tokenizer,
+                # weights stay on the host until the residency manager loads
+                # them, so startup never holds every model on the GPU at once
+                unet=unet.to(dtype=torch_dtype),
+                controlnet=controlnet_canny,
+                scheduler=LCMScheduler.from_config(shared.scheduler.config),
+                safety_checker=shared.safety_checker,
+                feature_extractor=shared.feature_extractor,
+                requires_safety_checker=False,
+            )
             pipe.set_progress_bar_config(disable=True)
             if device.type != "mps":
-                pipe.unet.to(memory_format=torch.channels_last)
-
-            if args.taesd:
-                pipe.vae = AutoencoderTiny.from_pretrained(
-                    taesd_model, torch_dtype=torch_dtype, use_safetensors=True
-                ).to(device)
+                unet.to(memory_format=torch.channels_last)
 
-            # Load LCM LoRA
+            # Fuse the LCM LoRA into this UNet once, the host copy the
+            # residency manager keeps already includes it
             pipe.load_lora_weights(lcm_lora_id, adapter_name="lcm")
-            pipe.to(device=device, dtype=torch_dtype).to(device)
+            pipe.fuse_lora()
+            pipe.unload_lora_weights()
+            self.residency.add(("unet", base_model_id), unet)
+            if text_encoder_key not in self.residency.modules:
+                self.residency.add(text_encoder_key, text_encoder)
+
             if args.compel:
-                self.compel_proc = Compel(
+                pipe.compel_proc = Compel(
                     tokenizer=pipe.tokenizer,
-                    text_encoder=pipe.text_encoder,
+                    text_encoder=text_encoder,
                     truncate_long_prompts=False,
                 )
-            if args.torch_compile:
+            self.pipes[base_model_id] = pipe
+
+        if args.torch_compile:
+            # Loading and offloading point the weights at new storage, which
+            # CUDA graphs would keep replaying with the old addresses. They
+            # are only used when every model fits and nothing is ever swapped.
+            all_resident = len(self.residency.modules) <= self.residency.max_resident
+            for pipe in self.pipes.values():
                 pipe.unet = torch.compile(
-                    pipe.unet, mode="reduce-overhead", fullgraph=True
-                )
-                pipe.vae = torch.compile(
-                    pipe.vae, mode="reduce-overhead", fullgraph=True
-                )
-                pipe(
-                    prompt="warmup",
-                    image=[Image.new("RGB", (768, 768))],
-                    control_image=[Image.new("RGB", (768, 768))],
+                    pipe.unet,
+                    mode="reduce-overhead" if all_resident else "default",
+                    fullgraph=True,
                 )
+        patch_controlnet(controlnet_canny, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        pipe = self.pipes[params.base_model_id]
+        activation_token = base_models[params.base_model_id]
+        text_encoder_key = self.text_encoder_keys[params.base_model_id]
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+        def encoder(*args):
+            # only needs the text encoder on the GPU on a cache miss
+            with self.residency.use(text_encoder_key):
+                return encode_sd(*args)
+
+        return self.prompt_cache.encode(
+            params.base_model_id,
+            encoder,
+            pipe,
+            f"{activation_token} {params.prompt}",
+            "",
+            getattr(pipe, "compel_proc", None),
+        )
+
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
         pipe = self.pipes[params.base_model_id]
 
-        activation_token = base_models[params.base_model_id]
-        prompt = f"{activation_token} {params.prompt}"
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(prompt)
-            prompt = None
+        embeds = self.encode_prompt(params)
 
         control_image = self.canny_torch(
-            params.image, params.canny_low_threshold, params.canny_high_threshold
+            params.image,
+            params.canny_low_threshold,
+            params.canny_high_threshold,
+            output_type="tensor",
         )
         steps = params.steps
         strength = params.strength
         if int(steps * strength) < 1:
             steps = math.ceil(1 / max(0.10, strength))
 
-        results = pipe(
-            image=params.image,
-            control_image=control_image,
-            prompt=prompt,
-            prompt_embeds=prompt_embeds,
-            generator=generator,
-            strength=strength,
-            num_inference_steps=steps,
-            guidance_scale=params.guidance_scale,
-            width=params.width,
-            height=params.height,
-            output_type="pt",
-            controlnet_conditioning_scale=params.controlnet_scale,
-            control_guidance_start=params.controlnet_start,
-            control_guidance_end=params.controlnet_end,
-        )
+        with self.residency.use(("unet", params.base_model_id)):
+            results = pipe(
+                image=params.image,
+                control_image=control_image,
+                **embeds,
+                generator=generator,
+                strength=strength,
+                num_inference_steps=steps,
+                guidance_scale=params.guidance_scale,
+                width=params.width,
+                height=params.height,
+                output_type="pt",
+                controlnet_conditioning_scale=params.controlnet_scale,
+                control_guidance_start=params.controlnet_start,
+                control_guidance_end=params.controlnet_end,
+            )
 
         nsfw_content_detected = (
             results.nsfw_content_detected[0]
@@ -271,10 +345,6 @@ class Pipeline:
             return None
         result_image = results.images[0]
         if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = control_image.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
+            result_image = overlay(result_image, control_image[0])
 
         return result_image
@@ -6,6 +6,10 @@ from diffusers import (
 )
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
+from pipelines.utils.controlnet_elision import patch_controlnet
+from pipelines.utils.static_control import CachedCondEmbedding
+from torchvision.transforms.functional import to_tensor
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -154,8 +158,10 @@ class Pipeline:
                 controlnet=controlnet_qrcode,
             )
 
-        self.control_image = Image.open(
-            "qr-code.png").convert("RGB").resize((512, 512))
+        self.control_image = Image.open("qr-code.png").convert("RGB")
+        self.control_tensors: dict[tuple[int, int], torch.Tensor] = {}
+        self.device = device
+        self.torch_dtype = torch_dtype
 
         self.pipe.scheduler = LCMScheduler.from_config(
             self.pipe.scheduler.config)
@@ -171,6 +177,10 @@ class Pipeline:
         # Load LCM LoRA
         self.pipe.load_lora_weights(lcm_lora_id, adapter_name="lcm")
         self.pipe.to(device=device, dtype=torch_dtype).to(device)
+        # the QR code is the control image of every frame
+        self.pipe.controlnet.controlnet_cond_embedding = CachedCondEmbedding(
+            self.pipe.controlnet.controlnet_cond_embedding
+        )
         if args.compel:
             self.compel_proc = Compel(
                 tokenizer=self.pipe.tokenizer,
@@ -184,37 +194,45 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (512, 512))],
-                control_image=[Image.new("RGB", (512, 512))],
-            )
+        patch_controlnet(self.pipe.controlnet, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            f"modern disney style {params.prompt}",
+            "",
+            getattr(self, "compel_proc", None),
+        )
+
+    def control_tensor(self, width: int, height: int) -> torch.Tensor:
+        key = (width, height)
+        if key not in self.control_tensors:
+            self.control_tensors[key] = to_tensor(
+                self.control_image.resize((width, height))
+            ).to(device=self.device, dtype=self.torch_dtype)
+        return self.control_tensors[key]
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
 
-        prompt = f"modern disney style {params.prompt}"
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(prompt)
-            prompt = None
+        embeds = self.encode_prompt(params)
 
         steps = params.steps
         strength = params.strength
         if int(steps * strength) < 1:
             steps = math.ceil(1 / max(0.10, strength))
 
-        blend_qr_image = Image.blend(
-            params.image,
-            self.control_image,
-            alpha=params.blend
+        control_image = self.control_tensor(params.width, params.height)
+        blend_qr_image = torch.lerp(
+            params.image.to(control_image.dtype), control_image, params.blend
         )
         results = self.pipe(
             image=blend_qr_image,
-            control_image=self.control_image,
-            prompt=prompt,
-            prompt_embeds=prompt_embeds,
+            control_image=control_image,
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -8,7 +8,10 @@ from diffusers import (
 )
 from compel import Compel, ReturnedEmbeddingsType
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sdxl
+from pipelines.utils.controlnet_elision import patch_controlnet
 from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.output import overlay
 from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
@@ -20,7 +23,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 controlnet_model = "diffusers/controlnet-canny-sdxl-1.0-small"
@@ -236,34 +238,29 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-                control_image=[Image.new("RGB", (768, 768))],
-            )
+        patch_controlnet(self.pipe.controlnet, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base,
+            encode_sdxl,
+            self.pipe,
+            params.prompt,
+            params.negative_prompt,
+            getattr(self.pipe, "compel_proc", None),
+        )
+
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
 
-        prompt = params.prompt
-        negative_prompt = params.negative_prompt
-        prompt_embeds = None
-        pooled_prompt_embeds = None
-        negative_prompt_embeds = None
-        negative_pooled_prompt_embeds = None
-        if hasattr(self.pipe, "compel_proc"):
-            _prompt_embeds, pooled_prompt_embeds = self.pipe.compel_proc(
-                [params.prompt, params.negative_prompt]
-            )
-            prompt = None
-            negative_prompt = None
-            prompt_embeds = _prompt_embeds[0:1]
-            pooled_prompt_embeds = pooled_prompt_embeds[0:1]
-            negative_prompt_embeds = _prompt_embeds[1:2]
-            negative_pooled_prompt_embeds = pooled_prompt_embeds[1:2]
+        embeds = self.encode_prompt(params)
 
         control_image = self.canny_torch(
-            params.image, params.canny_low_threshold, params.canny_high_threshold
+            params.image,
+            params.canny_low_threshold,
+            params.canny_high_threshold,
+            output_type="tensor",
         )
         steps = params.steps
         strength = params.strength
@@ -273,12 +270,7 @@ class Pipeline:
         results = self.pipe(
             image=params.image,
             control_image=control_image,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -300,10 +292,6 @@ class Pipeline:
             return None
         result_image = results.images[0]
         if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = control_image.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
+            result_image = overlay(result_image, control_image[0])
 
         return result_image
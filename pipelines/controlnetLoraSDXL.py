@@ -7,7 +7,12 @@ from diffusers import (
 )
 from compel import Compel, ReturnedEmbeddingsType
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sdxl, cat_prompt_embeds
+from pipelines.utils.controlnet_elision import patch_controlnet
 from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.lora_manager import FusedLoraManager
+from pipelines.utils.batched_lora import LoraAssignment, extract_branches, wrap_branches
+from pipelines.utils.output import overlay
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -17,13 +22,17 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 controlnet_model = "diffusers/controlnet-canny-sdxl-1.0"
 model_id = "stabilityai/stable-diffusion-xl-base-1.0"
 lcm_lora_id = "latent-consistency/lcm-lora-sdxl"
 taesd_model = "madebyollin/taesdxl"
+# style LoRAs a session can pick, applied on top of the LCM LoRA
+lora_models = {
+    "none": None,
+    "toy": ("CiroN2022/toy-face", "toy_face_sdxl.safetensors"),
+}
 
 
 default_prompt = "Portrait of The Terminator with , glare pose, detailed, intricate, full of colour, cinematic lighting, trending on artstation, 8k, hyperrealistic, focused, extreme details, unreal engine 5 cinematic, masterpiece"
@@ -165,6 +174,25 @@ class Pipeline:
             hide=True,
             id="debug_canny",
         )
+        lora: str = Field(
+            "toy",
+            title="LoRA",
+            values=list(lora_models.keys()),
+            field="select",
+            id="lora",
+        )
+        lora_weight: float = Field(
+            0.8,
+            min=0,
+            max=1.0,
+            step=0.001,
+            title="LoRA Weight",
+            field="range",
+            id="lora_weight",
+        )
+
+    # sessions with different LoRAs still share one batched UNet call
+    batch_varying_params = {"lora", "lora_weight"}
 
     def __init__(self, args: Args, device: torch.device, torch_dtype: torch.dtype):
         controlnet_canny = ControlNetModel.from_pretrained(
@@ -189,17 +217,30 @@ class Pipeline:
         self.canny_torch = SobelOperator(device=device)
         # Load LCM LoRA
         self.pipe.load_lora_weights(lcm_lora_id, adapter_name="lcm")
-        self.pipe.load_lora_weights(
-            "CiroN2022/toy-face",
-            weight_name="toy_face_sdxl.safetensors",
-            adapter_name="toy",
-        )
-        self.pipe.set_adapters(["lcm", "toy"], adapter_weights=[1.0, 0.8])
+        self.lora_styles = [name for name, lora in lora_models.items() if lora]
+        for name in self.lora_styles:
+            repo, weight_name = lora_models[name]
+            self.pipe.load_lora_weights(
+                repo, weight_name=weight_name, adapter_name=name
+            )
 
         self.pipe.scheduler = LCMScheduler.from_config(
             self.pipe.scheduler.config)
         self.pipe.set_progress_bar_config(disable=True)
         self.pipe.to(device=device, dtype=torch_dtype).to(device)
+        # A batch where every session uses the same style runs with that
+        # style fused into the UNet. Mixed batches fuse only the LCM LoRA and
+        # add each session's style through per-sample low rank branches.
+        # Styles only touch the UNet, so prompt embeddings are shared.
+        self.lora_assignment = LoraAssignment(
+            self.lora_styles, device, torch_dtype, args.max_batch_size
+        )
+        branches = extract_branches(self.pipe.unet, self.lora_styles)
+        self.lora_manager = FusedLoraManager(
+            self.pipe, ["lcm", *self.lora_styles], components=("unet",)
+        )
+        wrap_branches(self.pipe.unet, branches, self.lora_assignment)
+        self.lora_manager.set({"lcm": 1.0})
 
         if args.sfast:
             from sfast.compilers.diffusion_pipeline_compiler import (
@@ -211,6 +252,10 @@ class Pipeline:
             config.enable_xformers = True
             config.enable_triton = True
             config.enable_cuda_graph = True
+            # the trace keeps whichever branches ran while tracing, so the
+            # style branches always run and add 0 for unassigned rows
+            self.lora_assignment.always = True
+            self.lora_assignment.set([])
             self.pipe = compile(self.pipe, config=config)
 
         if device.type != "mps":
@@ -237,34 +282,58 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-                control_image=[Image.new("RGB", (768, 768))],
-            )
+        patch_controlnet(self.pipe.controlnet, args.controlnet_resolution_scale)
+        self.prompt_cache = get_prompt_cache(args)
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        generator = torch.manual_seed(params.seed)
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            model_id,
+            encode_sdxl,
+            self.pipe,
+            params.prompt,
+            params.negative_prompt,
+            getattr(self.pipe, "compel_proc", None),
+        )
 
-        prompt = params.prompt
-        negative_prompt = params.negative_prompt
-        prompt_embeds = None
-        pooled_prompt_embeds = None
-        negative_prompt_embeds = None
-        negative_pooled_prompt_embeds = None
-        if hasattr(self.pipe, "compel_proc"):
-            _prompt_embeds, pooled_prompt_embeds = self.pipe.compel_proc(
-                [params.prompt, params.negative_prompt]
-            )
-            prompt = None
-            negative_prompt = None
-            prompt_embeds = _prompt_embeds[0:1]
-            pooled_prompt_embeds = pooled_prompt_embeds[0:1]
-            negative_prompt_embeds = _prompt_embeds[1:2]
-            negative_pooled_prompt_embeds = pooled_prompt_embeds[1:2]
+    def set_loras(self, params_list: list):
+        samples = [
+            (p.lora, p.lora_weight) if lora_models.get(p.lora) else (None, 0.0)
+            for p in params_list
+        ]
+        if len(set(samples)) == 1:
+            lora, weight = samples[0]
+            fused = {"lcm": 1.0}
+            if lora is not None:
+                fused[lora] = weight
+            self.lora_manager.set(fused)
+            self.lora_assignment.set([])
+        else:
+            self.lora_manager.set({"lcm": 1.0})
+            self.lora_assignment.set(samples)
 
-        control_image = self.canny_torch(
-            params.image, params.canny_low_threshold, params.canny_high_threshold
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
+        return self.predict_batch([params])[0]
+
+    def predict_batch(self, params_list: list) -> list:
+        params = params_list[0]
+        batch_size = len(params_list)
+        generator = [torch.Generator().manual_seed(p.seed) for p in params_list]
+        embeds = cat_prompt_embeds(
+            [self.encode_prompt(p) for p in params_list],
+            getattr(self.pipe, "compel_proc", None),
+        )
+        self.set_loras(params_list)
+
+        control_image = torch.cat(
+            [
+                self.canny_torch(
+                    p.image,
+                    p.canny_low_threshold,
+                    p.canny_high_threshold,
+                    output_type="tensor",
+                )
+                for p in params_list
+            ]
         )
         steps = params.steps
         strength = params.strength
@@ -272,14 +341,9 @@ class Pipeline:
             steps = math.ceil(1 / max(0.10, strength))
 
         results = self.pipe(
-            image=params.image,
+            image=[p.image for p in params_list],
             control_image=control_image,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -293,18 +357,18 @@ class Pipeline:
         )
 
         nsfw_content_detected = (
-            results.nsfw_content_detected[0]
+            results.nsfw_content_detected
             if "nsfw_content_detected" in results
-            else False
+            else [False] * batch_size
         )
-        if nsfw_content_detected:
-            return None
-        result_image = results.images[0]
-        if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = control_image.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
-
-        return result_image
+        result_images = []
+        for result_image, nsfw, p, control in zip(
+            results.images, nsfw_content_detected, params_list, control_image
+        ):
+            if nsfw:
+                result_images.append(None)
+                continue
+            if p.debug_canny:
+                result_image = overlay(result_image, control)
+            result_images.append(result_image)
+        return result_images
@@ -3,6 +3,7 @@ from diffusers import (
     AutoencoderTiny,
 )
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd, cat_prompt_embeds
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -12,7 +13,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 from sfast.compilers.diffusion_pipeline_compiler import (
     compile,
@@ -148,11 +148,6 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-            )
         if args.compel:
             from compel import Compel
 
@@ -161,27 +156,37 @@ class Pipeline:
                 text_encoder=self.pipe.text_encoder,
                 truncate_long_prompts=True,
             )
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            params.negative_prompt,
+            getattr(self.pipe, "compel_proc", None),
+        )
+
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
+        return self.predict_batch([params])[0]
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        generator = torch.manual_seed(params.seed)
+    def predict_batch(self, params_list: list) -> list:
+        params = params_list[0]
+        generator = [torch.Generator().manual_seed(p.seed) for p in params_list]
         steps = params.steps
         strength = params.strength
         if int(steps * strength) < 1:
             steps = math.ceil(1 / max(0.10, strength))
 
-        prompt = params.prompt
-        prompt_embeds = None
-        if hasattr(self.pipe, "compel_proc"):
-            prompt_embeds = self.pipe.compel_proc(
-                [params.prompt, params.negative_prompt]
-            )
-            prompt = None
+        embeds = cat_prompt_embeds(
+            [self.encode_prompt(p) for p in params_list],
+            getattr(self.pipe, "compel_proc", None),
+        )
 
         results = self.pipe(
-            image=params.image,
-            prompt_embeds=prompt_embeds,
-            prompt=prompt,
-            negative_prompt=params.negative_prompt,
+            image=[p.image for p in params_list],
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -192,12 +197,11 @@ class Pipeline:
         )
 
         nsfw_content_detected = (
-            results.nsfw_content_detected[0]
+            results.nsfw_content_detected
             if "nsfw_content_detected" in results
-            else False
+            else [False] * len(params_list)
         )
-        if nsfw_content_detected:
-            return None
-        result_image = results.images[0]
-
-        return result_image
+        return [
+            None if nsfw else result_image
+            for result_image, nsfw in zip(results.images, nsfw_content_detected)
+        ]
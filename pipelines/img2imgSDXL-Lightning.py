@@ -7,6 +7,7 @@ from diffusers import (
 )
 from compel import Compel, ReturnedEmbeddingsType
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sdxl, cat_prompt_embeds
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -17,7 +18,6 @@ from safetensors.torch import load_file
 from huggingface_hub import hf_hub_download
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 base = "stabilityai/stable-diffusion-xl-base-1.0"
@@ -160,10 +160,6 @@ class Pipeline:
             self.pipe.vae = torch.compile(
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-            )
 
         if args.compel:
             self.pipe.compel_proc = Compel(
@@ -172,25 +168,29 @@ class Pipeline:
                 returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED,
                 requires_pooled=[False, True],
             )
+        self.prompt_cache = get_prompt_cache(args)
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        generator = torch.manual_seed(params.seed)
-        prompt = params.prompt
-        negative_prompt = params.negative_prompt
-        prompt_embeds = None
-        pooled_prompt_embeds = None
-        negative_prompt_embeds = None
-        negative_pooled_prompt_embeds = None
-        if hasattr(self.pipe, "compel_proc"):
-            _prompt_embeds, pooled_prompt_embeds = self.pipe.compel_proc(
-                [params.prompt, params.negative_prompt]
-            )
-            prompt = None
-            negative_prompt = None
-            prompt_embeds = _prompt_embeds[0:1]
-            pooled_prompt_embeds = pooled_prompt_embeds[0:1]
-            negative_prompt_embeds = _prompt_embeds[1:2]
-            negative_pooled_prompt_embeds = pooled_prompt_embeds[1:2]
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base,
+            encode_sdxl,
+            self.pipe,
+            params.prompt,
+            params.negative_prompt,
+            getattr(self.pipe, "compel_proc", None),
+        )
+
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
+        return self.predict_batch([params])[0]
+
+    def predict_batch(self, params_list: list) -> list:
+        params = params_list[0]
+        batch_size = len(params_list)
+        generator = [torch.Generator().manual_seed(p.seed) for p in params_list]
+        embeds = cat_prompt_embeds(
+            [self.encode_prompt(p) for p in params_list],
+            getattr(self.pipe, "compel_proc", None),
+        )
 
         steps = params.steps
         strength = params.strength
@@ -198,13 +198,8 @@ class Pipeline:
             steps = math.ceil(1 / max(0.10, strength))
 
         results = self.pipe(
-            image=params.image,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            image=[p.image for p in params_list],
+            **embeds,
             generator=generator,
             strength=strength,
             num_inference_steps=steps,
@@ -215,12 +210,11 @@ class Pipeline:
         )
 
         nsfw_content_detected = (
-            results.nsfw_content_detected[0]
+            results.nsfw_content_detected
             if "nsfw_content_detected" in results
-            else False
+            else [False] * batch_size
         )
-        if nsfw_content_detected:
-            return None
-        result_image = results.images[0]
-
-        return result_image
+        return [
+            None if nsfw else result_image
+            for result_image, nsfw in zip(results.images, nsfw_content_detected)
+        ]
@@ -1,6 +1,7 @@
 from diffusers import AutoPipelineForImage2Image, AutoencoderTiny
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd, cat_prompt_embeds
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -10,7 +11,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 import math
 
 base_model = "IDKiro/sdxs-512-0.9"
@@ -130,30 +130,38 @@ class Pipeline:
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
 
-            self.pipe(
-                prompt="warmup",
-                image=[Image.new("RGB", (768, 768))],
-            )
-
         if args.compel:
             self.compel_proc = Compel(
                 tokenizer=self.pipe.tokenizer,
                 text_encoder=self.pipe.text_encoder,
                 truncate_long_prompts=False,
             )
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            "",
+            getattr(self, "compel_proc", None),
+        )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        generator = torch.manual_seed(params.seed)
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(params.prompt)
-            prompt = None
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
+        return self.predict_batch([params])[0]
+
+    def predict_batch(self, params_list: list) -> list:
+        params = params_list[0]
+        generator = [torch.Generator().manual_seed(p.seed) for p in params_list]
+        embeds = cat_prompt_embeds(
+            [self.encode_prompt(p) for p in params_list],
+            getattr(self, "compel_proc", None),
+        )
 
         results = self.pipe(
-            image=params.image,
-            prompt=prompt,
-            prompt_embeds=prompt_embeds,
+            image=[p.image for p in params_list],
+            **embeds,
             generator=generator,
             strength=params.strength,
             num_inference_steps=params.steps,
@@ -164,12 +172,11 @@ class Pipeline:
         )
 
         nsfw_content_detected = (
-            results.nsfw_content_detected[0]
+            results.nsfw_content_detected
             if "nsfw_content_detected" in results
-            else False
+            else [False] * len(params_list)
         )
-        if nsfw_content_detected:
-            return None
-        result_image = results.images[0]
-
-        return result_image
+        return [
+            None if nsfw else result_image
+            for result_image, nsfw in zip(results.images, nsfw_content_detected)
+        ]
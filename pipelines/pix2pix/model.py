@@ -2,15 +2,19 @@
 from diffusers import DDPMScheduler
 
 
-def make_1step_sched():
+def make_1step_sched(device="cuda"):
     noise_scheduler_1step = DDPMScheduler.from_pretrained(
         "stabilityai/sd-turbo", subfolder="scheduler"
     )
-    noise_scheduler_1step.set_timesteps(1, device="cuda")
-    noise_scheduler_1step.alphas_cumprod = noise_scheduler_1step.alphas_cumprod.cuda()
+    noise_scheduler_1step.set_timesteps(1, device=device)
+    noise_scheduler_1step.alphas_cumprod = noise_scheduler_1step.alphas_cumprod.to(
+        device
+    )
     return noise_scheduler_1step
 
 
+# The skip activations and their gain are passed explicitly instead of being
+# kept on the modules, so concurrent and batched calls cannot mix them up.
 def my_vae_encoder_fwd(self, sample):
     sample = self.conv_in(sample)
     l_blocks = []
@@ -23,17 +27,16 @@ def my_vae_encoder_fwd(self, sample):
     sample = self.conv_norm_out(sample)
     sample = self.conv_act(sample)
     sample = self.conv_out(sample)
-    self.current_down_blocks = l_blocks
-    return sample
+    return sample, l_blocks
 
 
-def my_vae_decoder_fwd(self, sample, latent_embeds=None):
+def my_vae_decoder_fwd(self, sample, latent_embeds=None, skip_acts=None, gamma=1.0):
     sample = self.conv_in(sample)
     upscale_dtype = next(iter(self.up_blocks.parameters())).dtype
     # middle
     sample = self.mid_block(sample, latent_embeds)
     sample = sample.to(upscale_dtype)
-    if not self.ignore_skip:
+    if not self.ignore_skip and skip_acts is not None:
         skip_convs = [
             self.skip_conv_1,
             self.skip_conv_2,
@@ -42,7 +45,7 @@ def my_vae_decoder_fwd(self, sample, latent_embeds=None):
         ]
         # up
         for idx, up_block in enumerate(self.up_blocks):
-            skip_in = skip_convs[idx](self.incoming_skip_acts[::-1][idx] * self.gamma)
+            skip_in = skip_convs[idx](skip_acts[::-1][idx] * gamma)
             # add skip
             sample = sample + skip_in
             sample = up_block(sample, latent_embeds)
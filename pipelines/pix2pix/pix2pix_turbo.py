@@ -4,11 +4,12 @@ import requests
 import sys
 import pdb
 import copy
+import threading
 from tqdm import tqdm
 import torch
 from transformers import AutoTokenizer, PretrainedConfig, CLIPTextModel
 from diffusers import AutoencoderKL, UNet2DConditionModel, DDPMScheduler
-from diffusers.utils.peft_utils import set_weights_and_activate_adapters
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from peft import LoraConfig
 
 from pipelines.pix2pix.model import (
@@ -16,6 +17,7 @@ from pipelines.pix2pix.model import (
     my_vae_encoder_fwd,
     my_vae_decoder_fwd,
 )
+from pipelines.utils.scaled_lora import LoraScale, fuse_scaled_lora
 
 
 class TwinConv(torch.nn.Module):
@@ -23,24 +25,35 @@ class TwinConv(torch.nn.Module):
         super(TwinConv, self).__init__()
         self.conv_in_pretrained = copy.deepcopy(convin_pretrained)
         self.conv_in_curr = copy.deepcopy(convin_curr)
-        self.r = None
+        # per sample r of the running batch, the UNet forward can't pass it
+        self.lora_scale: LoraScale = None
 
     def forward(self, x):
         x1 = self.conv_in_pretrained(x).detach()
         x2 = self.conv_in_curr(x)
-        return x1 * (1 - self.r) + x2 * (self.r)
+        r = self.lora_scale.per_sample(self.lora_scale.strength, x.ndim)
+        return x1 * (1 - r) + x2 * r
 
 
 class Pix2Pix_Turbo(torch.nn.Module):
-    def __init__(self, name, ckpt_folder="checkpoints"):
+    def __init__(
+        self,
+        name,
+        ckpt_folder="checkpoints",
+        device="cuda",
+        torch_dtype=torch.float32,
+        torch_compile=False,
+        max_batch_size=4,
+    ):
         super().__init__()
+        device = torch.device(device)
         self.tokenizer = AutoTokenizer.from_pretrained(
             "stabilityai/sd-turbo", subfolder="tokenizer"
         )
         self.text_encoder = CLIPTextModel.from_pretrained(
             "stabilityai/sd-turbo", subfolder="text_encoder"
-        ).cuda()
-        self.sched = make_1step_sched()
+        ).to(device=device, dtype=torch_dtype)
+        self.sched = make_1step_sched(device)
 
         vae = AutoencoderKL.from_pretrained("stabilityai/sd-turbo", subfolder="vae")
         unet = UNet2DConditionModel.from_pretrained(
@@ -115,16 +128,16 @@ class Pix2Pix_Turbo(torch.nn.Module):
         # add the skip connection convs
         vae.decoder.skip_conv_1 = torch.nn.Conv2d(
             512, 512, kernel_size=(1, 1), stride=(1, 1), bias=False
-        ).cuda()
+        )
         vae.decoder.skip_conv_2 = torch.nn.Conv2d(
             256, 512, kernel_size=(1, 1), stride=(1, 1), bias=False
-        ).cuda()
+        )
         vae.decoder.skip_conv_3 = torch.nn.Conv2d(
             128, 512, kernel_size=(1, 1), stride=(1, 1), bias=False
-        ).cuda()
+        )
         vae.decoder.skip_conv_4 = torch.nn.Conv2d(
             128, 256, kernel_size=(1, 1), stride=(1, 1), bias=False
-        ).cuda()
+        )
         vae_lora_config = LoraConfig(
             r=sd["rank_vae"],
             init_lora_weights="gaussian",
@@ -137,77 +150,97 @@ class Pix2Pix_Turbo(torch.nn.Module):
         for k in sd["state_dict_unet"]:
             _sd_unet[k] = sd["state_dict_unet"][k]
         unet.load_state_dict(_sd_unet)
-        unet.enable_xformers_memory_efficient_attention()
+        if device.type == "cuda":
+            try:
+                unet.enable_xformers_memory_efficient_attention()
+            except Exception:
+                # falls back to torch scaled dot product attention
+                pass
         _sd_vae = vae.state_dict()
         for k in sd["state_dict_vae"]:
             _sd_vae[k] = sd["state_dict_vae"][k]
         vae.load_state_dict(_sd_vae)
-        unet.to("cuda")
-        vae.to("cuda")
+        unet.to(device=device, dtype=torch_dtype)
+        vae.to(device=device, dtype=torch_dtype)
+        if device.type != "mps":
+            unet.to(memory_format=torch.channels_last)
         unet.eval()
         vae.eval()
+        # Both LoRAs are fused at full strength, which is all deterministic
+        # mode runs. Stochastic mode scales them by r through a runtime scalar.
+        self.lora_strength = LoraScale(device, torch_dtype, max_batch_size)
+        fuse_scaled_lora(unet, "default", self.lora_strength)
+        fuse_scaled_lora(vae, "vae_skip", self.lora_strength)
+        if isinstance(unet.conv_in, TwinConv):
+            unet.conv_in.lora_scale = self.lora_strength
+        if torch_compile:
+            print("Running torch compile")
+            unet = torch.compile(unet, mode="reduce-overhead", fullgraph=True)
+            vae.encoder = torch.compile(vae.encoder, mode="reduce-overhead", fullgraph=True)
+            vae.decoder = torch.compile(vae.decoder, mode="reduce-overhead", fullgraph=True)
         self.unet, self.vae = unet, vae
-        self.vae.decoder.gamma = 1
-        self.timesteps = torch.tensor([999], device="cuda").long()
-        self.last_prompt = ""
-        self.caption_enc = None
-        self.device = "cuda"
+        self.timesteps = torch.tensor([999], device=device).long()
+        self.device = device
+        self.dtype = torch_dtype
+        # The per sample LoRA strengths live on the shared LoraScale, the only
+        # per call state left on the modules. forward is thread safe but not
+        # concurrent: calls are serialized by this lock, and sessions share a
+        # call by batching their samples instead.
+        self.lock = threading.Lock()
 
     @torch.no_grad()
-    def forward(self, c_t, prompt, deterministic=True, r=1.0, noise_map=1.0):
-        # encode the text prompt
-        if prompt != self.last_prompt:
-            caption_tokens = self.tokenizer(
-                prompt,
-                max_length=self.tokenizer.model_max_length,
-                padding="max_length",
-                truncation=True,
-                return_tensors="pt",
-            ).input_ids.cuda()
-            caption_enc = self.text_encoder(caption_tokens)[0]
-            self.caption_enc = caption_enc
-            self.last_prompt = prompt
+    def encode_prompt(self, prompt):
+        caption_tokens = self.tokenizer(
+            prompt,
+            max_length=self.tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids.to(self.device)
+        return self.text_encoder(caption_tokens)[0]
 
-        if deterministic:
-            encoded_control = (
-                self.vae.encode(c_t).latent_dist.sample()
-                * self.vae.config.scaling_factor
-            )
-            model_pred = self.unet(
-                encoded_control,
-                self.timesteps,
-                encoder_hidden_states=self.caption_enc,
-            ).sample
-            x_denoised = self.sched.step(
-                model_pred, self.timesteps, encoded_control, return_dict=True
-            ).prev_sample
-            self.vae.decoder.incoming_skip_acts = self.vae.encoder.current_down_blocks
-            output_image = (
-                self.vae.decode(x_denoised / self.vae.config.scaling_factor).sample
-            ).clamp(-1, 1)
-        else:
+    @torch.no_grad()
+    def forward(self, c_t, caption_enc, r=1.0, noise_map=None, generator=None):
+        # c_t and caption_enc are batches, r is a float or one per sample.
+        # r = 1 is the deterministic mode, below that noise_map is mixed in.
+        # Re-entrant in the sense of thread safe, concurrent callers wait on
+        # self.lock because the strengths are module state.
+        batch_size = c_t.shape[0]
+        r = [float(r)] * batch_size if isinstance(r, (int, float)) else list(r)
+        c_t = c_t.to(device=self.device, dtype=self.dtype)
+        caption_enc = caption_enc.to(dtype=self.dtype)
+        if caption_enc.shape[0] != batch_size:
+            caption_enc = caption_enc.expand(batch_size, -1, -1)
+        stochastic = any(value != 1.0 for value in r)
+
+        with self.lock:
             # scale the lora weights based on the r value
-            self.unet.set_adapters(["default"], weights=[r])
-            set_weights_and_activate_adapters(self.vae, ["vae_skip"], [r])
+            self.lora_strength.set(r)
+            ratio = self.lora_strength.strength.view(-1, 1, 1, 1)
+
+            h, skip_acts = self.vae.encoder(c_t)
+            if self.vae.quant_conv is not None:
+                h = self.vae.quant_conv(h)
             encoded_control = (
-                self.vae.encode(c_t).latent_dist.sample()
+                DiagonalGaussianDistribution(h).sample(generator)
                 * self.vae.config.scaling_factor
             )
-            # combine the input and noise
-            unet_input = encoded_control * r + noise_map * (1 - r)
-            self.unet.conv_in.r = r
-            unet_output = self.unet(
+            unet_input = encoded_control
+            if stochastic:
+                # combine the input and noise
+                unet_input = encoded_control * ratio + noise_map * (1 - ratio)
+            model_pred = self.unet(
                 unet_input,
                 self.timesteps,
-                encoder_hidden_states=self.caption_enc,
+                encoder_hidden_states=caption_enc,
             ).sample
-            self.unet.conv_in.r = None
             x_denoised = self.sched.step(
-                unet_output, self.timesteps, unet_input, return_dict=True
+                model_pred, self.timesteps, unet_input, return_dict=True
             ).prev_sample
-            self.vae.decoder.incoming_skip_acts = self.vae.encoder.current_down_blocks
-            self.vae.decoder.gamma = r
-            output_image = (
-                self.vae.decode(x_denoised / self.vae.config.scaling_factor).sample
+            z = x_denoised.to(self.dtype) / self.vae.config.scaling_factor
+            if self.vae.post_quant_conv is not None:
+                z = self.vae.post_quant_conv(z)
+            output_image = self.vae.decoder(
+                z, skip_acts=skip_acts, gamma=ratio
             ).clamp(-1, 1)
         return output_image
@@ -1,12 +1,14 @@
+from collections import OrderedDict
 import torch
-from torchvision import transforms
 
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 from pipelines.pix2pix.pix2pix_turbo import Pix2Pix_Turbo
 from pipelines.utils.canny_gpu import ScharrOperator
+from pipelines.utils.prompt_cache import get_prompt_cache, cat_prompt_embeds
+from pipelines.utils.output import overlay
 
+model_name = "pix2pix_turbo/edge_to_image"
 default_prompt = "close-up photo of the joker"
 page_content = """
 <h1 class="text-3xl font-bold">Real-Time pix2pix_turbo</h1>
@@ -98,38 +100,91 @@ class Pipeline:
             id="debug_canny",
         )
 
+    # noise_r and deterministic only change the per sample LoRA strength,
+    # noise mix and skip gain, so sessions with different values share a batch
+    batch_varying_params = {
+        "noise_r",
+        "deterministic",
+        "canny_low_threshold",
+        "canny_high_threshold",
+        "debug_canny",
+    }
+
     def __init__(self, args: Args, device: torch.device, torch_dtype: torch.dtype):
-        self.model = Pix2Pix_Turbo("edge_to_image")
+        self.model = Pix2Pix_Turbo(
+            "edge_to_image",
+            device=device,
+            torch_dtype=torch_dtype,
+            torch_compile=args.torch_compile,
+            max_batch_size=args.max_batch_size,
+        )
         self.canny_torch = ScharrOperator(device=device)
         self.device = device
+        self.torch_dtype = torch_dtype
+        # LRU of the noise of recent sessions, enough for several batches so
+        # sessions split across batches keep theirs
+        self.noise: OrderedDict[tuple, torch.Tensor] = OrderedDict()
+        self.noise_cache_size = 4 * max(1, args.max_batch_size)
+        self.prompt_cache = get_prompt_cache(args)
         self.last_time = 0.0
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        canny_pil, canny_tensor = self.canny_torch(
-            params.image,
-            params.canny_low_threshold,
-            params.canny_high_threshold,
-            output_type="pt,tensor",
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.get(
+            (model_name, str(self.model.dtype), params.prompt, None, False),
+            lambda: {"prompt_embeds": self.model.encode_prompt(params.prompt)},
+            self.device,
         )
-        torch.manual_seed(params.seed)
-        noise = torch.randn(
-            (1, 4, params.width // 8, params.height // 8), device=self.device
+
+    def get_noise(self, seed: int, width: int, height: int) -> torch.Tensor:
+        # the noise only depends on the seed and size, reuse it across frames
+        key = (seed, width, height)
+        if key in self.noise:
+            self.noise.move_to_end(key)
+            return self.noise[key]
+        generator = torch.Generator().manual_seed(seed)
+        self.noise[key] = torch.randn(
+            (1, 4, height // 8, width // 8), generator=generator
+        ).to(device=self.device, dtype=self.torch_dtype)
+        while len(self.noise) > self.noise_cache_size:
+            self.noise.popitem(last=False)
+        return self.noise[key]
+
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
+        return self.predict_batch([params])[0]
+
+    def predict_batch(self, params_list: list) -> list:
+        params = params_list[0]
+        canny_tensor = torch.cat(
+            [
+                self.canny_torch(
+                    p.image,
+                    p.canny_low_threshold,
+                    p.canny_high_threshold,
+                    output_type="tensor",
+                    channels=3,
+                )
+                for p in params_list
+            ]
         )
-        canny_tensor = torch.cat((canny_tensor, canny_tensor, canny_tensor), dim=1)
+        keys = [(p.seed, params.width, params.height) for p in params_list]
+        noise = torch.cat([self.get_noise(*key) for key in keys])
+        embeds = cat_prompt_embeds([self.encode_prompt(p) for p in params_list])
+        generator = [
+            torch.Generator(device=self.device).manual_seed(p.seed)
+            for p in params_list
+        ]
         output_image = self.model(
             canny_tensor,
-            params.prompt,
-            params.deterministic,
-            params.noise_r,
+            embeds["prompt_embeds"],
+            [1.0 if p.deterministic else p.noise_r for p in params_list],
             noise,
+            generator,
         )
-        output_pil = transforms.ToPILImage()(output_image[0].cpu() * 0.5 + 0.5)
-
-        result_image = output_pil
-        if params.debug_canny:
-            # paste control_image on top of result_image
-            w0, h0 = (200, 200)
-            control_image = canny_pil.resize((w0, h0))
-            w1, h1 = result_image.size
-            result_image.paste(control_image, (w1 - w0, h1 - h0))
-        return result_image
+        result_images = []
+        for result_image, p, control in zip(output_image, params_list, canny_tensor):
+            # the model decodes to [-1, 1]
+            result_image = (result_image * 0.5 + 0.5).clamp_(0, 1)
+            if p.debug_canny:
+                result_image = overlay(result_image, control)
+            result_images.append(result_image)
+        return result_images
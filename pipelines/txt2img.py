@@ -1,6 +1,7 @@
 from diffusers import DiffusionPipeline, AutoencoderTiny
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -9,7 +10,6 @@ except:
 
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 from typing import List
 
 base_model = "SimianLuo/LCM_Dreamshaper_v7"
@@ -115,26 +115,30 @@ class Pipeline:
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
 
-            self.pipe(prompt="warmup", num_inference_steps=1, guidance_scale=8.0)
-
         if args.compel:
             self.compel_proc = Compel(
                 tokenizer=self.pipe.tokenizer,
                 text_encoder=self.pipe.text_encoder,
                 truncate_long_prompts=False,
             )
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            None,
+            getattr(self, "compel_proc", None),
+        )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(params.prompt)
-            prompt = None
+        embeds = self.encode_prompt(params)
 
         results = self.pipe(
-            prompt_embeds=prompt_embeds,
-            prompt=prompt,
+            **embeds,
             generator=generator,
             num_inference_steps=params.steps,
             guidance_scale=params.guidance_scale,
@@ -1,6 +1,7 @@
 from diffusers import DiffusionPipeline, AutoencoderTiny, LCMScheduler
 from compel import Compel
 import torch
+from pipelines.utils.prompt_cache import get_prompt_cache, encode_sd
 
 try:
     import intel_extension_for_pytorch as ipex  # type: ignore
@@ -10,7 +11,6 @@ except:
 import psutil
 from config import Args
 from pydantic import BaseModel, Field
-from PIL import Image
 
 base_model = "wavymulder/Analog-Diffusion"
 lcm_lora_id = "latent-consistency/lcm-lora-sdv1-5"
@@ -113,8 +113,6 @@ class Pipeline:
                 self.pipe.vae, mode="reduce-overhead", fullgraph=True
             )
 
-            self.pipe(prompt="warmup", num_inference_steps=1, guidance_scale=8.0)
-
         if args.sfast:
             from sfast.compilers.diffusion_pipeline_compiler import (
                 compile,
@@ -133,18 +131,24 @@ class Pipeline:
                 text_encoder=self.pipe.text_encoder,
                 truncate_long_prompts=False,
             )
+        self.prompt_cache = get_prompt_cache(args)
+
+    def encode_prompt(self, params: "Pipeline.InputParams") -> dict:
+        return self.prompt_cache.encode(
+            base_model,
+            encode_sd,
+            self.pipe,
+            params.prompt,
+            "",
+            getattr(self, "compel_proc", None),
+        )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
+    def predict(self, params: "Pipeline.InputParams") -> torch.Tensor:
         generator = torch.manual_seed(params.seed)
-        prompt_embeds = None
-        prompt = params.prompt
-        if hasattr(self, "compel_proc"):
-            prompt_embeds = self.compel_proc(params.prompt)
-            prompt = None
+        embeds = self.encode_prompt(params)
 
         results = self.pipe(
-            prompt=prompt,
-            prompt_embeds=prompt_embeds,
+            **embeds,
             generator=generator,
             num_inference_steps=params.steps,
             guidance_scale=params.guidance_scale,
@@ -0,0 +1,120 @@
+import torch
+import torch.nn as nn
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+
+class LoraAssignment:
+    # Which LoRA (adapter, weight) each sample of the next UNet call uses.
+    # Shared by every BatchedLoraLayer of a model, set once per batch. The
+    # selection is a per row weight for every adapter, 0 where a row didn't
+    # pick it, so the layers run the same ops for any assignment and traced
+    # or CUDA graph captured UNets stay valid. The weights live in a device
+    # buffer refilled in place from pinned memory, sized for max_batch_size
+    # samples run twice for classifier free guidance.
+    def __init__(self, adapters: list[str], device: torch.device, dtype: torch.dtype, max_batch_size: int = 4):
+        self.adapters = list(adapters)
+        self.device = device
+        self.dtype = dtype
+        self.samples: list[tuple[str, float]] = []
+        # branches run even for unassigned batches, for UNets traced once
+        self.always = False
+        self.active = False
+        self.copied: torch.cuda.Event = None
+        self.allocate(2 * max(1, max_batch_size))
+
+    def allocate(self, rows: int):
+        pin = torch.device(self.device).type == "cuda"
+        shape = (len(self.adapters), rows)
+        self.host = torch.zeros(shape, dtype=self.dtype, pin_memory=pin)
+        self.weights = torch.zeros(shape, device=self.device, dtype=self.dtype)
+        self.copied = None
+
+    def set(self, samples: list[tuple[str, float]]):
+        samples = list(samples)
+        self.active = self.always or bool(samples)
+        if samples == self.samples:
+            return
+        self.samples = samples
+        if 2 * len(samples) > self.weights.shape[1]:
+            self.allocate(2 * len(samples))
+        if self.copied is not None:
+            # the previous copy may still be reading the pinned buffer
+            self.copied.synchronize()
+        self.host.zero_()
+        # classifier free guidance runs the batch as [samples, samples], so
+        # row i belongs to sample i % len(samples)
+        for row in range(self.host.shape[1] if samples else 0):
+            adapter, weight = samples[row % len(samples)]
+            if adapter in self.adapters:
+                self.host[self.adapters.index(adapter), row] = weight
+        self.weights.copy_(self.host, non_blocking=True)
+        if self.weights.is_cuda:
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+
+    def row_weights(self, adapter: str, rows: int) -> torch.Tensor:
+        return self.weights[self.adapters.index(adapter), :rows]
+
+
+class BatchedLoraLayer(nn.Module):
+    # Base layer plus one low rank branch per adapter. Each adapter's branch
+    # runs on the whole batch and is added into the base output scaled by
+    # the row weights, which are 0 for the samples that didn't select it.
+    def __init__(self, base_layer: nn.Module, assignment: LoraAssignment):
+        super().__init__()
+        self.base_layer = base_layer
+        self.assignment = assignment
+        self.lora_A = nn.ModuleDict()
+        self.lora_B = nn.ModuleDict()
+        self.scaling: dict[str, float] = {}
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self.base_layer.weight
+
+    @property
+    def bias(self) -> torch.Tensor:
+        return self.base_layer.bias
+
+    def add_adapter(self, adapter: str, lora_A: nn.Module, lora_B: nn.Module, scaling: float):
+        self.lora_A[adapter] = lora_A
+        self.lora_B[adapter] = lora_B
+        self.scaling[adapter] = scaling
+
+    def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        output = self.base_layer(x, *args, **kwargs)
+        if not self.assignment.active:
+            return output
+        for adapter in self.lora_A:
+            weights = self.assignment.row_weights(adapter, x.shape[0])
+            delta = self.lora_B[adapter](self.lora_A[adapter](x)) * self.scaling[adapter]
+            output = output + (delta * weights.view(-1, *([1] * (delta.ndim - 1)))).to(output.dtype)
+        return output
+
+
+def extract_branches(model: nn.Module, adapters: list[str]) -> dict[str, dict[str, tuple]]:
+    # module name -> adapter -> (lora_A, lora_B, scaling), taken from the peft
+    # layers before the LoRA weights are unloaded
+    branches = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, BaseTunerLayer):
+            continue
+        for adapter in adapters:
+            if adapter in module.lora_A:
+                branches.setdefault(name, {})[adapter] = (
+                    module.lora_A[adapter],
+                    module.lora_B[adapter],
+                    module.scaling[adapter],
+                )
+    return branches
+
+
+def wrap_branches(model: nn.Module, branches: dict[str, dict[str, tuple]], assignment: LoraAssignment):
+    # replace the (already unloaded) base layers with batched LoRA layers
+    for name, adapters in branches.items():
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        layer = BatchedLoraLayer(getattr(parent, child_name), assignment)
+        for adapter, (lora_A, lora_B, scaling) in adapters.items():
+            layer.add_adapter(adapter, lora_A, lora_B, scaling)
+        setattr(parent, child_name, layer)
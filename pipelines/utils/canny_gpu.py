@@ -1,117 +1,167 @@
+from abc import ABCMeta, abstractmethod
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision.transforms import ToTensor, ToPILImage
 from PIL import Image
 
+# ITU-R BT.601 luma, the same weights PIL uses for convert("L")
+GRAYSCALE_WEIGHTS = torch.tensor([0.299, 0.587, 0.114])
 
-class SobelOperator(nn.Module):
-    SOBEL_KERNEL_X = torch.tensor(
-        [[-1.0, 0.0, 1.0], [-2.0, 0.0, 2.0], [-1.0, 0.0, 1.0]]
-    )
-    SOBEL_KERNEL_Y = torch.tensor(
-        [[-1.0, -2.0, -1.0], [0.0, 0.0, 0.0], [1.0, 2.0, 1.0]]
-    )
 
-    def __init__(self, device="cuda"):
-        super(SobelOperator, self).__init__()
-        self.device = device
-        self.edge_conv_x = nn.Conv2d(1, 1, kernel_size=3, padding=1, bias=False).to(
-            self.device
-        )
-        self.edge_conv_y = nn.Conv2d(1, 1, kernel_size=3, padding=1, bias=False).to(
-            self.device
-        )
-        self.edge_conv_x.weight = nn.Parameter(
-            self.SOBEL_KERNEL_X.view((1, 1, 3, 3)).to(self.device)
-        )
-        self.edge_conv_y.weight = nn.Parameter(
-            self.SOBEL_KERNEL_Y.view((1, 1, 3, 3)).to(self.device)
-        )
+def to_batch(image: Image.Image | torch.Tensor, device) -> torch.Tensor:
+    # PIL, CHW or BCHW in [0, 1] -> float32 BCHW RGB on device
+    if isinstance(image, Image.Image):
+        image = ToTensor()(image.convert("RGB"))
+    if image.ndim == 3:
+        image = image.unsqueeze(0)
+    image = image.to(device=device, dtype=torch.float32, non_blocking=True)
+    if image.shape[1] == 4:
+        image = image[:, :3]
+    elif image.shape[1] == 1:
+        image = image.expand(-1, 3, -1, -1)
+    return image
 
-    @torch.no_grad()
-    def forward(
-        self,
-        image: Image.Image,
-        low_threshold: float,
-        high_threshold: float,
-        output_type="pt",
-    ) -> Image.Image | torch.Tensor | tuple[Image.Image, torch.Tensor]:
-        # Convert PIL image to PyTorch tensor
-        image_gray = image.convert("L")
-        image_tensor = ToTensor()(image_gray).unsqueeze(0).to(self.device)
 
-        # Compute gradients
-        edge_x = self.edge_conv_x(image_tensor)
-        edge_y = self.edge_conv_y(image_tensor)
-        edge = torch.sqrt(torch.square(edge_x) + torch.square(edge_y))
+def normalize(edge: torch.Tensor) -> torch.Tensor:
+    # per image 0-1 scaling, amax stays on the device so there is no host sync
+    return edge / edge.amax(dim=(-2, -1), keepdim=True).clamp_min(1e-6)
 
-        # Apply thresholding
-        edge.div_(edge.max())  # Normalize to 0-1 (in-place operation)
-        edge[edge >= high_threshold] = 1.0
-        edge[edge <= low_threshold] = 0.0
 
-        # Convert the result back to a PIL image
-        if output_type == "pil":
-            return ToPILImage()(edge.squeeze(0).cpu())
-        elif output_type == "tensor":
-            return edge
-        elif output_type == "pil,tensor":
-            return ToPILImage()(edge.squeeze(0).cpu()), edge
+def threshold(edge: torch.Tensor, low_threshold: float, high_threshold: float) -> torch.Tensor:
+    edge = torch.where(edge >= high_threshold, 1.0, edge)
+    return torch.where(edge <= low_threshold, 0.0, edge)
 
 
-class ScharrOperator(nn.Module):
-    SCHARR_KERNEL_X = torch.tensor(
-        [[-3.0, 0.0, 3.0], [-10.0, 0.0, 10.0], [-3.0, 0.0, 3.0]]
-    )
-    SCHARR_KERNEL_Y = torch.tensor(
-        [[-3.0, -10.0, -3.0], [0.0, 0.0, 0.0], [3.0, 10.0, 3.0]]
-    )
+class EdgeOperator(nn.Module, metaclass=ABCMeta):
+    KERNEL_X: torch.Tensor = None
+    KERNEL_Y: torch.Tensor = None
 
     def __init__(self, device="cuda"):
-        super(ScharrOperator, self).__init__()
+        super(EdgeOperator, self).__init__()
         self.device = device
-        self.edge_conv_x = nn.Conv2d(1, 1, kernel_size=3, padding=1, bias=False).to(
-            self.device
-        )
-        self.edge_conv_y = nn.Conv2d(1, 1, kernel_size=3, padding=1, bias=False).to(
-            self.device
-        )
-        self.edge_conv_x.weight = nn.Parameter(
-            self.SCHARR_KERNEL_X.view((1, 1, 3, 3)).to(self.device)
-        )
-        self.edge_conv_y.weight = nn.Parameter(
-            self.SCHARR_KERNEL_Y.view((1, 1, 3, 3)).to(self.device)
+        # grayscale conversion folded into the gradient kernels, one conv
+        # turns an RGB batch into (gx, gy)
+        kernels = torch.stack((self.KERNEL_X, self.KERNEL_Y)).view(2, 1, 3, 3)
+        self.register_buffer(
+            "weight", (kernels * GRAYSCALE_WEIGHTS.view(1, 3, 1, 1)).to(device)
         )
 
+    def gradients(self, image: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        gradients = F.conv2d(image, self.weight, padding=1)
+        return gradients[:, 0:1], gradients[:, 1:2]
+
+    @abstractmethod
+    def edges(
+        self, image: torch.Tensor, low_threshold: float, high_threshold: float
+    ) -> torch.Tensor:
+        pass
+
     @torch.no_grad()
     def forward(
         self,
-        image: Image.Image,
+        image: Image.Image | torch.Tensor,
         low_threshold: float,
         high_threshold: float,
-        output_type="pt",
+        output_type="tensor",
+        channels: int = 3,
         invert: bool = False,
     ) -> Image.Image | torch.Tensor | tuple[Image.Image, torch.Tensor]:
-        # Convert PIL image to PyTorch tensor
-        image_gray = image.convert("L")
-        image_tensor = ToTensor()(image_gray).unsqueeze(0).to(self.device)
-
-        # Compute gradients
-        edge_x = self.edge_conv_x(image_tensor)
-        edge_y = self.edge_conv_y(image_tensor)
-        edge = torch.abs(edge_x) + torch.abs(edge_y)
-
-        # Apply thresholding
-        edge.div_(edge.max())  # Normalize to 0-1 (in-place operation)
-        edge[edge >= high_threshold] = 1.0
-        edge[edge <= low_threshold] = 0.0
+        # image is a PIL image, CHW or BCHW tensor, the result is BCHW in 0-1
+        # with `channels` identical channels (3 for ControlNet inputs)
+        edge = self.edges(to_batch(image, self.device), low_threshold, high_threshold)
         if invert:
             edge = 1 - edge
+        if channels > 1:
+            edge = edge.expand(-1, channels, -1, -1)
 
-        # Convert the result back to a PIL image
+        # PIL output means a device to host copy, only meant for debugging
         if output_type == "pil":
-            return ToPILImage()(edge.squeeze(0).cpu())
-        elif output_type == "tensor":
-            return edge
+            return ToPILImage()(edge[0].cpu())
         elif output_type == "pil,tensor":
-            return ToPILImage()(edge.squeeze(0).cpu()), edge
+            return ToPILImage()(edge[0].cpu()), edge
+        elif output_type in ("tensor", "pt"):
+            return edge
+        raise ValueError(f"Unknown output_type {output_type}")
+
+
+class SobelOperator(EdgeOperator):
+    KERNEL_X = torch.tensor([[-1.0, 0.0, 1.0], [-2.0, 0.0, 2.0], [-1.0, 0.0, 1.0]])
+    KERNEL_Y = torch.tensor([[-1.0, -2.0, -1.0], [0.0, 0.0, 0.0], [1.0, 2.0, 1.0]])
+
+    def edges(self, image, low_threshold, high_threshold):
+        edge_x, edge_y = self.gradients(image)
+        edge = torch.sqrt(torch.square(edge_x) + torch.square(edge_y))
+        return threshold(normalize(edge), low_threshold, high_threshold)
+
+
+class ScharrOperator(EdgeOperator):
+    KERNEL_X = torch.tensor([[-3.0, 0.0, 3.0], [-10.0, 0.0, 10.0], [-3.0, 0.0, 3.0]])
+    KERNEL_Y = torch.tensor([[-3.0, -10.0, -3.0], [0.0, 0.0, 0.0], [3.0, 10.0, 3.0]])
+
+    def edges(self, image, low_threshold, high_threshold):
+        edge_x, edge_y = self.gradients(image)
+        edge = torch.abs(edge_x) + torch.abs(edge_y)
+        return threshold(normalize(edge), low_threshold, high_threshold)
+
+
+class CannyOperator(EdgeOperator):
+    KERNEL_X = SobelOperator.KERNEL_X
+    KERNEL_Y = SobelOperator.KERNEL_Y
+
+    def __init__(self, device="cuda", blur_sigma: float = 1.4, hysteresis_iterations: int = 16):
+        super(CannyOperator, self).__init__(device)
+        # hysteresis grows strong edges this many pixels along weak ones, a
+        # fixed count instead of a convergence check keeps it sync-free
+        self.hysteresis_iterations = hysteresis_iterations
+        x = torch.arange(5, dtype=torch.float32) - 2
+        gaussian = torch.exp(-(x**2) / (2 * blur_sigma**2))
+        gaussian = torch.outer(gaussian, gaussian)
+        self.register_buffer(
+            "blur",
+            (gaussian / gaussian.sum() * GRAYSCALE_WEIGHTS.view(3, 1, 1))
+            .view(1, 3, 5, 5)
+            .to(device),
+        )
+        self.register_buffer(
+            "sobel",
+            torch.stack((self.KERNEL_X, self.KERNEL_Y)).view(2, 1, 3, 3).to(device),
+        )
+
+    def suppress(self, edge: torch.Tensor, edge_x: torch.Tensor, edge_y: torch.Tensor) -> torch.Tensor:
+        # non-maximum suppression along the gradient quantized to 0/45/90/135
+        angle = torch.rad2deg(torch.atan2(edge_y, edge_x)) % 180
+        direction = (((angle + 22.5) // 45) % 4).long()
+
+        padded = F.pad(edge, (1, 1, 1, 1))
+        height, width = edge.shape[-2:]
+
+        def shifted(dy, dx):
+            return padded[..., 1 + dy : 1 + dy + height, 1 + dx : 1 + dx + width]
+
+        neighbours = torch.stack(
+            (
+                torch.maximum(shifted(0, -1), shifted(0, 1)),
+                torch.maximum(shifted(-1, -1), shifted(1, 1)),
+                torch.maximum(shifted(-1, 0), shifted(1, 0)),
+                torch.maximum(shifted(-1, 1), shifted(1, -1)),
+            )
+        )
+        neighbour = torch.gather(neighbours, 0, direction.unsqueeze(0)).squeeze(0)
+        return torch.where(edge >= neighbour, edge, 0.0)
+
+    def hysteresis(self, edge: torch.Tensor, low_threshold: float, high_threshold: float) -> torch.Tensor:
+        weak = (edge >= low_threshold).to(edge.dtype)
+        strong = (edge >= high_threshold).to(edge.dtype)
+        for _ in range(self.hysteresis_iterations):
+            strong = F.max_pool2d(strong, kernel_size=3, stride=1, padding=1) * weak
+        return strong
+
+    def edges(self, image, low_threshold, high_threshold):
+        gray = F.conv2d(image, self.blur, padding=2)
+        gradients = F.conv2d(gray, self.sobel, padding=1)
+        edge_x, edge_y = gradients[:, 0:1], gradients[:, 1:2]
+        edge = normalize(torch.sqrt(torch.square(edge_x) + torch.square(edge_y)))
+        edge = self.suppress(edge, edge_x, edge_y)
+        return self.hysteresis(edge, low_threshold, high_threshold)
@@ -0,0 +1,74 @@
+import torch
+import torch.nn.functional as F
+from diffusers import ControlNetModel
+
+
+def level_size(size: int, level: int) -> int:
+    # spatial size after `level` stride 2 downsamplers, which round up
+    for _ in range(level):
+        size = (size + 1) // 2
+    return size
+
+
+def upsample_residual(residual: torch.Tensor, reduced: tuple[int, int], full: tuple[int, int]) -> torch.Tensor:
+    height, width = residual.shape[-2:]
+    level = 0
+    while level_size(reduced[0], level) > height:
+        level += 1
+    size = (level_size(full[0], level), level_size(full[1], level))
+    if (height, width) == size:
+        return residual
+    return F.interpolate(residual, size=size, mode="bilinear", align_corners=False)
+
+
+def elided_controlnet_fwd(self, sample: torch.Tensor, timestep, *args, **kwargs):
+    # The pipelines pass conditioning_scale = controlnet_scale * keep, which is
+    # 0 when the scale is 0 or the step is outside [start, end]. The residuals
+    # would be multiplied by 0 anyway, so skip the ControlNet and let the UNet
+    # run without them.
+    conditioning_scale = kwargs.get("conditioning_scale", 1.0)
+    if (
+        not kwargs.get("return_dict", True)
+        and isinstance(conditioning_scale, (int, float))
+        and conditioning_scale == 0
+    ):
+        return None, None
+
+    scale = self.resolution_scale
+    if scale >= 1 or kwargs.get("return_dict", True):
+        return self.original_forward(sample, timestep, *args, **kwargs)
+
+    # Run the control branch on a smaller latent and upsample the residuals
+    # back to the sizes the UNet expects.
+    full = tuple(sample.shape[-2:])
+    reduced = tuple(max(8, round(size * scale / 8) * 8) for size in full)
+    controlnet_cond = kwargs["controlnet_cond"]
+    kwargs["controlnet_cond"] = F.interpolate(
+        controlnet_cond,
+        size=(reduced[0] * 8, reduced[1] * 8),
+        mode="bilinear",
+        align_corners=False,
+        antialias=True,
+    )
+    sample = F.interpolate(sample, size=reduced, mode="bilinear", align_corners=False)
+    down_block_res_samples, mid_block_res_sample = self.original_forward(
+        sample, timestep, *args, **kwargs
+    )
+    down_block_res_samples = [
+        upsample_residual(residual, reduced, full) for residual in down_block_res_samples
+    ]
+    mid_block_res_sample = upsample_residual(mid_block_res_sample, reduced, full)
+    return down_block_res_samples, mid_block_res_sample
+
+
+def patch_controlnet(controlnet, resolution_scale: float = 1.0):
+    # compiled wrappers (onediff) keep their own forward
+    if not isinstance(controlnet, ControlNetModel):
+        return controlnet
+    if not hasattr(controlnet, "original_forward"):
+        controlnet.original_forward = controlnet.forward
+        controlnet.forward = elided_controlnet_fwd.__get__(
+            controlnet, controlnet.__class__
+        )
+    controlnet.resolution_scale = resolution_scale
+    return controlnet
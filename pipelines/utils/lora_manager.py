@@ -0,0 +1,117 @@
+import threading
+import torch
+import torch.nn.functional as F
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+LORA_COMPONENTS = ("unet", "text_encoder", "text_encoder_2")
+
+
+def delta_weight(lora_A: torch.Tensor, lora_B: torch.Tensor, scaling: float) -> torch.Tensor:
+    # B @ A in the layout of the base weight, like peft's get_delta_weight
+    lora_A, lora_B = lora_A.float(), lora_B.float()
+    if lora_A.ndim == 2:
+        return lora_B @ lora_A * scaling
+    if lora_B.shape[2:4] == (1, 1):
+        return (lora_B.flatten(1) @ lora_A.flatten(1)).unsqueeze(2).unsqueeze(3) * scaling
+    return F.conv2d(lora_A.permute(1, 0, 2, 3), lora_B).permute(1, 0, 2, 3) * scaling
+
+
+class FusedLoraManager:
+    # Takes over the LoRA adapters loaded into a diffusers pipeline. The delta
+    # B @ A of every adapter and layer is computed once and cached in pinned
+    # host memory, next to a copy of every LoRA targeted base weight, and the
+    # LoRA layers are removed, so the UNet runs with plain weights. Selecting
+    # an adapter combination copies the cached tensors of the layers of the
+    # adapters whose weight changed to the device without blocking, rebuilds
+    # base + sum(weight * delta) in fp32 and copies it into the existing
+    # weight tensors. That keeps compiled graphs valid, never re-runs the
+    # peft fuse or B @ A on a switch, and going back to a combination
+    # restores the same weights instead of accumulating rounding error.
+    def __init__(
+        self,
+        pipe,
+        adapters: list[str],
+        components: tuple[str, ...] = LORA_COMPONENTS,
+    ):
+        self.pipe = pipe
+        self.adapters = adapters
+        self.modules: dict[tuple[str, str], torch.nn.Module] = {}
+        self.base: dict[tuple[str, str], torch.Tensor] = {}
+        self.deltas: dict[str, dict[tuple[str, str], torch.Tensor]] = {
+            adapter: {} for adapter in adapters
+        }
+        # the weights are plain base weights after unloading, every adapter at 0
+        self.weights: dict[str, float] = {adapter: 0.0 for adapter in adapters}
+        self.current: tuple = ()
+        self.lock = threading.Lock()
+
+        names = []
+        for component in components:
+            model = getattr(pipe, component, None)
+            if model is None:
+                continue
+            for name, module in model.named_modules():
+                if not isinstance(module, BaseTunerLayer):
+                    continue
+                key = (component, name)
+                names.append(key)
+                weight = module.get_base_layer().weight
+                for adapter in adapters:
+                    if adapter in module.lora_A:
+                        delta = delta_weight(
+                            module.lora_A[adapter].weight.detach(),
+                            module.lora_B[adapter].weight.detach(),
+                            module.scaling[adapter],
+                        )
+                        self.deltas[adapter][key] = host_copy(delta.to(weight.dtype))
+
+        pipe.unload_lora_weights()
+        for component, name in names:
+            model = getattr(pipe, component)
+            module = model.get_submodule(name)
+            self.modules[(component, name)] = module
+            self.base[(component, name)] = host_copy(module.weight)
+
+    @property
+    def name(self) -> str:
+        # identifies the fused weights, e.g. for the prompt embedding cache
+        if not self.current:
+            return "base"
+        return ",".join(f"{adapter}:{weight}" for adapter, weight in self.current)
+
+    @torch.no_grad()
+    def set(self, weights: dict[str, float]):
+        key = tuple(
+            sorted((adapter, float(weight)) for adapter, weight in weights.items() if weight != 0)
+        )
+        with self.lock:
+            if key == self.current:
+                return
+            new_weights = {adapter: 0.0 for adapter in self.adapters}
+            new_weights.update(key)
+            changed = set()
+            for adapter, weight in new_weights.items():
+                if weight != self.weights[adapter]:
+                    changed.update(self.deltas[adapter])
+            for module_key in changed:
+                weight_tensor = self.modules[module_key].weight
+                fused = self.base[module_key].to(
+                    device=weight_tensor.device,
+                    dtype=torch.float32,
+                    non_blocking=True,
+                    copy=True,
+                )
+                for adapter, weight in key:
+                    delta = self.deltas[adapter].get(module_key)
+                    if delta is not None:
+                        delta = delta.to(weight_tensor.device, non_blocking=True)
+                        fused.add_(delta, alpha=weight)
+                weight_tensor.copy_(fused)
+            self.weights = new_weights
+            self.current = key
+
+
+def host_copy(tensor: torch.Tensor) -> torch.Tensor:
+    # pinned when it comes from the GPU, so copying it back is asynchronous
+    copy = tensor.detach().to("cpu", copy=True)
+    return copy.pin_memory() if tensor.is_cuda else copy
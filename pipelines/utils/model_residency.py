@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+import torch
+
+
+class ResidentModule:
+    def __init__(self, module: torch.nn.Module):
+        self.module = module
+        self.users = 0
+        # One host copy of every weight, made once. Offloading just points the
+        # module back at it, loading is a non_blocking copy from pinned memory.
+        pin = torch.cuda.is_available()
+        self.spare = {}
+        for name, tensor in self.tensors():
+            spare = tensor.detach().to("cpu")
+            self.spare[name] = spare.pin_memory() if pin else spare
+
+    def tensors(self):
+        yield from self.module.named_parameters()
+        yield from self.module.named_buffers()
+
+    def load(self, device: torch.device):
+        self.module.to(device, non_blocking=True)
+
+    def offload(self):
+        for name, tensor in self.tensors():
+            tensor.data = self.spare[name]
+
+
+class ModelResidency:
+    # Keeps at most max_resident modules on the GPU, least recently used ones
+    # fall back to their host copy. Modules in use are never offloaded, so
+    # the limit can be exceeded while several models run at once.
+    def __init__(self, device: torch.device, max_resident: int = 2):
+        self.device = device
+        self.max_resident = max(1, max_resident)
+        self.modules: dict[tuple, ResidentModule] = {}
+        self.resident: OrderedDict[tuple, None] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key: tuple, module: torch.nn.Module) -> torch.nn.Module:
+        with self.lock:
+            self.modules[key] = ResidentModule(module)
+            if module_device(module).type != "cpu":
+                self.resident[key] = None
+            else:
+                self.modules[key].offload()
+            self.evict()
+        return module
+
+    def evict(self):
+        for key in list(self.resident):
+            if len(self.resident) <= self.max_resident:
+                return
+            if self.modules[key].users == 0:
+                del self.resident[key]
+                self.modules[key].offload()
+
+    @contextmanager
+    def use(self, key: tuple):
+        with self.lock:
+            entry = self.modules[key]
+            entry.users += 1
+            if key in self.resident:
+                self.resident.move_to_end(key)
+            else:
+                logging.info(f"Loading {key} to {self.device}")
+                self.resident[key] = None
+                self.evict()
+                entry.load(self.device)
+        try:
+            yield entry.module
+        finally:
+            with self.lock:
+                entry.users -= 1
+                self.evict()
+
+
+def module_device(module: torch.nn.Module) -> torch.device:
+    return next(module.parameters()).device
+
+
+def same_weights(a: torch.nn.Module, b: torch.nn.Module) -> bool:
+    a_state, b_state = a.state_dict(), b.state_dict()
+    return a_state.keys() == b_state.keys() and all(
+        torch.equal(a_state[name].cpu(), b_state[name].cpu()) for name in a_state
+    )
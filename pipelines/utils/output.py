@@ -0,0 +1,46 @@
+import torch
+import torch.nn.functional as F
+
+# Every pipeline's predict returns, on the inference device, either
+#   - an RGB CHW float tensor in [0, 1], or
+#   - an RGBA8 HWC uint8 tensor already laid out like the output texture,
+# or None when the frame was dropped (e.g. by the safety checker). Only the
+# metadata is checked, reading the values would synchronize with the GPU.
+
+
+def is_rgba8(image: torch.Tensor) -> bool:
+    return image.dtype == torch.uint8 and image.ndim == 3 and image.shape[-1] == 4
+
+
+def check_output(image, device: torch.device = None) -> torch.Tensor:
+    if image is None:
+        return None
+    if not isinstance(image, torch.Tensor):
+        raise TypeError(f"Pipeline output must be a tensor, got {type(image).__name__}")
+    if device is not None and image.device.type != torch.device(device).type:
+        raise ValueError(f"Pipeline output is on {image.device}, expected {device}")
+    if is_rgba8(image):
+        return image
+    if not image.is_floating_point() or image.ndim != 3 or image.shape[0] != 3:
+        raise ValueError(
+            f"Pipeline output must be RGB CHW float or RGBA8 HWC uint8, "
+            f"got {tuple(image.shape)} {image.dtype}"
+        )
+    return image
+
+
+@torch.no_grad()
+def overlay(image: torch.Tensor, control: torch.Tensor, size: tuple[int, int] = (200, 200)) -> torch.Tensor:
+    # paste the control map (CHW, 1 or 3 channels) into the bottom right
+    # corner of a CHW output, in place
+    height, width = image.shape[-2:]
+    w0, h0 = min(size[0], width), min(size[1], height)
+    control = F.interpolate(
+        control.unsqueeze(0).to(image.dtype),
+        size=(h0, w0),
+        mode="bilinear",
+        align_corners=False,
+        antialias=True,
+    ).squeeze(0)
+    image[:, height - h0 :, width - w0 :] = control.expand(image.shape[0], -1, -1)
+    return image
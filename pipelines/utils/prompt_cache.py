@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import torch
+
+# Embeddings only depend on the text encoder weights and the text, so one
+# cache is shared by every pipeline in the process. Keys are
+# (model, dtype, prompt, negative_prompt, compel) and values are dicts of the
+# *_prompt_embeds keyword arguments diffusers pipelines accept.
+_shared_cache = None
+
+
+class PromptEmbeddingCache:
+    def __init__(self, max_size: int = 64, cache_dir: str = None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.entries: OrderedDict[tuple, dict] = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: tuple) -> str:
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pt")
+
+    def lookup(self, key: tuple, device: torch.device = None) -> dict:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.cache_dir and os.path.exists(self.path(key)):
+            embeds = torch.load(self.path(key), map_location=device or "cpu")
+            self.store(key, embeds, persist=False)
+            return embeds
+        return None
+
+    def store(self, key: tuple, embeds: dict, persist: bool = True):
+        with self.lock:
+            self.entries[key] = embeds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if persist and self.cache_dir:
+            # written next to the final path and renamed into place, so a
+            # concurrent lookup or a crash never sees a truncated file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    torch.save({k: v.cpu() for k, v in embeds.items()}, f)
+                os.replace(tmp_path, self.path(key))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def get(self, key: tuple, encode, device: torch.device = None) -> dict:
+        embeds = self.lookup(key, device)
+        if embeds is None:
+            embeds = encode()
+            self.store(key, embeds)
+        return embeds
+
+    def encode(
+        self, model: str, encoder, pipe, prompt: str, negative_prompt: str = None, compel_proc=None
+    ) -> dict:
+        key = (model, str(pipe.dtype), prompt, negative_prompt, compel_proc is not None)
+        return self.get(
+            key,
+            lambda: encoder(pipe, prompt, negative_prompt, compel_proc),
+            pipe._execution_device,
+        )
+
+
+def get_prompt_cache(args) -> PromptEmbeddingCache:
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = PromptEmbeddingCache(
+            max_size=getattr(args, "prompt_cache_size", 64),
+            cache_dir=getattr(args, "prompt_cache_dir", None),
+        )
+    return _shared_cache
+
+
+@torch.no_grad()
+def encode_sd(pipe, prompt: str, negative_prompt: str = None, compel_proc=None) -> dict:
+    # negative_prompt=None for pipelines that take no negative embeddings (LCM)
+    if compel_proc is not None:
+        if negative_prompt is None:
+            return {"prompt_embeds": compel_proc(prompt)}
+        _prompt_embeds = compel_proc([prompt, negative_prompt])
+        return {
+            "prompt_embeds": _prompt_embeds[0:1],
+            "negative_prompt_embeds": _prompt_embeds[1:2],
+        }
+
+    prompt_embeds, negative_prompt_embeds = pipe.encode_prompt(
+        prompt,
+        pipe._execution_device,
+        1,
+        negative_prompt is not None,
+        negative_prompt,
+    )
+    if negative_prompt is None:
+        return {"prompt_embeds": prompt_embeds}
+    return {
+        "prompt_embeds": prompt_embeds,
+        "negative_prompt_embeds": negative_prompt_embeds,
+    }
+
+
+@torch.no_grad()
+def encode_sdxl(pipe, prompt: str, negative_prompt: str = None, compel_proc=None) -> dict:
+    if compel_proc is not None:
+        _prompt_embeds, pooled_prompt_embeds = compel_proc(
+            [prompt, negative_prompt or ""]
+        )
+        return {
+            "prompt_embeds": _prompt_embeds[0:1],
+            "pooled_prompt_embeds": pooled_prompt_embeds[0:1],
+            "negative_prompt_embeds": _prompt_embeds[1:2],
+            "negative_pooled_prompt_embeds": pooled_prompt_embeds[1:2],
+        }
+
+    (
+        prompt_embeds,
+        negative_prompt_embeds,
+        pooled_prompt_embeds,
+        negative_pooled_prompt_embeds,
+    ) = pipe.encode_prompt(
+        prompt=prompt,
+        device=pipe._execution_device,
+        num_images_per_prompt=1,
+        do_classifier_free_guidance=True,
+        negative_prompt=negative_prompt,
+    )
+    return {
+        "prompt_embeds": prompt_embeds,
+        "pooled_prompt_embeds": pooled_prompt_embeds,
+        "negative_prompt_embeds": negative_prompt_embeds,
+        "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+    }
+
+
+def cat_prompt_embeds(embeds_list: list[dict], compel_proc=None) -> dict:
+    if len(embeds_list) == 1:
+        return embeds_list[0]
+    embeds = {}
+    for name in embeds_list[0]:
+        tensors = [e[name] for e in embeds_list]
+        if (
+            tensors[0].ndim == 3
+            and len({t.shape[1] for t in tensors}) > 1
+            and compel_proc is not None
+        ):
+            # long compel prompts can encode to different lengths
+            tensors = compel_proc.pad_conditioning_tensors_to_same_length(tensors)
+        embeds[name] = torch.cat(tensors)
+    return embeds
@@ -0,0 +1,110 @@
+import torch
+import torch.nn as nn
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+
+class LoraScale:
+    # Per sample LoRA strengths of the next call, shared by every
+    # ScaledLoraLayer of a model. The LoRA is fused into the base weights at
+    # full strength, so a strength s only needs the branches to add
+    # (s - 1) * delta. The layers read `scale` at runtime, so changing the
+    # strengths never recompiles. `strength` and `scale` are views of device
+    # buffers sized for max_batch_size, refilled from pinned memory only when
+    # the values change, so CUDA graphs keep seeing the same addresses.
+    def __init__(self, device: torch.device, dtype: torch.dtype = torch.float32, max_batch_size: int = 4):
+        self.device = device
+        self.dtype = dtype
+        self.values = (1.0,)
+        self.active = False
+        self.copied: torch.cuda.Event = None
+        self.allocate(max(1, max_batch_size))
+
+    def allocate(self, size: int):
+        pin = torch.device(self.device).type == "cuda"
+        self.host = torch.ones(size, dtype=self.dtype, pin_memory=pin)
+        self.strength_buffer = torch.ones(size, device=self.device, dtype=self.dtype)
+        self.scale_buffer = torch.zeros(size, device=self.device, dtype=self.dtype)
+        self.copied = None
+        self.fill(self.values)
+
+    def fill(self, values: tuple):
+        count = len(values)
+        if self.copied is not None:
+            # the previous copy may still be reading the pinned buffer
+            self.copied.synchronize()
+        self.host[:count] = torch.tensor(values, dtype=self.dtype)
+        self.strength = self.strength_buffer[:count]
+        self.strength.copy_(self.host[:count], non_blocking=True)
+        self.scale = self.scale_buffer[:count]
+        torch.sub(self.strength, 1, out=self.scale)
+        if self.strength.is_cuda:
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+
+    def set(self, strengths: list[float]):
+        values = tuple(float(strength) for strength in strengths)
+        if values == self.values:
+            return
+        self.values = values
+        # strength 1 is exactly the fused weights, skip the branches
+        self.active = any(value != 1.0 for value in values)
+        if len(values) > self.strength_buffer.shape[0]:
+            self.allocate(len(values))
+        else:
+            self.fill(values)
+
+    def per_sample(self, tensor: torch.Tensor, ndim: int) -> torch.Tensor:
+        # broadcasts one value per sample over an output of ndim dimensions
+        return tensor.view(-1, *([1] * (ndim - 1)))
+
+
+class ScaledLoraLayer(nn.Module):
+    def __init__(self, base_layer: nn.Module, lora_A: nn.Module, lora_B: nn.Module, scaling: float, strength: LoraScale):
+        super().__init__()
+        self.base_layer = base_layer
+        self.lora_A = lora_A
+        self.lora_B = lora_B
+        self.scaling = scaling
+        self.strength = strength
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self.base_layer.weight
+
+    @property
+    def bias(self) -> torch.Tensor:
+        return self.base_layer.bias
+
+    def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        output = self.base_layer(x, *args, **kwargs)
+        if not self.strength.active:
+            return output
+        delta = self.lora_B(self.lora_A(x)) * self.scaling
+        return output + delta * self.strength.per_sample(self.strength.scale, delta.ndim)
+
+
+@torch.no_grad()
+def fuse_scaled_lora(model: nn.Module, adapter: str, strength: LoraScale) -> nn.Module:
+    # fold the adapter into the base weights and replace the peft layers
+    layers = [
+        (name, module)
+        for name, module in model.named_modules()
+        if isinstance(module, BaseTunerLayer) and adapter in module.lora_A
+    ]
+    for name, module in layers:
+        base_layer = module.get_base_layer()
+        base_layer.weight.add_(module.get_delta_weight(adapter).to(base_layer.weight.dtype))
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        setattr(
+            parent,
+            child_name,
+            ScaledLoraLayer(
+                base_layer,
+                module.lora_A[adapter],
+                module.lora_B[adapter],
+                module.scaling[adapter],
+                strength,
+            ),
+        )
+    return model
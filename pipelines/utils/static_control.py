@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+
+
+class CachedCondEmbedding(nn.Module):
+    # Wraps ControlNetModel.controlnet_cond_embedding for pipelines whose
+    # control image never changes. The conditioning embedding only depends on
+    # the control image, so it is computed once per input shape. The down/mid
+    # residuals themselves depend on the noisy latent and the prompt, they
+    # can not be cached across steps or frames.
+    def __init__(self, embedding: nn.Module):
+        super().__init__()
+        self.embedding = embedding
+        self.cache: dict[tuple, torch.Tensor] = {}
+
+    def clear(self):
+        self.cache.clear()
+
+    def forward(self, conditioning: torch.Tensor) -> torch.Tensor:
+        key = (tuple(conditioning.shape), conditioning.dtype, conditioning.device)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            embedding = self.embedding(conditioning)
+            self.cache[key] = embedding
+        return embedding
@@ -0,0 +1,54 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+import torch
+
+# Params that feed the text encoder. A change to any of them is encoded in
+# the background while the session keeps rendering with the old embeddings.
+PROMPT_PARAMS = {"prompt", "negative_prompt"}
+
+
+class PromptPrefetcher:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.prompt_params = PROMPT_PARAMS | set(
+            getattr(pipeline, "prompt_params", ())
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prompt-prefetch"
+        )
+        self.stream = None
+
+    def prompt_changed(self, current: SimpleNamespace, params: SimpleNamespace) -> bool:
+        return any(
+            getattr(current, name, None) != getattr(params, name, None)
+            for name in self.prompt_params
+        )
+
+    def with_prompt(self, params: SimpleNamespace, prompt_source: SimpleNamespace) -> SimpleNamespace:
+        # params with the prompt fields of prompt_source, everything else new
+        merged = SimpleNamespace(**vars(params))
+        for name in self.prompt_params:
+            if hasattr(prompt_source, name):
+                setattr(merged, name, getattr(prompt_source, name))
+        return merged
+
+    def encode(self, params: SimpleNamespace) -> dict:
+        if not torch.cuda.is_available():
+            return self.pipeline.encode_prompt(params)
+        if self.stream is None:
+            self.stream = torch.cuda.Stream()
+        # the text encoder runs next to the UNet on its own stream, the result
+        # lands in the shared prompt cache where predict picks it up
+        with torch.cuda.stream(self.stream):
+            embeds = self.pipeline.encode_prompt(params)
+        self.stream.synchronize()
+        for tensor in embeds.values():
+            # inference reads them on the default stream
+            tensor.record_stream(torch.cuda.default_stream())
+        return embeds
+
+    def submit(self, params: SimpleNamespace) -> Future:
+        return self.executor.submit(self.encode, params)
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
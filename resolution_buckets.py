@@ -0,0 +1,31 @@
+import math
+
+
+class ResolutionBuckets:
+    def __init__(self, spec: str = None):
+        # "512x512,768x768" -> [(512, 512), (768, 768)], empty disables bucketing
+        self.sizes: list[tuple[int, int]] = []
+        for size in (spec or "").split(","):
+            size = size.strip().lower()
+            if not size:
+                continue
+            width, height = (int(value) for value in size.split("x"))
+            if width % 8 or height % 8:
+                raise ValueError(f"Resolution bucket {size} is not a multiple of 8")
+            self.sizes.append((width, height))
+
+    def __bool__(self):
+        return len(self.sizes) > 0
+
+    def nearest(self, width: int, height: int) -> tuple[int, int]:
+        # closest aspect ratio first so the resize distorts as little as
+        # possible, then the closest pixel count
+        if not self.sizes:
+            return width, height
+        return min(
+            self.sizes,
+            key=lambda size: (
+                round(abs(math.log((size[0] / size[1]) / (width / height))), 3),
+                abs(size[0] * size[1] - width * height),
+            ),
+        )
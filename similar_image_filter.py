@@ -0,0 +1,83 @@
+import random
+import torch
+import torch.nn.functional as F
+
+
+class SimilarImageFilter:
+    def __init__(self, threshold: float = 0.98, max_skip_frame: int = 10, size: int = 64):
+        self.threshold = threshold
+        self.max_skip_frame = max_skip_frame
+        self.size = size
+        self.prev_tensor: torch.Tensor = None
+        self.skip_count = 0
+        # on CUDA the similarity is read back one frame late through pinned
+        # memory, so the check never waits for the GPU
+        self.host: torch.Tensor = None
+        self.pending: tuple[int, torch.cuda.Event] = None
+        self.next_buffer = 0
+        self.reset_requested = False
+
+    def reset(self):
+        # called from other threads while should_skip may be running, so the
+        # state is only cleared by the thread calling should_skip
+        self.reset_requested = True
+
+    @torch.no_grad()
+    def downsample(self, image: torch.Tensor) -> torch.Tensor:
+        if image.ndim == 3:
+            image = image.unsqueeze(0)
+        return F.interpolate(
+            image.float(), size=(self.size, self.size), mode="area"
+        ).reshape(-1)
+
+    @torch.no_grad()
+    def should_skip(self, image: torch.Tensor) -> bool:
+        if self.reset_requested:
+            self.reset_requested = False
+            self.prev_tensor = None
+            self.skip_count = 0
+            self.pending = None
+        current = self.downsample(image)
+        if self.prev_tensor is None:
+            self.prev_tensor = current
+            return False
+
+        # Probabilistic skip as in StreamDiffusion: the closer the frame is to
+        # the last processed one, the more likely it is skipped, but a frame is
+        # never skipped more than max_skip_frame times in a row.
+        cos_sim = self.similarity(current)
+        if cos_sim is None:
+            # no finished result yet, process the frame
+            self.prev_tensor = current
+            self.skip_count = 0
+            return False
+        if self.threshold >= 1:
+            skip_prob = 0.0
+        else:
+            skip_prob = max(0.0, 1 - (1 - cos_sim) / (1 - self.threshold))
+
+        if skip_prob < random.uniform(0, 1) or self.skip_count >= self.max_skip_frame:
+            self.prev_tensor = current
+            self.skip_count = 0
+            return False
+        self.skip_count += 1
+        return True
+
+    @torch.no_grad()
+    def similarity(self, current: torch.Tensor) -> float:
+        cos_sim = F.cosine_similarity(self.prev_tensor, current, dim=0)
+        if not cos_sim.is_cuda:
+            return cos_sim.item()
+        if self.host is None:
+            self.host = torch.empty(2, dtype=torch.float32, pin_memory=True)
+        # the previous frame's value, if the GPU is done with it
+        result = None
+        if self.pending is not None and self.pending[1].query():
+            result = self.host[self.pending[0]].item()
+        index = self.next_buffer
+        self.next_buffer = 1 - index
+        self.host[index].copy_(cos_sim, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self.pending = (index, event)
+        return result
@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from pipelines.utils.batched_lora import BatchedLoraLayer, LoraAssignment
+
+
+def batched_layer(assignment):
+    torch.manual_seed(0)
+    layer = BatchedLoraLayer(torch.nn.Linear(8, 6), assignment)
+    for adapter in assignment.adapters:
+        layer.add_adapter(adapter, torch.nn.Linear(8, 2, bias=False), torch.nn.Linear(2, 6, bias=False), 0.5)
+    return layer
+
+
+def branch(layer, adapter, x):
+    return layer.lora_B[adapter](layer.lora_A[adapter](x)) * 0.5
+
+
+@torch.no_grad()
+def test_mixed_batch_applies_each_sample_its_own_adapter():
+    assignment = LoraAssignment(["toy", "pixel"], torch.device("cpu"), torch.float32, max_batch_size=3)
+    layer = batched_layer(assignment)
+    x = torch.randn(3, 8)
+
+    assignment.set([("toy", 0.8), (None, 0.0), ("pixel", 0.5)])
+    expected = layer.base_layer(x).clone()
+    expected[0] += 0.8 * branch(layer, "toy", x[:1])[0]
+    expected[2] += 0.5 * branch(layer, "pixel", x[2:])[0]
+    torch.testing.assert_close(layer(x), expected)
+
+
+@torch.no_grad()
+def test_guidance_rows_repeat_the_sample_assignment():
+    assignment = LoraAssignment(["toy"], torch.device("cpu"), torch.float32, max_batch_size=1)
+    layer = batched_layer(assignment)
+    x = torch.randn(4, 8)
+
+    assignment.set([("toy", 1.0), (None, 0.0)])
+    expected = layer.base_layer(x).clone()
+    expected[0::2] += branch(layer, "toy", x[0::2])
+    torch.testing.assert_close(layer(x), expected)
+
+
+@torch.no_grad()
+def test_unassigned_batches_run_the_base_layer_unless_always_on():
+    assignment = LoraAssignment(["toy"], torch.device("cpu"), torch.float32)
+    layer = batched_layer(assignment)
+    x = torch.randn(2, 8)
+    assignment.set([])
+    assert torch.equal(layer(x), layer.base_layer(x))
+
+    weights = assignment.weights
+    assignment.always = True
+    assignment.set([])
+    assert assignment.active
+    torch.testing.assert_close(layer(x), layer.base_layer(x))
+    # in place refills keep the buffer a traced graph captured
+    assignment.set([("toy", 1.0), ("toy", 0.5)])
+    assert assignment.weights is weights
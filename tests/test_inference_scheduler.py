@@ -0,0 +1,55 @@
+from concurrent.futures import wait
+from types import SimpleNamespace
+
+import pytest
+
+from inference_scheduler import InferenceScheduler
+
+
+class BatchPipeline:
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.batches = []
+
+    def predict(self, params):
+        return params.seed
+
+    def predict_batch(self, params_list):
+        self.batches.append([params.seed for params in params_list])
+        return [params.seed for params in params_list][self.drop:]
+
+
+def scheduler_for(pipeline, sessions=2):
+    scheduler = InferenceScheduler(pipeline, max_batch_size=4, batch_timeout=1.0)
+    for _ in range(sessions):
+        scheduler.register()
+    return scheduler
+
+
+def test_sessions_with_matching_params_share_a_batch():
+    pipeline = BatchPipeline()
+    scheduler = scheduler_for(pipeline)
+    futures = [scheduler.submit(SimpleNamespace(seed=seed, steps=2, lora={"toy": 0.5})) for seed in (1, 2)]
+    assert [future.result(timeout=5) for future in futures] == [1, 2]
+    assert pipeline.batches == [[1, 2]]
+    scheduler.stop()
+
+
+def test_unhashable_params_never_share_a_batch():
+    scheduler = scheduler_for(BatchPipeline())
+    first = scheduler.batch_key(SimpleNamespace(seed=1, mask=bytearray(b"a")))
+    second = scheduler.batch_key(SimpleNamespace(seed=2, mask=bytearray(b"a")))
+    assert first != second
+    assert first == first
+    scheduler.stop()
+
+
+def test_short_batch_results_fail_every_request():
+    scheduler = scheduler_for(BatchPipeline(drop=1))
+    futures = [scheduler.submit(SimpleNamespace(seed=seed)) for seed in (1, 2)]
+    done, not_done = wait(futures, timeout=5)
+    assert not not_done
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result()
+    scheduler.stop()
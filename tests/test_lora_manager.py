@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+
+from peft.tuners.tuners_utils import BaseTunerLayer
+from pipelines.utils.lora_manager import FusedLoraManager
+
+
+class LoraPipe:
+    # the parts of a diffusers pipeline FusedLoraManager uses
+    def __init__(self, adapters):
+        torch.manual_seed(0)
+        self.unet = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.Conv2d(8, 8, 1))
+        self.base = [param.detach().clone() for param in self.unet.parameters()]
+        for adapter in adapters:
+            config = peft.LoraConfig(r=2, target_modules=["0", "1"], init_lora_weights=False)
+            peft.inject_adapter_in_model(config, self.unet, adapter_name=adapter)
+
+    def unload_lora_weights(self):
+        for name, module in list(self.unet.named_children()):
+            if isinstance(module, BaseTunerLayer):
+                setattr(self.unet, name, module.get_base_layer())
+
+
+def lora_setup(adapters=("toy", "pixel")):
+    pipe = LoraPipe(adapters)
+    layers = list(pipe.unet)
+    deltas = {
+        adapter: [layer.get_delta_weight(adapter).detach().clone() for layer in layers]
+        for adapter in adapters
+    }
+    return pipe, FusedLoraManager(pipe, list(adapters), components=("unet",)), deltas
+
+
+def test_set_fuses_weighted_deltas_into_the_base_weights():
+    pipe, manager, deltas = lora_setup()
+    manager.set({"toy": 0.5, "pixel": 2.0})
+    for index, layer in enumerate(pipe.unet):
+        expected = pipe.base[2 * index] + 0.5 * deltas["toy"][index] + 2.0 * deltas["pixel"][index]
+        torch.testing.assert_close(layer.weight, expected)
+    assert manager.name == "pixel:2.0,toy:0.5"
+
+
+def test_going_back_to_base_restores_the_exact_weights():
+    pipe, manager, _ = lora_setup()
+    weights = [layer.weight for layer in pipe.unet]
+    for value in (0.1, 0.37, 0.9, 0.55):
+        manager.set({"toy": value, "pixel": 1 - value})
+    manager.set({"toy": 0.0})
+    for index, layer in enumerate(pipe.unet):
+        assert layer.weight is weights[index]
+        assert torch.equal(layer.weight, pipe.base[2 * index])
+    assert manager.name == "base"
@@ -0,0 +1,81 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from pipelines.utils.output import check_output, is_rgba8, overlay
+
+
+VALID_OUTPUTS = {
+    "rgb_float32": lambda: torch.rand(3, 64, 48),
+    "rgb_float16": lambda: torch.rand(3, 64, 48).half(),
+    "rgba8": lambda: torch.zeros(64, 48, 4, dtype=torch.uint8),
+}
+
+INVALID_SHAPES = {
+    "hwc_float": lambda: torch.rand(64, 48, 3),
+    "rgba_chw_float": lambda: torch.rand(4, 64, 48),
+    "batched": lambda: torch.rand(1, 3, 64, 48),
+    "rgb_uint8_chw": lambda: torch.zeros(3, 64, 48, dtype=torch.uint8),
+    "rgb8_hwc": lambda: torch.zeros(64, 48, 3, dtype=torch.uint8),
+}
+
+
+@pytest.mark.parametrize("name", VALID_OUTPUTS)
+def test_valid_outputs_pass_through(name):
+    image = VALID_OUTPUTS[name]()
+    assert check_output(image, "cpu") is image
+
+
+def test_dropped_frame_is_none():
+    assert check_output(None, "cpu") is None
+
+
+def test_pil_output_is_rejected():
+    with pytest.raises(TypeError):
+        check_output(Image.new("RGB", (48, 64)), "cpu")
+
+
+@pytest.mark.parametrize("name", INVALID_SHAPES)
+def test_wrong_shapes_are_rejected(name):
+    with pytest.raises(ValueError):
+        check_output(INVALID_SHAPES[name](), "cpu")
+
+
+def test_device_mismatch_is_rejected():
+    with pytest.raises(ValueError):
+        check_output(torch.rand(3, 8, 8), torch.device("cuda"))
+
+
+def test_device_is_optional():
+    image = torch.rand(3, 8, 8)
+    assert check_output(image) is image
+
+
+def test_is_rgba8():
+    assert is_rgba8(torch.zeros(8, 8, 4, dtype=torch.uint8))
+    assert not is_rgba8(torch.zeros(8, 8, 4))
+    assert not is_rgba8(torch.zeros(4, 8, 8, dtype=torch.uint8)[..., :3])
+
+
+def test_overlay_pastes_bottom_right_in_place():
+    image = torch.zeros(3, 300, 400)
+    control = torch.ones(3, 64, 64)
+    result = overlay(image, control)
+    assert result is image
+    assert torch.all(image[:, 100:, 200:] == 1)
+    assert torch.all(image[:, :100, :] == 0)
+    assert torch.all(image[:, :, :200] == 0)
+
+
+def test_overlay_expands_single_channel_control():
+    image = torch.zeros(3, 256, 256)
+    overlay(image, torch.ones(1, 32, 32), size=(64, 64))
+    assert torch.all(image[:, 192:, 192:] == 1)
+
+
+def test_overlay_is_clipped_to_small_images():
+    image = torch.zeros(3, 100, 150, dtype=torch.float16)
+    overlay(image, torch.ones(3, 400, 400))
+    assert torch.all(image == 1)
+    assert image.dtype == torch.float16
@@ -0,0 +1,50 @@
+import ast
+from pathlib import Path
+
+import pytest
+
+# Every pipeline's predict signatures are checked statically here, building
+# them needs their models. test_pipeline_runs.py runs some on tiny models.
+PIPELINES = sorted(
+    path for path in (Path(__file__).parent.parent / "pipelines").glob("*.py")
+    if path.name != "__init__.py"
+)
+
+
+def pipeline_methods(path: Path) -> dict[str, ast.FunctionDef]:
+    tree = ast.parse(path.read_text())
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == "Pipeline":
+            return {
+                item.name: item for item in node.body if isinstance(item, ast.FunctionDef)
+            }
+    raise AssertionError(f"{path.name} has no Pipeline class")
+
+
+@pytest.mark.parametrize("path", PIPELINES, ids=lambda path: path.stem)
+def test_predict_returns_tensor(path):
+    predict = pipeline_methods(path)["predict"]
+    assert predict.returns is not None, f"{path.name} predict has no return annotation"
+    assert ast.unparse(predict.returns) == "torch.Tensor"
+
+
+@pytest.mark.parametrize("path", PIPELINES, ids=lambda path: path.stem)
+def test_predict_batch_returns_list(path):
+    predict_batch = pipeline_methods(path).get("predict_batch")
+    if predict_batch is None:
+        pytest.skip("pipeline does not batch")
+    assert predict_batch.returns is not None
+    assert ast.unparse(predict_batch.returns) in ("list", "list[torch.Tensor]")
+
+
+@pytest.mark.parametrize("method", ["predict", "predict_batch"])
+@pytest.mark.parametrize("path", PIPELINES, ids=lambda path: path.stem)
+def test_no_pil_conversion_in_predict(path, method):
+    # outputs stay on the device, converting to PIL means a host round trip
+    function = pipeline_methods(path).get(method)
+    if function is None:
+        pytest.skip("pipeline does not batch")
+    source = ast.unparse(function)
+    assert "ToPILImage" not in source
+    assert 'output_type="pil"' not in source
+    assert ".to_pil" not in source
@@ -0,0 +1,150 @@
+import importlib
+import json
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+torch = pytest.importorskip("torch")
+diffusers = pytest.importorskip("diffusers")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("compel")
+pytest.importorskip("psutil")
+
+# config.py parses the command line on import, give it the server defaults
+with mock.patch.object(sys, "argv", ["main.py"]):
+    import config  # noqa: F401
+
+from pipelines.utils.canny_gpu import SobelOperator
+from pipelines.utils.output import check_output
+from pipelines.utils.prompt_cache import PromptEmbeddingCache
+
+SIZE = 64
+
+# Runs the SD 1.5 pipelines end to end on CPU, with randomly initialised
+# models small enough to run in a test: the tokenizer only knows its special
+# tokens, the UNet, VAE and ControlNet have two blocks and the VAE scales by 2.
+
+
+@pytest.fixture(scope="module")
+def components(tmp_path_factory):
+    torch.manual_seed(0)
+    directory = tmp_path_factory.mktemp("tokenizer")
+    vocab = directory / "vocab.json"
+    vocab.write_text(json.dumps({"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}))
+    merges = directory / "merges.txt"
+    merges.write_text("#version: 0.2\n")
+    tokenizer = transformers.CLIPTokenizer(str(vocab), str(merges), model_max_length=77)
+    text_encoder = transformers.CLIPTextModel(
+        transformers.CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=1,
+            pad_token_id=1,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            vocab_size=16,
+        )
+    )
+    blocks = dict(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        cross_attention_dim=32,
+    )
+    unet = diffusers.UNet2DConditionModel(
+        sample_size=SIZE // 2,
+        in_channels=4,
+        out_channels=4,
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        **blocks,
+    )
+    controlnet = diffusers.ControlNetModel(
+        in_channels=4, conditioning_embedding_out_channels=(16, 32), **blocks
+    )
+    vae = diffusers.AutoencoderKL(
+        block_out_channels=(32, 64),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+    )
+    return dict(
+        tokenizer=tokenizer,
+        text_encoder=text_encoder,
+        unet=unet.eval(),
+        controlnet=controlnet.eval(),
+        vae=vae.eval(),
+        scheduler=diffusers.LCMScheduler(),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+
+def tiny_pipeline(name: str, pipe):
+    # the Pipeline wrapper without its __init__, which downloads the models
+    module = importlib.import_module(f"pipelines.{name}")
+    pipeline = module.Pipeline.__new__(module.Pipeline)
+    pipe.set_progress_bar_config(disable=True)
+    pipeline.pipe = pipe
+    pipeline.prompt_cache = PromptEmbeddingCache()
+    pipeline.canny_torch = SobelOperator(device="cpu")
+    return pipeline
+
+
+def session_params(pipeline, seed: int = 0, **overrides) -> SimpleNamespace:
+    # what TextureManager.infer hands to predict, an RGB CHW frame in [0, 1]
+    params = SimpleNamespace(**pipeline.InputParams(seed=seed, **overrides).dict())
+    params.image = torch.rand(3, SIZE, SIZE, generator=torch.Generator().manual_seed(seed))
+    params.width = SIZE
+    params.height = SIZE
+    return params
+
+
+PIPELINES = {
+    "img2img": lambda c: diffusers.StableDiffusionImg2ImgPipeline(**c, image_encoder=None),
+    "txt2img": lambda c: diffusers.StableDiffusionPipeline(**c, image_encoder=None),
+    "controlnet": lambda c: diffusers.StableDiffusionControlNetImg2ImgPipeline(**c),
+}
+
+
+def build(name, components):
+    pipe_components = dict(components)
+    if name != "controlnet":
+        del pipe_components["controlnet"]
+    return tiny_pipeline(name, PIPELINES[name](pipe_components))
+
+
+def assert_frame(image):
+    assert isinstance(image, torch.Tensor)
+    assert check_output(image, torch.device("cpu")) is image
+    assert image.shape == (3, SIZE, SIZE)
+    assert image.dtype == torch.float32
+    assert image.device.type == "cpu"
+    assert image.min() >= 0 and image.max() <= 1
+
+
+@pytest.mark.parametrize("name", PIPELINES)
+def test_predict_returns_a_frame_on_the_pipeline_device(name, components):
+    pipeline = build(name, components)
+    assert_frame(pipeline.predict(session_params(pipeline)))
+
+
+@pytest.mark.parametrize("name", PIPELINES)
+def test_predict_batch_returns_one_frame_per_session(name, components):
+    pipeline = build(name, components)
+    if not hasattr(pipeline, "predict_batch"):
+        pytest.skip("pipeline does not batch")
+    images = pipeline.predict_batch([session_params(pipeline, seed) for seed in range(2)])
+    assert len(images) == 2
+    for image in images:
+        assert_frame(image)
+
+
+def test_controlnet_debug_overlay_keeps_the_frame_format(components):
+    pipeline = build("controlnet", components)
+    assert_frame(pipeline.predict(session_params(pipeline, debug_canny=True)))
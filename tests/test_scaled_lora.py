@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from pipelines.utils.scaled_lora import LoraScale, ScaledLoraLayer
+
+
+def scaled_layer(base, lora_A, lora_B, scaling=0.5):
+    strength = LoraScale(torch.device("cpu"), torch.float32, max_batch_size=2)
+    return ScaledLoraLayer(base, lora_A, lora_B, scaling, strength), strength
+
+
+@torch.no_grad()
+def test_linear_strength_scales_the_fused_delta_per_sample():
+    torch.manual_seed(0)
+    base, lora_A, lora_B = torch.nn.Linear(8, 6), torch.nn.Linear(8, 2, bias=False), torch.nn.Linear(2, 6, bias=False)
+    layer, strength = scaled_layer(base, lora_A, lora_B)
+    x = torch.randn(3, 8)
+    delta = lora_B(lora_A(x)) * 0.5
+
+    strength.set([1.0, 1.0, 1.0])
+    assert torch.equal(layer(x), base(x))
+
+    strength.set([0.0, 0.5, 2.0])
+    expected = base(x) + delta * torch.tensor([-1.0, -0.5, 1.0]).view(-1, 1)
+    torch.testing.assert_close(layer(x), expected)
+
+
+@torch.no_grad()
+def test_conv_strength_broadcasts_over_channels_and_pixels():
+    torch.manual_seed(0)
+    base = torch.nn.Conv2d(4, 5, 3, padding=1)
+    lora_A = torch.nn.Conv2d(4, 2, 3, padding=1, bias=False)
+    lora_B = torch.nn.Conv2d(2, 5, 1, bias=False)
+    layer, strength = scaled_layer(base, lora_A, lora_B)
+    x = torch.randn(2, 4, 6, 6)
+
+    strength.set([0.25, 1.5])
+    expected = base(x) + lora_B(lora_A(x)) * 0.5 * torch.tensor([-0.75, 0.5]).view(-1, 1, 1, 1)
+    torch.testing.assert_close(layer(x), expected)
+
+
+def test_strengths_grow_past_the_allocated_batch():
+    strength = LoraScale(torch.device("cpu"), torch.float32, max_batch_size=1)
+    strength.set([0.5, 0.5, 0.75])
+    assert strength.active
+    assert strength.scale.tolist() == [-0.5, -0.5, -0.25]
+    assert strength.per_sample(strength.strength, 4).shape == (3, 1, 1, 1)
@@ -0,0 +1,55 @@
+import sys
+
+import numpy as np
+import pytest
+
+if sys.platform == "win32":
+    pytest.skip("shared memory textures are the POSIX backend", allow_module_level=True)
+
+import gfx2cuda as g2c
+import gfx2cuda.backends
+
+SHAPE = (8, 12, 4)
+
+
+@pytest.fixture
+def textures():
+    # the render engine's texture and the same segment opened by a session
+    engine = g2c.texture(SHAPE, g2c.TextureFormat.RGBA8UINT, backend=g2c.Backends.SHM)
+    session = g2c.open_ipc_texture(engine.ipc_handle, backend=g2c.Backends.SHM)
+    yield engine, session
+    session.release()
+    engine.release()
+
+
+def frame(value):
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def read(texture):
+    dst = np.empty(SHAPE, dtype=np.uint8)
+    texture.copy_to(dst)
+    return dst
+
+
+def test_complete_frames_are_read(textures):
+    engine, session = textures
+    engine.copy_from(frame(7))
+    assert session.frame == 1
+    assert np.array_equal(read(session), frame(7))
+    engine.copy_from(frame(9))
+    assert session.frame == 2
+    assert np.array_equal(read(session), frame(9))
+
+
+def test_frame_being_written_returns_the_last_complete_one(textures, monkeypatch):
+    monkeypatch.setattr(gfx2cuda.backends, "SHM_READ_TIMEOUT", 0.005)
+    engine, session = textures
+    engine.copy_from(frame(7))
+    assert np.array_equal(read(session), frame(7))
+    # a writer stuck halfway through the next frame
+    engine._frame[0] += 1
+    engine.array[:4] = 200
+    assert np.array_equal(read(session), frame(7))
+    engine._frame[0] += 1
+    assert np.array_equal(read(session)[:4], frame(200)[:4])
@@ -3,24 +3,165 @@ from uuid import UUID
 import torch
 import gfx2cuda as g2c 
 import asyncio
+import queue
+import threading
 import time
+from inference_scheduler import InferenceScheduler
+from similar_image_filter import SimilarImageFilter
+from frame_pacer import FramePacer
+from frame_converter import FrameConverter
+from texture_pool import TexturePool
+from prompt_prefetcher import PromptPrefetcher
+from resolution_buckets import ResolutionBuckets
+from pipelines.utils.output import check_output, is_rgba8
+import logging
+from config import Args
+
+def record_event(stream: torch.cuda.Stream = None):
+	if not torch.cuda.is_available():
+		return None
+	event = torch.cuda.Event()
+	event.record(stream)
+	return event
+
+def wait_event(event, stream: torch.cuda.Stream = None):
+	if event is not None:
+		(stream or torch.cuda.current_stream()).wait_event(event)
+
+def current_stream():
+	# texture copies are queued on the calling thread's torch stream, so they
+	# only order against that stage's work instead of the whole device
+	return torch.cuda.current_stream() if torch.cuda.is_available() else None
 
 class TextureTransfer:
-	def __init__(self, on_handle_change: lambda handle: None, pipeline: any):
+	def __init__(
+		self,
+		on_handle_change: lambda handles: None,
+		pipeline: any,
+		scheduler: InferenceScheduler,
+		device: torch.device,
+		torch_dtype: torch.dtype,
+		pool: TexturePool,
+		similar_filter: SimilarImageFilter = None,
+		overlap_stages: bool = False,
+		stage_buffers: int = 3,
+		target_fps: float = 60.0,
+		prefetcher: PromptPrefetcher = None,
+		buckets: ResolutionBuckets = None,
+		direct_io: bool = False,
+		output_ring_size: int = 1,
+		on_frame_ready: lambda frame, slot: None = None,
+	):
 		self.source_handle = None
 		self.width = None
 		self.height = None
+		self.buckets = buckets
+		self.bucket: tuple[int, int] = None
 		self.on_handle_change = on_handle_change
 		self.pipeline = pipeline
+		self.scheduler = scheduler
+		self.similar_filter = similar_filter
+		self.prefetcher = prefetcher
+		self.paramsGeneration = 0
+		self.overlap_stages = overlap_stages
+		self.stage_buffers = max(2, stage_buffers) if overlap_stages else 1
+		self.pacer = FramePacer(target_fps)
+		self.device = device
+		self.converter = FrameConverter(device, torch_dtype)
+		self.pool = pool
+		self.input_tensors: list[torch.Tensor] = []
+		self.output_tensors: list[torch.Tensor] = []
+		# finished frames rotate through the ring, so a reader never sees the
+		# texture it is reading being overwritten by the next frame
+		self.output_ring_size = max(1, output_ring_size)
+		self.output_textures: list[g2c.Texture] = []
+		self.on_frame_ready = on_frame_ready
+		self.frame = 0
+		self.publishedFrame = -1
+		# Readers that send frame_released hold a slot from its frame_ready
+		# until then and the writer skips it. Readers that never do must read
+		# a slot within output_ring_size - 1 frames.
+		self.ringLock = threading.Lock()
+		self.ringSlot = -1
+		self.heldSlots: set[int] = set()
+		self.readerAcks = False
+		self.eventLoop: asyncio.AbstractEventLoop = None
+		# waits for each written frame's event and announces it on the loop
+		self.announcements: queue.Queue = queue.Queue()
+		self.announcer: threading.Thread = None
+		# direct_io samples and writes the mapped textures with CUDA kernels,
+		# direct is whether this session's textures allow it
+		self.direct_io = direct_io
+		self.direct = False
 		self.params = SimpleNamespace()
+		self.receivedParams: dict = None
 		self.loopTask: asyncio.Future = None
-		self.cancelEvent: asyncio.Event = None
+		self.cancelEvent: threading.Event = None
+		self.lock = threading.Lock()
+		self.running = False
+		self.closed = False
 
 	def cancel(self):
-		if self.loopTask and self.cancelEvent:
-			self.loopTask.cancel()
+		if self.cancelEvent:
 			self.cancelEvent.set()
 
+	async def stop(self):
+		self.cancel()
+		if self.loopTask:
+			try:
+				await self.loopTask
+			except Exception as e:
+				logging.error(f"Texture loop error: {e}")
+			self.loopTask = None
+
+	def close(self):
+		# buffers go back to the pool once the loop thread is done with them
+		with self.lock:
+			self.closed = True
+			self.cancel()
+			if not self.running:
+				self.releaseBuffers()
+
+	def setParams(self, params: SimpleNamespace):
+		with self.lock:
+			# clients resend source_info with unchanged settings, which must
+			# neither restart a prefetch nor reset the similar image filter
+			received = vars(params).copy()
+			if received == self.receivedParams:
+				return
+			self.receivedParams = received
+			self.paramsGeneration += 1
+			generation = self.paramsGeneration
+			prefetch = (
+				self.prefetcher is not None
+				and hasattr(self.params, "prompt")
+				and self.prefetcher.prompt_changed(self.params, params)
+			)
+			if prefetch:
+				# keep rendering the old prompt until the new one is encoded
+				self.params = self.prefetcher.with_prompt(params, self.params)
+			else:
+				self.params = params
+		if self.similar_filter:
+			# new params must always produce a new frame
+			self.similar_filter.reset()
+		if prefetch:
+			future = self.prefetcher.submit(params)
+			future.add_done_callback(lambda future: self.swapParams(generation, params, future))
+
+	def swapParams(self, generation: int, params: SimpleNamespace, future):
+		if future.cancelled():
+			return
+		if future.exception() is not None:
+			# predict will encode it again and surface the error there
+			logging.error(f"Prompt prefetch error: {future.exception()}")
+		with self.lock:
+			# a newer setParams has taken over, it prefetches its own prompt
+			if generation != self.paramsGeneration:
+				return
+			self.params = params
+		if self.similar_filter:
+			self.similar_filter.reset()
 
 	def setInputTexture(self, source_handle: int):
 		self.source_handle = source_handle
@@ -28,91 +169,395 @@ class TextureTransfer:
 		return
 	
 	async def setProps(self, width: int, height: int, source_handle: int):
-		reload = False
+		reload = width != self.width or height != self.height or source_handle != self.source_handle
+		if not reload:
+			return
+
+		await self.stop()
 		if width != self.width or height != self.height:
 			await self.setSize(width, height)
-			reload = True
 		if source_handle != self.source_handle:
 			self.setInputTexture(source_handle)
-			reload = True
-
-		if reload:
-			self.cancel()
-			await self.run()
+		self.setDirect()
+		await self.run()
 		return
 	
 	async def setSize(self, width: int, height: int):
 		self.width =  width
 		self.height = height
-		self.output_tensor = torch.ones((self.height, self.width, 4), dtype=torch.uint8).mul(255).cuda()
-		self.input_tensor = torch.zeros((self.height, self.width, 4), dtype=torch.uint8).cuda()
-		self.output_texture = g2c.texture(torch.ones((self.height, self.width, 4), dtype=torch.uint8).cuda())
-		self.output_handle = self.output_texture.ipc_handle
-		await self.on_handle_change(self.output_texture.ipc_handle)
+		# the pipeline always runs at a bucket size so compiled graphs are reused
+		self.bucket = self.buckets.nearest(width, height) if self.buckets else (width, height)
+		self.converter.clear()
+		self.releaseBuffers()
+		self.output_textures = [
+			self.pool.acquire_texture(self.width, self.height, surface=self.wantsDirect())
+			for _ in range(self.output_ring_size)
+		]
+		# frames still in flight were written to the old ring, don't announce them
+		self.publishedFrame = self.frame - 1
+		with self.ringLock:
+			self.ringSlot = -1
+			self.heldSlots.clear()
+		await self.on_handle_change([texture.ipc_handle for texture in self.output_textures])
 		return
 
-	def loop(self):
-		while True:
+	def wantsDirect(self) -> bool:
+		return self.direct_io and self.device.type == "cuda"
+
+	def setDirect(self):
+		# Needs both textures, so it is decided once the size and the input
+		# are known. Formats the kernels don't read, or backends without a
+		# CUDA array, fall back to the staging copies.
+		self.direct = (
+			self.wantsDirect()
+			and self.input_texture.supports_direct_io
+			and all(texture.supports_direct_io for texture in self.output_textures)
+		)
+		if self.direct:
+			for tensor in self.input_tensors + self.output_tensors:
+				self.pool.release(tensor)
+			self.input_tensors = []
+			self.output_tensors = []
+		elif not self.input_tensors:
+			self.output_tensors = [
+				self.pool.acquire_tensor((self.height, self.width, 4), torch.uint8, fill=255)
+				for _ in range(self.stage_buffers)
+			]
+			self.input_tensors = [
+				self.pool.acquire_tensor((self.height, self.width, 4), torch.uint8)
+				for _ in range(self.stage_buffers)
+			]
+
+	def releaseBuffers(self):
+		for tensor in self.input_tensors + self.output_tensors:
+			self.pool.release(tensor)
+		for texture in self.output_textures:
+			self.pool.release(texture)
+		self.input_tensors = []
+		self.output_tensors = []
+		self.output_textures = []
+
+	# readInput and writeOutput expect their texture to be mapped already
+	def readInput(self, slot: int, stream) -> torch.Tensor:
+		if self.direct:
+			# sampled straight to the bucket size, infer won't resize it again
+			width, height = self.bucket
+			return self.converter.read_texture(self.input_texture, width, height, slot, stream)
+		input_tensor = self.input_tensors[slot]
+		self.input_texture.copy_to(input_tensor, stream)
+		return self.converter.to_image(input_tensor, slot)
+
+	def writeOutput(self, pt_img: torch.Tensor, output_texture: g2c.Texture, slot: int, stream):
+		if self.direct:
+			if is_rgba8(pt_img):
+				output_texture.copy_from(pt_img.contiguous(), stream)
+			else:
+				self.converter.write_texture(pt_img, output_texture, slot, stream)
+			return
+		output_tensor = self.converter.to_rgba(pt_img, self.output_tensors[slot], slot)
+		output_texture.copy_from(output_tensor, stream)
 
-			if self.cancelEvent.is_set():
+	# only called from the thread writing frames back
+	def nextOutput(self) -> tuple[int, int]:
+		with self.ringLock:
+			for offset in range(1, self.output_ring_size + 1):
+				ring_slot = (self.ringSlot + offset) % self.output_ring_size
+				if ring_slot not in self.heldSlots:
+					break
+			else:
+				# the reader holds every texture, drop the frame rather than
+				# write into one it is reading
+				return None
+			self.ringSlot = ring_slot
+		frame = self.frame
+		self.frame += 1
+		return frame, ring_slot
+
+	def releaseSlot(self, ring_slot: int):
+		with self.ringLock:
+			self.readerAcks = True
+			self.heldSlots.discard(ring_slot)
+
+	def publishFrame(self, frame: int, ring_slot: int, stream):
+		if self.output_ring_size == 1 or self.on_frame_ready is None or self.eventLoop is None:
+			return
+		# announced once the GPU is done writing, without blocking this thread
+		if self.announcer is None:
+			self.announcer = threading.Thread(target=self.announceFrames, name="frame-announcer", daemon=True)
+			self.announcer.start()
+		self.announcements.put((frame, ring_slot, record_event(stream)))
+
+	def stopAnnouncer(self):
+		if self.announcer is not None:
+			self.announcements.put(None)
+			self.announcer = None
+
+	def announceFrames(self):
+		while True:
+			announcement = self.announcements.get()
+			if announcement is None:
 				return
+			frame, ring_slot, event = announcement
+			if event is not None:
+				event.synchronize()
+			asyncio.run_coroutine_threadsafe(self.frameReady(frame, ring_slot), self.eventLoop)
 
-			with self.input_texture: 
-					self.input_texture.copy_to(self.input_tensor)
-		
-			without_alpha = self.input_tensor[..., :3]
-			
-			for_img = without_alpha.permute(2, 0, 1).contiguous().mul(1/255).cuda()
-			self.params.image = for_img
-			self.params.width = self.width
-			self.params.height = self.height
-			pt_img = self.pipeline.predict(self.params)
+	async def frameReady(self, frame: int, ring_slot: int):
+		# a newer frame may have been announced already
+		if frame <= self.publishedFrame:
+			return
+		self.publishedFrame = frame
+		with self.ringLock:
+			if self.readerAcks:
+				self.heldSlots.add(ring_slot)
+		try:
+			await self.on_frame_ready(frame, ring_slot)
+		except Exception as e:
+			logging.error(f"Frame ready error: {e}")
+
+	def capture(self, slot: int) -> torch.Tensor:
+		stream = current_stream()
+		with self.input_texture.mapped(stream):
+			return self.readInput(slot, stream)
+
+	def skip(self, image: torch.Tensor) -> bool:
+		return self.similar_filter is not None and self.similar_filter.should_skip(image)
+
+	def infer(self, image: torch.Tensor) -> torch.Tensor:
+		params = self.params
+		width, height = self.bucket
+		params.image = self.converter.resize(image, width, height)
+		params.width = width
+		params.height = height
+		pt_img = check_output(self.scheduler.predict(params), self.converter.device)
+		if pt_img is None:
+			return None
+		return self.converter.resize(pt_img, self.width, self.height)
+
+	def writeBack(self, pt_img: torch.Tensor, slot: int):
+		stream = current_stream()
+		output = self.nextOutput()
+		if output is None:
+			return
+		frame, ring_slot = output
+		output_texture = self.output_textures[ring_slot]
+		with output_texture.mapped(stream):
+			self.writeOutput(pt_img, output_texture, slot, stream)
+		self.publishFrame(frame, ring_slot, stream)
+
+	def writeBackAndCapture(self, pt_img: torch.Tensor, slot: int) -> torch.Tensor:
+		# frame N goes out and frame N+1 comes in under a single map call
+		stream = current_stream()
+		output = self.nextOutput()
+		if output is None:
+			return self.capture(slot)
+		frame, ring_slot = output
+		output_texture = self.output_textures[ring_slot]
+		with g2c.map_many([output_texture, self.input_texture], stream):
+			self.writeOutput(pt_img, output_texture, slot, stream)
+			image = self.readInput(slot, stream)
+		self.publishFrame(frame, ring_slot, stream)
+		return image
+
+	def loop(self, cancelEvent: threading.Event):
+		self.pacer.reset()
+		for_img = self.capture(0)
+		while not cancelEvent.is_set():
+			if self.skip(for_img):
+				self.pacer.wait()
+				for_img = self.capture(0)
+				continue
+
+			pt_img = self.infer(for_img)
 			if pt_img is None:
 				return
 
-			generated_tensor = pt_img.permute(1, 2, 0).contiguous().mul(255).cuda()
-			
-			self.output_tensor[..., :3] = generated_tensor
+			for_img = self.writeBackAndCapture(pt_img, 0)
+
+			self.pacer.wait()
+
+	# Overlapped mode: frame N+1 is captured and frame N-1 written back on
+	# their own CUDA streams while frame N is in the UNet. Each stage hands
+	# its tensor over together with an event, so the next stage only waits on
+	# the GPU for the work it depends on.
+	def captureStage(self, cancelEvent: threading.Event, free_slots: threading.Semaphore, captured: queue.Queue):
+		stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+		frame = 0
+		while not cancelEvent.is_set():
+			if not free_slots.acquire(timeout=0.1):
+				continue
+			slot = frame % self.stage_buffers
+			with torch.cuda.stream(stream):
+				image = self.capture(slot)
+				event = record_event(stream)
+			captured.put((slot, image, event))
+			frame += 1
+
+	def writeBackStage(self, cancelEvent: threading.Event, free_slots: threading.Semaphore, generated: queue.Queue):
+		stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+		while not cancelEvent.is_set():
+			try:
+				slot, pt_img, event = generated.get(timeout=0.1)
+			except queue.Empty:
+				continue
+			with torch.cuda.stream(stream):
+				wait_event(event, stream)
+				if stream is not None:
+					pt_img.record_stream(stream)
+				self.writeBack(pt_img, slot)
+			free_slots.release()
 
-			with self.output_texture:
-				self.output_texture.copy_from(self.output_tensor)
+	def runStage(self, stage, errors: list, cancelEvent: threading.Event, *args):
+		# a failing stage stops the whole loop, which re-raises its error
+		try:
+			stage(cancelEvent, *args)
+		except Exception as e:
+			errors.append(e)
+			cancelEvent.set()
 
-			time.sleep(1/60)
+	def overlappedLoop(self, cancelEvent: threading.Event):
+		free_slots = threading.Semaphore(self.stage_buffers)
+		captured = queue.Queue()
+		generated = queue.Queue()
+		errors = []
+		stages = [
+			threading.Thread(target=self.runStage, args=(self.captureStage, errors, cancelEvent, free_slots, captured), daemon=True),
+			threading.Thread(target=self.runStage, args=(self.writeBackStage, errors, cancelEvent, free_slots, generated), daemon=True),
+		]
+		for stage in stages:
+			stage.start()
+
+		self.pacer.reset()
+		try:
+			while not cancelEvent.is_set():
+				try:
+					slot, for_img, event = captured.get(timeout=0.1)
+				except queue.Empty:
+					continue
+				wait_event(event)
+				if event is not None:
+					for_img.record_stream(torch.cuda.current_stream())
+
+				if self.skip(for_img):
+					free_slots.release()
+					self.pacer.wait()
+					continue
+
+				pt_img = self.infer(for_img)
+				if pt_img is None:
+					return
+
+				generated.put((slot, pt_img, record_event()))
+
+				self.pacer.wait()
+		finally:
+			cancelEvent.set()
+			# the stages use the session's buffers, which go back to the pool
+			# as soon as this returns
+			for stage in stages:
+				stage.join()
+		if errors:
+			raise errors[0]
 	
+	def runLoop(self, cancelEvent: threading.Event):
+		try:
+			if self.overlap_stages:
+				self.overlappedLoop(cancelEvent)
+			else:
+				self.loop(cancelEvent)
+		finally:
+			self.stopAnnouncer()
+			with self.lock:
+				self.running = False
+				if self.closed:
+					self.releaseBuffers()
+
 	async def run(self):
-		self.cancelEvent = asyncio.Event()
-		self.loopTask = asyncio.get_event_loop().run_in_executor(None, lambda:  self.loop())
+		cancelEvent = threading.Event()
+		self.cancelEvent = cancelEvent
+		self.running = True
+		self.eventLoop = asyncio.get_event_loop()
+		self.loopTask = asyncio.get_event_loop().run_in_executor(None, lambda:  self.runLoop(cancelEvent))
 
 class TextureManager:
-	def __init__(self, on_handle_change: lambda  user_id, handle: None, pipeline):
+	def __init__(self, on_handle_change: lambda  user_id, handles: None, pipeline, scheduler: InferenceScheduler, args: Args, device: torch.device, torch_dtype: torch.dtype, on_frame_ready: lambda user_id, frame, slot: None = None):
+		self.args = args
+		self.device = device
+		self.torch_dtype = torch_dtype
+		self.pool = TexturePool(device, args.texture_pool_budget * 1024 * 1024)
+		self.buckets = ResolutionBuckets(args.resolution_buckets)
 		self.textures = {}
 		self.transfers: dict[UUID, TextureTransfer] = {}
 		self.on_handle_change = on_handle_change
+		self.on_frame_ready = on_frame_ready
 		self.pipeline = pipeline
+		self.scheduler = scheduler
+		self.prefetcher = PromptPrefetcher(pipeline) if hasattr(pipeline, "encode_prompt") else None
 		return
 
+	def create_similar_filter(self) -> SimilarImageFilter:
+		if not self.args.similar_image_filter:
+			return None
+		return SimilarImageFilter(
+			threshold=self.args.similar_image_filter_threshold,
+			max_skip_frame=self.args.similar_image_filter_max_skip_frame,
+		)
+
+	def release_frame(self, user_id: UUID, slot: int):
+		if user_id in self.transfers:
+			self.transfers[user_id].releaseSlot(slot)
+
 	def cancel(self, user_id: UUID):
 		if user_id in self.transfers:
-			self.transfers[user_id].cancel()
+			self.transfers[user_id].close()
 			del self.transfers[user_id]
+			self.scheduler.unregister()
 		return
 	
 	def cancel_all(self):
-		for user_id in self.transfers:
+		for user_id in list(self.transfers):
 			self.cancel(user_id)
+		self.scheduler.stop()
+		if self.prefetcher:
+			self.prefetcher.stop()
+		self.pool.clear()
 		return	
   
-	async def update_info(self, user_id: UUID, width: int, height: int, handle: int, params: SimpleNamespace):
+	async def update_info(self, user_id: UUID, width: int, height: int, handle: int, params: SimpleNamespace, target_fps: float = None):
 		if not user_id in self.transfers:
-			async def cb(handle):
-				await self.on_handle_change(user_id, handle)
+			async def cb(handles):
+				await self.on_handle_change(user_id, handles)
+				return
+			async def frame_cb(frame, slot):
+				await self.on_frame_ready(user_id, frame, slot)
 				return
-			self.transfers[user_id] = TextureTransfer(lambda handle: cb(handle), self.pipeline)
-			self.transfers[user_id].params = params
+			self.transfers[user_id] = TextureTransfer(
+				lambda handle: cb(handle),
+				self.pipeline,
+				self.scheduler,
+				self.device,
+				self.torch_dtype,
+				self.pool,
+				self.create_similar_filter(),
+				overlap_stages=self.args.overlap_stages,
+				stage_buffers=self.args.stage_buffers,
+				target_fps=self.args.target_fps,
+				prefetcher=self.prefetcher,
+				buckets=self.buckets,
+				direct_io=self.args.direct_texture_io,
+				output_ring_size=self.args.output_ring_size,
+				on_frame_ready=frame_cb if self.on_frame_ready else None,
+			)
+			self.scheduler.register()
+			self.transfers[user_id].setParams(params)
+			if target_fps is not None:
+				self.transfers[user_id].pacer.set_target_fps(target_fps)
 			await self.transfers[user_id].setProps(width, height, handle)
 		
 
 		else:
-			self.transfers[user_id].params = params
+			self.transfers[user_id].setParams(params)
+			if target_fps is not None:
+				self.transfers[user_id].pacer.set_target_fps(target_fps)
 			await self.transfers[user_id].setProps(width, height, handle)
 		return
\ No newline at end of file
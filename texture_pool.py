@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import threading
+import torch
+import gfx2cuda as g2c
+
+
+class TexturePool:
+    def __init__(self, device: torch.device, budget: int = 0):
+        # budget is in bytes, 0 means unlimited
+        self.device = device
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.free: OrderedDict[int, tuple[tuple, object, int]] = OrderedDict()
+        self.in_use: dict[int, tuple[tuple, object, int]] = {}
+        self.free_bytes = 0
+        self.in_use_bytes = 0
+
+    def take(self, key: tuple):
+        with self.lock:
+            for resource_id in reversed(self.free):
+                entry = self.free[resource_id]
+                if entry[0] == key:
+                    del self.free[resource_id]
+                    self.free_bytes -= entry[2]
+                    self.in_use[resource_id] = entry
+                    self.in_use_bytes += entry[2]
+                    return entry[1]
+        return None
+
+    def track(self, key: tuple, resource, nbytes: int):
+        with self.lock:
+            self.in_use[id(resource)] = (key, resource, nbytes)
+            self.in_use_bytes += nbytes
+            evicted = self.evict()
+        self.destroy(evicted)
+        return resource
+
+    def acquire_texture(
+        self,
+        width: int,
+        height: int,
+        format: g2c.TextureFormat = g2c.TextureFormat.RGBA8UINT,
+        surface: bool = False,
+    ) -> g2c.Texture:
+        key = ("texture", width, height, format, surface)
+        texture = self.take(key)
+        if texture is None:
+            texture = g2c.texture((height, width, format.channels), format, surface=surface)
+            self.track(key, texture, texture.nbytes)
+        return texture
+
+    def acquire_tensor(self, shape: tuple, dtype: torch.dtype, fill: int = 0) -> torch.Tensor:
+        key = ("tensor", tuple(shape), dtype)
+        tensor = self.take(key)
+        if tensor is None:
+            tensor = torch.empty(shape, dtype=dtype, device=self.device)
+            self.track(key, tensor, tensor.numel() * tensor.element_size())
+        return tensor.fill_(fill)
+
+    def release(self, resource):
+        with self.lock:
+            entry = self.in_use.pop(id(resource), None)
+            if entry is None:
+                return
+            self.in_use_bytes -= entry[2]
+            self.free[id(resource)] = entry
+            self.free_bytes += entry[2]
+            evicted = self.evict()
+        self.destroy(evicted)
+
+    def evict(self) -> list:
+        # drop least recently released entries until we fit the budget again
+        evicted = []
+        while (
+            self.budget > 0
+            and self.free
+            and self.free_bytes + self.in_use_bytes > self.budget
+        ):
+            _, (key, resource, nbytes) = self.free.popitem(last=False)
+            self.free_bytes -= nbytes
+            evicted.append(resource)
+        return evicted
+
+    def destroy(self, resources: list):
+        for resource in resources:
+            if isinstance(resource, g2c.Texture):
+                g2c.release(resource)
+
+    def clear(self):
+        with self.lock:
+            evicted = [entry[1] for entry in self.free.values()]
+            self.free.clear()
+            self.free_bytes = 0
+        self.destroy(evicted)
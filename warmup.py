@@ -0,0 +1,90 @@
+from pathlib import Path
+from types import SimpleNamespace
+import itertools
+import time
+import torch
+from pydantic import BaseModel
+
+from config import Args
+from resolution_buckets import ResolutionBuckets
+
+
+# Shapes to run once before the server accepts sessions, so torch.compile,
+# sfast and onediff build their graphs at startup instead of on the first
+# frames. Loaded from the JSON file given to --warmup-profile, e.g.
+#
+#   {"resolutions": ["512x512", "768x768"], "steps": [1, 2],
+#    "batch_sizes": [1, 4], "controlnet": [true, false]}
+class WarmupProfile(BaseModel):
+    # empty resolutions/steps fall back to the pipeline defaults, empty
+    # batch_sizes to every size the scheduler can batch up to
+    resolutions: list[str] = []
+    steps: list[int] = []
+    batch_sizes: list[int] = []
+    controlnet: list[bool] = [True]
+
+
+def load_profile(args: Args, buckets: ResolutionBuckets) -> WarmupProfile:
+    if args.warmup_profile:
+        profile = WarmupProfile.model_validate_json(Path(args.warmup_profile).read_text())
+    elif args.torch_compile or args.sfast or args.onediff or buckets:
+        profile = WarmupProfile()
+    else:
+        return None
+    if not profile.resolutions and buckets:
+        profile.resolutions = [f"{width}x{height}" for width, height in buckets.sizes]
+    if not profile.batch_sizes:
+        profile.batch_sizes = list(range(1, max(1, args.max_batch_size) + 1))
+    return profile
+
+
+def warmup_params(pipeline, profile: WarmupProfile) -> list[tuple[SimpleNamespace, int]]:
+    defaults = pipeline.InputParams()
+    sizes = ResolutionBuckets(",".join(profile.resolutions)).sizes or [
+        (defaults.width, defaults.height)
+    ]
+    steps = profile.steps or [getattr(defaults, "steps", None)]
+    # pipelines without a controlnet have nothing to toggle
+    controlnet = profile.controlnet if hasattr(defaults, "controlnet_scale") else [True]
+
+    shapes = []
+    for (width, height), step, batch_size, use_controlnet in itertools.product(
+        sizes, dict.fromkeys(steps), dict.fromkeys(profile.batch_sizes), dict.fromkeys(controlnet)
+    ):
+        params = SimpleNamespace(**defaults.dict())
+        params.width = width
+        params.height = height
+        if step is not None:
+            params.steps = step
+        if not use_controlnet:
+            params.controlnet_scale = 0.0
+        shapes.append((params, batch_size))
+    return shapes
+
+
+@torch.no_grad()
+def warmup(pipeline, profile: WarmupProfile, device: torch.device, torch_dtype: torch.dtype):
+    if profile is None:
+        return
+    for params, batch_size in warmup_params(pipeline, profile):
+        params.image = torch.zeros(
+            (3, params.height, params.width), dtype=torch_dtype, device=device
+        )
+        shape = f"{params.width}x{params.height}"
+        if hasattr(params, "steps"):
+            shape += f" steps={params.steps}"
+        shape += f" batch={batch_size}"
+        if hasattr(params, "controlnet_scale"):
+            shape += f" controlnet={'off' if params.controlnet_scale == 0 else 'on'}"
+
+        if batch_size > 1 and not hasattr(pipeline, "predict_batch"):
+            print(f"Warmup {shape}: skipped, pipeline does not batch")
+            continue
+        start = time.perf_counter()
+        if batch_size > 1:
+            pipeline.predict_batch([params] * batch_size)
+        else:
+            pipeline.predict(params)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(f"Warmup {shape}: {time.perf_counter() - start:.2f}s")